@@ -0,0 +1,350 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark of log_analyzer stages on synthetic ui_short logs.
+
+    python benchmark.py run [--lines N] [--urls N] [--zipf S]
+                            [--error-rate R] [--gzip] [--seed S]
+                            [--output results.json]
+    python benchmark.py compare BASELINE RESULTS [--threshold 0.1]
+"""
+
+import os
+import sys
+import argparse
+import bisect
+import gzip
+import json
+import logging
+import random
+import resource
+import shutil
+import tempfile
+import time
+import platform
+import multiprocessing
+
+from datetime import datetime, timedelta
+
+import log_analyzer
+
+METHODS = ('GET', 'GET', 'GET', 'GET', 'POST', 'PUT', 'DELETE')
+URL_TEMPLATES = (
+    '/api/v2/banner/%d',
+    '/api/v2/banner/%d/',
+    '/api/1/photogenic_banners/list/?server_name=WIN7RB%d',
+    '/api/v2/banner/%d/statistic/?date_from=2017-06-29&date_to=2017-06-29',
+    '/api/v2/internal/banner/%d/info',
+    '/banners/%d/switch_status/?status=delete&_=1498748952071',
+    '/accounts/login/?next=/agency/campaigns/%d',
+    '/ads/campaigns/%d/gpmd/event_statistic/?date_type=day&puid1=&puid2=',
+)
+USER_AGENTS = (
+    'python-requests/2.8.1',
+    'Lynx/2.8.8dev.9 libwww-FM/2.14 SSL-MM/1.4.1 GNUTLS/2.10.5',
+    'Python-urllib/2.7',
+    'Slotovod',
+    'Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/537.36 '
+    '(KHTML, like Gecko) Chrome/59.0.3071.115 Safari/537.36',
+)
+
+# stages are timed separately, each in its own process
+STAGES = ('xread_loglines', 'xread_loglines_threaded', 'parse_log_line',
+          'process_logfile', 'render_report', 'save_report', 'write_report')
+REPORT_TEMPLATE = os.path.join(
+    os.path.dirname(os.path.abspath(log_analyzer.__file__)), 'report.html')
+
+
+def zipf_sampler(rnd, size, skew):
+    """
+    random rank in [0, size) with P(rank) ~ 1 / (rank + 1) ^ skew
+    """
+    cumulative = []
+    total = 0.0
+    for rank in xrange(size):
+        total += 1.0 / (rank + 1) ** skew
+        cumulative.append(total)
+
+    def sample():
+        return bisect.bisect_left(cumulative, rnd.random() * total)
+    return sample
+
+
+def generate_log(filename, lines=100000, urls=10000, zipf=1.1,
+                 error_rate=0.001, seed=1):
+    """
+    Write reproducible nginx ui_short log (gzipped if filename ends
+    with .gz)
+    """
+    rnd = random.Random(seed)
+    url_list = [URL_TEMPLATES[i % len(URL_TEMPLATES)] %
+                rnd.randint(1, 10 ** 8) for i in xrange(urls)]
+    # slow urls are slow on every hit
+    url_speed = [rnd.lognormvariate(-2.5, 1.0) for _ in xrange(urls)]
+    sample_url = zipf_sampler(rnd, urls, zipf)
+    moment = datetime(2017, 6, 29, 3, 50, 22)
+
+    if filename.endswith('.gz'):
+        logfile = gzip.open(filename, 'wb')
+    else:
+        logfile = open(filename, 'wb')
+
+    try:
+        for i in xrange(lines):
+            if rnd.random() < error_rate:
+                logfile.write('%d garbage line "%s\n' % (
+                    i, '-' * rnd.randint(0, 50)))
+                continue
+            url_id = sample_url()
+            moment += timedelta(microseconds=rnd.randint(0, 20000))
+            logfile.write(
+                '%d.%d.%d.%d -  - [%s +0300] "%s %s HTTP/1.1" %d %d "-" "%s" '
+                '"-" "%d-%d-4708-%d" "%s" %.3f\n' % (
+                    rnd.randint(1, 255), rnd.randint(0, 255),
+                    rnd.randint(0, 255), rnd.randint(0, 255),
+                    moment.strftime('%d/%b/%Y:%H:%M:%S'),
+                    rnd.choice(METHODS), url_list[url_id],
+                    200 if rnd.random() < 0.97 else 500,
+                    rnd.randint(12, 30000), rnd.choice(USER_AGENTS),
+                    1498697422 + i // 1000, rnd.randint(0, 2 ** 31), i,
+                    '%x' % rnd.getrandbits(36),
+                    rnd.expovariate(1.0 / url_speed[url_id])))
+    finally:
+        logfile.close()
+
+
+def peak_rss_kb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def run_stage(stage, log_path, work_dir, report_size, options,
+              read_thread=False):
+    """
+    -> (seconds, processed lines). Runs in a separate process, so peak
+    RSS is measured for this stage only
+    """
+    log_parser = log_analyzer.compile_log_format(
+        log_analyzer.DEFAULT_LOG_FORMAT)
+
+    if stage in ('xread_loglines', 'xread_loglines_threaded'):
+        started = time.time()
+        count = sum(1 for _ in log_analyzer.xread_loglines(
+            log_path, log_parser,
+            read_thread=(stage == 'xread_loglines_threaded')))
+        return time.time() - started, count
+
+    if stage == 'parse_log_line':
+        lines = []
+        for raw_lines, _ in log_analyzer.xread_line_batches(log_path):
+            lines.extend(raw_lines)
+        started = time.time()
+        for line in lines:
+            try:
+                log_parser(line)
+            except ValueError:
+                pass
+        return time.time() - started, len(lines)
+
+    if stage == 'process_logfile':
+        started = time.time()
+        log_analyzer.process_logfile(
+            log_analyzer.xread_loglines(log_path, log_parser,
+                                        read_thread=read_thread),
+            report_size, 1.0, **options)
+        return time.time() - started, None
+
+    # report stages: stat_list is prepared outside the timing
+    stat_list = log_analyzer.process_logfile(
+        log_analyzer.xread_loglines(log_path, log_parser,
+                                    read_thread=read_thread),
+        report_size, 1.0, **options)
+    report_filename = os.path.join(work_dir, 'report.html')
+    if stage == 'render_report':
+        started = time.time()
+        log_analyzer.render_report(stat_list, REPORT_TEMPLATE)
+        return time.time() - started, len(stat_list)
+
+    if stage == 'save_report':
+        report_str = log_analyzer.render_report(stat_list, REPORT_TEMPLATE)
+        started = time.time()
+        log_analyzer.save_report(report_str, report_filename)
+        return time.time() - started, len(stat_list)
+
+    if stage == 'write_report':
+        started = time.time()
+        log_analyzer.write_report(stat_list, REPORT_TEMPLATE,
+                                  report_filename)
+        return time.time() - started, len(stat_list)
+
+    raise ValueError('Unknown stage %s' % stage)
+
+
+def _stage_worker(queue, stage, log_path, work_dir, report_size, options,
+                  read_thread):
+    try:
+        seconds, count = run_stage(stage, log_path, work_dir, report_size,
+                                   options, read_thread)
+        queue.put((seconds, count, peak_rss_kb(), None))
+    except Exception as e:
+        queue.put((None, None, peak_rss_kb(), repr(e)))
+
+
+def measure_stage(stage, log_path, work_dir, line_count, report_size,
+                  options, repeat=1, read_thread=False):
+    best = None
+    for _ in xrange(repeat):
+        queue = multiprocessing.Queue()
+        worker = multiprocessing.Process(
+            target=_stage_worker,
+            args=(queue, stage, log_path, work_dir, report_size, options,
+                  read_thread))
+        worker.start()
+        seconds, count, rss, error = queue.get()
+        worker.join()
+        if error:
+            raise RuntimeError('Stage %s failed: %s' % (stage, error))
+        if best is None or seconds < best['seconds']:
+            count = count if count is not None else line_count
+            best = {
+                'seconds': seconds,
+                'items': count,
+                'items_per_sec': count / seconds if seconds else None,
+                'peak_rss_kb': rss,
+            }
+    return best
+
+
+def run_benchmark(args):
+    work_dir = tempfile.mkdtemp(prefix='log_analyzer_bench_')
+    try:
+        log_path = os.path.join(
+            work_dir, 'nginx-access-ui.log-20170630.%s' %
+            ('gz' if args.gzip else 'log'))
+        started = time.time()
+        generate_log(log_path, args.lines, args.urls, args.zipf,
+                     args.error_rate, args.seed)
+        print('Generated %d lines in %.1fs' % (args.lines,
+                                                time.time() - started))
+
+        options = {'engine': args.engine}
+        params = dict(vars(args))
+        del params['command']
+        del params['output']
+        results = {
+            'params': params,
+            'python': platform.python_version(),
+            'log_size': os.path.getsize(log_path),
+            'baseline_rss_kb': peak_rss_kb(),
+            'stages': {},
+        }
+        for stage in args.stages:
+            result = measure_stage(stage, log_path, work_dir, args.lines,
+                                   args.report_size, options, args.repeat,
+                                   args.read_thread)
+            results['stages'][stage] = result
+            print('%-24s %8.3fs %12.0f items/sec %10d KB peak RSS' % (
+                stage, result['seconds'], result['items_per_sec'] or 0,
+                result['peak_rss_kb']))
+
+        stages = results['stages']
+        if 'xread_loglines' in stages and 'xread_loglines_threaded' in stages:
+            results['read_thread_gain'] = (
+                stages['xread_loglines']['seconds'] /
+                stages['xread_loglines_threaded']['seconds'] - 1.0)
+            print('Read thread gain: %+.1f%%%s' % (
+                100 * results['read_thread_gain'],
+                '' if args.gzip else ' (plain log - thread is not used)'))
+    finally:
+        shutil.rmtree(work_dir)
+
+    with open(args.output, 'w') as output:
+        json.dump(results, output, indent=2, sort_keys=True)
+    print('Results saved to %s' % args.output)
+    return True
+
+
+def compare_results(baseline, results, threshold=0.1):
+    """
+    -> list of regression messages: throughput lower or peak RSS higher
+    than baseline by more than threshold
+    """
+    regressions = []
+    for stage, result in sorted(results['stages'].iteritems()):
+        base = baseline['stages'].get(stage)
+        if base is None:
+            continue
+        if (base['items_per_sec'] and result['items_per_sec'] and
+                result['items_per_sec'] < base['items_per_sec'] *
+                (1.0 - threshold)):
+            regressions.append('%s: %.0f items/sec, baseline %.0f' % (
+                stage, result['items_per_sec'], base['items_per_sec']))
+        if result['peak_rss_kb'] > base['peak_rss_kb'] * (1.0 + threshold):
+            regressions.append('%s: %d KB peak RSS, baseline %d KB' % (
+                stage, result['peak_rss_kb'], base['peak_rss_kb']))
+    return regressions
+
+
+def run_compare(args):
+    with open(args.baseline) as fbaseline:
+        baseline = json.load(fbaseline)
+    with open(args.results) as fresults:
+        results = json.load(fresults)
+
+    if baseline['params'] != results['params']:
+        print('Warning: benchmark params differ from baseline')
+
+    regressions = compare_results(baseline, results, args.threshold)
+    for regression in regressions:
+        print('REGRESSION %s' % regression)
+    if not regressions:
+        print('No regressions')
+    return not regressions
+
+
+def main():
+    arg_parser = argparse.ArgumentParser()
+    commands = arg_parser.add_subparsers(dest='command')
+
+    run_parser = commands.add_parser('run', help='run benchmark')
+    run_parser.add_argument('--lines', type=int, default=1000000)
+    run_parser.add_argument('--urls', type=int, default=50000,
+                            help='number of distinct urls')
+    run_parser.add_argument('--zipf', type=float, default=1.1,
+                            help='skew of url popularity')
+    run_parser.add_argument('--error-rate', type=float, default=0.001,
+                            help='share of unparsable lines')
+    run_parser.add_argument('--gzip', action='store_true',
+                            help='gzipped log')
+    run_parser.add_argument('--seed', type=int, default=1)
+    run_parser.add_argument('--report-size', type=int, default=1000)
+    run_parser.add_argument('--engine', default='python',
+                            choices=('python', 'numpy'))
+    run_parser.add_argument('--read-thread', action='store_true',
+                            help='inflate .gz in a separate thread in '
+                                 'process/report stages')
+    run_parser.add_argument('--repeat', type=int, default=1,
+                            help='best of N runs per stage')
+    run_parser.add_argument('--stages', nargs='+', default=list(STAGES),
+                            choices=STAGES)
+    run_parser.add_argument('--output', default='bench_results.json')
+
+    compare_parser = commands.add_parser(
+        'compare', help='compare results with baseline')
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('results')
+    compare_parser.add_argument('--threshold', type=float, default=0.1,
+                                help='allowed slowdown/growth share')
+
+    args = arg_parser.parse_args()
+    # per-line parse errors would flood the output
+    logging.basicConfig(level=logging.CRITICAL)
+    if args.command == 'run':
+        ok = run_benchmark(args)
+    else:
+        ok = run_compare(args)
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -6,18 +6,190 @@ import sys
 import argparse
 import json
 import gzip
-import shutil
+import zlib
+import mmap
 import logging
 import re
 import time
+import tempfile
+import shutil
+import math
 import operator
+import heapq
+import bisect
+import itertools
+import multiprocessing
+import threading
+import Queue
+import cPickle
+import sqlite3
+import resource
+import contextlib
+import cProfile
+import cgi
+import ctypes
+import ctypes.util
+import select
+import signal
+import struct
 import ConfigParser
 
-from datetime import datetime
-from collections import namedtuple
+from datetime import datetime, timedelta
+from array import array
+try:
+    import numpy
+except ImportError:
+    numpy = None
+from collections import namedtuple, deque, defaultdict
 
 ParsedLine = namedtuple('ParsedLine', ('url', 'response_time'))
+# parsed by extended parser (for GROUP_BY), absent variables are None
+ParsedLineExt = namedtuple('ParsedLineExt', ParsedLine._fields +
+                           ('method', 'status', 'time_local'))
 LogfileData = namedtuple('LogfileData', ('filename', 'date'))
+# logfile of one host in multi-host mode (host is None for a single host)
+HostLogfile = namedtuple('HostLogfile', ('host', 'path'))
+# missing_bound - (count, time_sum) upper bound for urls evicted from stat
+# in heavy hitters mode, (0, 0.0) if stat has every url
+# groups - {dimensions: {key: [count, time_sum, time_max]}} for GROUP_BY
+LogAggregate = namedtuple('LogAggregate', ('stat', 'line_count',
+                                           'parsed_count', 'total_time',
+                                           'missing_bound', 'groups'))
+EMPTY_BOUND = (0, 0.0)
+# in histogram mode response times of a url are kept as is until it has
+# more hits than this - most urls of a big log have just a few
+SMALL_TIMES_MAX = 16
+# external aggregation (MEMORY_LIMIT): estimated memory of url record
+# besides url string itself and 8 bytes per stored response time
+SPILL_URL_BYTES = 200
+SPILL_PARTITIONS = 64
+
+
+class UrlStat(object):
+    """
+    Per-url aggregate record of LogAggregate.stat.
+
+    time_list - array('d') of response times (exact quantiles mode, or
+    first SMALL_TIMES_MAX hits in histogram mode), time_hist - histogram
+    otherwise; the other one is None. count_err/time_err are set in heavy
+    hitters mode only
+    """
+    __slots__ = ('count', 'time_sum', 'time_max', 'time_list', 'time_hist',
+                 'count_err', 'time_err')
+
+    def __init__(self, count=0, time_sum=0.0, time_max=0.0, time_list=None,
+                 time_hist=None, count_err=None, time_err=None):
+        self.count = count
+        self.time_sum = time_sum
+        self.time_max = time_max
+        self.time_list = time_list
+        self.time_hist = time_hist
+        self.count_err = count_err
+        self.time_err = time_err
+
+    def __getstate__(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __setstate__(self, state):
+        for name, value in zip(self.__slots__, state):
+            setattr(self, name, value)
+
+# log_format ui_short из конфига nginx
+DEFAULT_LOG_FORMAT = (
+    '$remote_addr $remote_user $http_x_real_ip [$time_local] "$request" '
+    '$status $body_bytes_sent "$http_referer" '
+    '"$http_user_agent" "$http_x_forwarded_for" "$http_X_REQUEST_ID" '
+    '"$http_X_RB_USER" $request_time')
+
+LOG_FORMAT_VAR_RE = re.compile(r'\$(\w+)')
+REQUEST_RE = re.compile(r'(\S+) ([^"]+) HTTP[^"]*$')
+
+# numeric path segment
+URL_ID_RE = re.compile(r'/\d+(?=/|$)')
+# data.translate(None, ASCII_BYTES) is empty for ASCII-only data
+ASCII_BYTES = bytes(bytearray(range(128)))
+
+# inotify(7) events
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_WATCH_MASK = (IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE |
+                 IN_DELETE)
+INOTIFY_EVENT = struct.Struct('iIII')
+
+# sampling: number of windows read from plain logfile, lines to check
+# share of parse errors on, z-value of 95% confidence intervals
+SAMPLE_WINDOWS = 64
+SAMPLE_CHECK_LINES = 5000
+Z95 = 1.96
+
+# logfiles are read by blocks of this size (compressed size for .gz)
+READ_BLOCK_SIZE = 1 << 20
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+# sidecar time index (.<logfile>.tidx): $time_local of a line is sampled
+# every TIME_INDEX_STEP bytes of inflated log, gzip access point (state
+# to restart inflating from) is kept every TIME_INDEX_SPAN bytes.
+# Lines are expected in time order give or take TIME_INDEX_SLACK minutes
+TIME_INDEX_STEP = 1 << 16
+TIME_INDEX_SPAN = 1 << 25
+TIME_INDEX_SLACK = 1
+TIME_INDEX_VERSION = 2
+TIME_LOCAL_MONTHS = dict((month, i + 1) for i, month in enumerate((
+    'Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun',
+    'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec')))
+
+# zlib through ctypes (python zlib has no inflatePrime/inflateSetDictionary
+# to restart inflating mid-stream)
+Z_OK = 0
+Z_STREAM_END = 1
+Z_BUF_ERROR = -5
+Z_NO_FLUSH = 0
+Z_BLOCK = 5
+# inflate() returned at the end of deflate block, last block is decoded
+Z_END_OF_BLOCK = 128
+Z_LAST_BLOCK = 64
+# deflate window: output needed to restart inflating
+GZIP_WINDOW = 1 << 15
+
+
+class ZStream(ctypes.Structure):
+    # z_stream of zlib.h
+    _fields_ = [
+        ('next_in', ctypes.c_void_p),
+        ('avail_in', ctypes.c_uint),
+        ('total_in', ctypes.c_ulong),
+        ('next_out', ctypes.c_void_p),
+        ('avail_out', ctypes.c_uint),
+        ('total_out', ctypes.c_ulong),
+        ('msg', ctypes.c_char_p),
+        ('state', ctypes.c_void_p),
+        ('zalloc', ctypes.c_void_p),
+        ('zfree', ctypes.c_void_p),
+        ('opaque', ctypes.c_void_p),
+        ('data_type', ctypes.c_int),
+        ('adler', ctypes.c_ulong),
+        ('reserved', ctypes.c_ulong),
+    ]
+
+
+# колонки отчета с квантилями времени ответа
+QUANTILES = (
+    ('time_med', 0.5),
+    ('time_p90', 0.9),
+    ('time_p95', 0.95),
+    ('time_p99', 0.99),
+)
+
+# GROUP_BY dimensions, in order of line_dimensions() values
+GROUP_DIMENSIONS = ('url', 'method', 'status', 'status_class', 'hour')
+SPARKLINE_CHARS = u'\u2581\u2582\u2583\u2584\u2585\u2586\u2587\u2588'
+
+# log-bucket histogram: bucket k holds values in (gamma^(k-1), gamma^k]
+HIST_ZERO_KEY = -(1 << 30)
+HIST_MIN_TIME = 0.0005
 
 
 def init_config(config_filename):
@@ -32,7 +204,37 @@ def init_config(config_filename):
         "LAST_PROCESSED_FILE": "./last_processed.ts",
         "LOG_DIR": "./log",
         "LOG_FILE_PATTERN": "nginx-access-ui.log-(\d{8}).(gz|log)",
-        "PARSE_ERROR_PERC_MAX": 0.2
+        "PARSE_ERROR_PERC_MAX": 0.2,
+        "LOG_FORMAT": DEFAULT_LOG_FORMAT,
+        "EXACT_QUANTILES": False,
+        "QUANTILE_ERROR": 0.01,
+        "QUANTILE_MAX_BUCKETS": 2048,
+        "WORKERS": 1,
+        "BACKFILL_WORKERS": 0,
+        "STATE_FILE": "./log_analyzer.state",
+        "AGGREGATE_DB": "",
+        "HEAVY_HITTERS": False,
+        "HEAVY_HITTERS_FACTOR": 10,
+        "URL_RULES": "",
+        "URL_CACHE_SIZE": 100000,
+        "ENGINE": "python",
+        "REPORT_GZIP": False,
+        "REPORT_LAYOUT": "inline",
+        "REPORT_SHARDED_TEMPLATE": "./report_sharded.html",
+        "REPORT_PAGE_SIZE": 500,
+        "METRICS_FILE": "",
+        "READ_THREAD": True,
+        "WATCH_INTERVAL": 10,
+        "WATCH_INOTIFY": True,
+        "GROUP_BY": "",
+        "MEMORY_LIMIT": 0,
+        "SPILL_DIR": "",
+        "SPILL_PARTITIONS": SPILL_PARTITIONS,
+        "LOG_DIRS": "",
+        "HOST_WORKERS": 0,
+        "HOST_COLUMN": False,
+        "TIME_INDEX": False,
+        "TIME_INDEX_DIR": "",
     }
 
     # check config file
@@ -55,308 +257,3965 @@ def init_config(config_filename):
     return config
 
 
+def config_bool(value):
+    """
+    Values from config file are strings
+    """
+    if isinstance(value, basestring):
+        return value.strip().lower() in ('1', 'yes', 'true', 'on')
+    return bool(value)
+
+
+def get_filename_date(fname_match):
+    """
+    Дата из совпадения имени файла с LOG_FILE_PATTERN: первая группа,
+    кроме (?P<host>...). None если это не дата
+    """
+    host_group = fname_match.re.groupindex.get('host')
+    for group in xrange(1, fname_match.re.groups + 1):
+        if group != host_group:
+            try:
+                return datetime.strptime(fname_match.group(group), '%Y%m%d')
+            except (ValueError, TypeError):
+                return None
+    return None
+
+
+def get_log_files(file_list, filename_pattern, since=None):
+    """
+    Все файлы из file_list с подходящим форматом имени, по возрастанию даты
+    Дату берем из имени файла, на одну дату - один файл
+    """
+    logfiles = {}
+    for filename in sorted(file_list):
+        fname_match = re.match(filename_pattern, filename)
+        if not fname_match:
+            continue
+        fname_date = get_filename_date(fname_match)
+        if fname_date is None:
+            continue
+        if since and fname_date < since:
+            continue
+        logfiles.setdefault(fname_date, filename)
+
+    return [LogfileData(filename=filename, date=fname_date)
+            for fname_date, filename in sorted(logfiles.iteritems())]
+
+
 def get_last_log(file_list, filename_pattern):
     """
     Выбираем самый поздний файл в списке file_list с подходящим форматом имени
     Дату берем из имени файла
     """
-    max_date_mark = 0
-    last_filename = None
+    logfiles = get_log_files(file_list, filename_pattern)
+    if not logfiles:
+        return None
+    return logfiles[-1]
 
-    for filename in file_list:
-        fname_match = re.match(filename_pattern, filename)
-        if fname_match:
-            fname_date_part = fname_match.group(1)
-            if int(fname_date_part) > int(max_date_mark):
-                last_filename = filename
-                max_date_mark = fname_date_part
 
-    max_datetime = datetime.strptime(max_date_mark, '%Y%m%d')
-    return LogfileData(filename=last_filename, date=max_datetime)
+def get_host_log_files(sources, filename_pattern, since=None):
+    """
+    Multi-host mode: sources - [(host, log_dir, file_list), ...] ->
+    [(date, [HostLogfile, ...]), ...] by date, one file per host and date.
+    Host is named by the source and by (?P<host>...) group of
+    filename_pattern, if any
+    """
+    logfiles = defaultdict(dict)
+    for source_host, log_dir, file_list in sources:
+        for filename in sorted(file_list):
+            fname_match = re.match(filename_pattern, filename)
+            if not fname_match:
+                continue
+            fname_date = get_filename_date(fname_match)
+            if fname_date is None or (since and fname_date < since):
+                continue
+            host = '/'.join(filter(None, (
+                source_host, fname_match.groupdict().get('host'))))
+            logfiles[fname_date].setdefault(
+                host, HostLogfile(host, os.path.join(log_dir, filename)))
+
+    return [(fname_date, [host_logs[host] for host in sorted(host_logs)])
+            for fname_date, host_logs in sorted(logfiles.iteritems())]
+
+
+def is_multi_host(config):
+    """
+    Several LOG_DIRS or (?P<host>...) in LOG_FILE_PATTERN
+    """
+    return bool(config.get('LOG_DIRS') or
+                'host' in re.compile(config['LOG_FILE_PATTERN']).groupindex)
+
+
+def single_host_only(config, mode):
+    """
+    Logs an error if mode (of one logfile per date) is run for several
+    hosts: its report would be of one host only
+    """
+    if not is_multi_host(config):
+        return False
+    logging.error('%s is not supported for several hosts (LOG_DIRS or '
+                  '(?P<host>...) in LOG_FILE_PATTERN)', mode)
+    return True
+
+
+def read_log_format(log_format):
+    """
+    Accepts plain format string or nginx-style definition:
+        log_format ui_short '$remote_addr ...'
+                            '... $request_time';
+    In the latter case quoted parts are concatenated
+    """
+    if isinstance(log_format, unicode):
+        # lines are parsed as bytes
+        log_format = log_format.encode('utf-8')
+    quoted = re.findall(r"'([^']*)'", log_format)
+    if quoted:
+        return ''.join(quoted)
+    return log_format.strip()
+
+
+def compile_log_format(log_format, extended=False):
+    """
+    Compile nginx log_format into parser function line -> ParsedLine
+
+    Only $request and $request_time are extracted. Fast path walks
+    separators with str.find (fields before $request) and str.rfind
+    (fields after it). Lines not handled by the fast path are matched
+    against a regex built from the same format.
 
+    extended=True - parser returns ParsedLineExt, $status and $time_local
+    are found by their own short walk from the nearest known position
+    """
+    log_format = read_log_format(log_format)
+    tokens = LOG_FORMAT_VAR_RE.split(log_format)
+    literals = tokens[0::2]
+    names = tokens[1::2]
+
+    for name in ('request', 'request_time'):
+        if name not in names:
+            raise ValueError('Log format has no $%s variable' % name)
+
+    request_idx = names.index('request')
+    time_idx = names.index('request_time')
+
+    extra_names = [name for name in ('status', 'time_local')
+                   if extended and name in names]
+
+    # fallback regex
+    pattern = []
+    for i, name in enumerate(names):
+        pattern.append(re.escape(literals[i]))
+        if name == 'request_time':
+            pattern.append('(?P<request_time>[0-9.]+)')
+        elif name == 'request':
+            pattern.append('(?P<request>[^"]*)')
+        elif name in extra_names and name not in names[:i]:
+            pattern.append('(?P<%s>.*?)' % name)
+        else:
+            pattern.append('.*?')
+    pattern.append(re.escape(literals[-1]) + '$')
+    format_re = re.compile(''.join(pattern))
+
+    # fast path: separators are searched left-to-right up to $request and
+    # right-to-left down to $request_time. Empty separator between two
+    # variables can't be found - such formats use regex only
+    head_len = len(literals[0])
+    tail_len = len(literals[-1])
+    forward = literals[1:request_idx + 2]
+    backward = literals[len(literals) - 2:time_idx:-1]
+    use_fast = (time_idx > request_idx and
+                all(forward) and all(backward) and literals[time_idx])
+    time_sep = literals[time_idx]
+
+    # extra field: (slot in (status, time_local), start from - 'head',
+    # 'request' or 'tail', separators to walk, separator at the other end
+    # of the field). Fields before $request are cut by positions found
+    # on the way to $request: (slot, 'head', index, separator after it)
+    extra_plans = []
+    for name in extra_names:
+        idx = names.index(name)
+        slot = ('status', 'time_local').index(name)
+        if idx < request_idx:
+            plan = (slot, 'head', idx, literals[idx + 1])
+        elif idx < time_idx:
+            plan = (slot, 'request', literals[request_idx + 2:idx + 1],
+                    literals[idx + 1])
+        else:
+            plan = (slot, 'tail', literals[len(literals) - 2:idx:-1],
+                    literals[idx])
+        if plan[1] != 'head':
+            use_fast = use_fast and all(plan[2]) and bool(plan[3])
+        extra_plans.append(plan)
+    request_sep_len = len(forward[-1])
+
+    def parse_regex(line):
+        log_match = format_re.match(line)
+        if not log_match:
+            raise ValueError('Line does not match log format')
+        request_match = REQUEST_RE.match(log_match.group('request'))
+        if not request_match:
+            raise ValueError('Wrong $request field')
+        if extended:
+            extras = log_match.groupdict()
+            return ParsedLineExt(
+                url=request_match.group(2),
+                response_time=log_match.group('request_time'),
+                method=request_match.group(1),
+                status=extras.get('status'),
+                time_local=extras.get('time_local'))
+        return ParsedLine(url=request_match.group(2),
+                          response_time=log_match.group('request_time'))
+
+    def find_extras(line, starts, request_end):
+        """
+        [status, time_local], None if separators are not found.
+        starts - positions of fields before $request
+        """
+        values = [None, None]
+        for slot, start_from, seps, end_sep in extra_plans:
+            if start_from == 'head':
+                # seps is index of the field here
+                end = starts[seps + 1] - len(end_sep)
+                values[slot] = line[starts[seps]:end]
+                continue
+            if start_from == 'tail':
+                end = len(line) - tail_len
+                for sep in seps:
+                    end = line.rfind(sep, request_end, end)
+                    if end < 0:
+                        return None
+                start = line.rfind(end_sep, request_end, end)
+                if start < 0:
+                    return None
+                values[slot] = line[start + len(end_sep):end]
+                continue
+            start = request_end + request_sep_len
+            for sep in seps:
+                start = line.find(sep, start)
+                if start < 0:
+                    return None
+                start += len(sep)
+            end = line.find(end_sep, start)
+            if end < 0:
+                return None
+            values[slot] = line[start:end]
+        return values
+
+    def parse(line):
+        if not use_fast:
+            return parse_regex(line)
+
+        # $request
+        pos = head_len
+        if extended:
+            # starts of fields before $request - for find_extras
+            starts = [pos]
+            for sep in forward[:-1]:
+                pos = line.find(sep, pos)
+                if pos < 0:
+                    return parse_regex(line)
+                pos += len(sep)
+                starts.append(pos)
+        else:
+            for sep in forward[:-1]:
+                pos = line.find(sep, pos)
+                if pos < 0:
+                    return parse_regex(line)
+                pos += len(sep)
+        end = line.find(forward[-1], pos)
+        if end < 0:
+            return parse_regex(line)
+
+        # $request_time
+        time_end = len(line) - tail_len
+        for sep in backward:
+            time_end = line.rfind(sep, end, time_end)
+            if time_end < 0:
+                return parse_regex(line)
+        time_start = line.rfind(time_sep, end, time_end)
+        if time_start < 0:
+            return parse_regex(line)
+        response_time = line[time_start + len(time_sep):time_end]
+
+        method, _, rest = line[pos:end].partition(' ')
+        url, _, protocol = rest.rpartition(' ')
+        if (not url or not protocol.startswith('HTTP') or
+                not response_time.replace('.', '', 1).isdigit()):
+            return parse_regex(line)
 
-def parse_log_line(line):
+        if extended:
+            values = find_extras(line, starts, end)
+            if values is None:
+                return parse_regex(line)
+            return ParsedLineExt(url, response_time, method, *values)
+        return ParsedLine(url=url, response_time=response_time)
+
+    return parse
+
+
+DEFAULT_LOG_PARSER = compile_log_format(DEFAULT_LOG_FORMAT)
+
+# compiled parsers (kept by workers and by --watch): log_format -> parser
+_log_parsers = {}
+
+
+def get_log_parser(log_format, extended=False):
+    log_parser = _log_parsers.get((log_format, extended))
+    if log_parser is None:
+        log_parser = _log_parsers[log_format, extended] = compile_log_format(
+            log_format, extended)
+    return log_parser
+
+
+def parse_log_line(line, log_parser=None):
     """
     process single log line
 
     return tuple(url, response_time)
     """
-    pattern = ('([0-9.]+) (.*) (.*) \[(.*)\] \"(\S+) ([^"]+) HTTP[^"]*\" .* '
-               '([0-9.]+)$')
     try:
-        log_match = re.match(pattern, line)
+        return (log_parser or DEFAULT_LOG_PARSER)(line)
     except Exception as e:
-        logging.error("error parsing line:'%s' message:%s", line, e.message)
+        logging.error("error parsing line:'%s' message:%s", line, e)
         raise
 
-    try:
-        result = ParsedLine(url=log_match.group(
-            6), response_time=log_match.group(7))
-    except Exception as e:
-        logging.error(
-            "error parsing line (no groups):'%s' message:%s", line, e.message)
-        raise
 
-    return result
+def url_rule_strip_query(params):
+    """
+    No params - drop query string, else drop listed query params
+    """
+    params = set(params)
 
+    def rule(url):
+        path, sep, query = url.partition('?')
+        if not sep or not params:
+            return path
+        query = '&'.join(pair for pair in query.split('&')
+                         if pair.partition('=')[0] not in params)
+        return path + '?' + query if query else path
+    return rule
 
-def xread_loglines(filename):
-    # open plain or gzip
-    try:
-        if filename.endswith('.gz'):
-            logfile = gzip.open(filename)
-        else:
-            logfile = open(filename)
-    except Exception as e:
-        logging.error('Unable to open file %s', filename)
-        raise
 
-    for line in logfile:
-        try:
-            parsed = parse_log_line(line.decode('utf-8').rstrip())
-            yield parsed, None
-        except UnicodeDecodeError as e:
-            yield None, e
-        except Exception as e:
-            yield None, e
+def url_rule_numeric_ids():
+    def rule(url):
+        path, sep, query = url.partition('?')
+        return URL_ID_RE.sub('/{id}', path) + sep + query
+    return rule
 
-    logfile.close()
 
+def url_rule_route(pattern, template):
+    """
+    Path matching pattern -> template (whole url, query is dropped)
+    """
+    route_re = re.compile(pattern)
 
-def median(lst):
-    n = len(lst)
-    if n < 1:
-        return None
-    if n % 2 == 1:
-        return sorted(lst)[n // 2]
-    else:
-        return sum(sorted(lst)[n // 2 - 1:n // 2 + 1]) / 2.0
+    def rule(url):
+        route_match = route_re.match(url.partition('?')[0])
+        if route_match:
+            return route_match.expand(template)
+        return url
+    return rule
 
 
-def process_logfile(log_lines, report_size=1000, parse_error_perc_max=0.0):
-    line_count = 0
-    parsed_count = 0
-    total_time = 0.0
+def url_rule_replace(pattern, replacement=''):
+    replace_re = re.compile(pattern)
 
-    stat = {}
-    for line, parse_error in log_lines:
-        line_count += 1
-        if parse_error:
+    def rule(url):
+        return replace_re.sub(replacement, url)
+    return rule
+
+
+URL_RULE_TYPES = {
+    'strip_query': url_rule_strip_query,
+    'numeric_ids': url_rule_numeric_ids,
+    'route': url_rule_route,
+    'replace': url_rule_replace,
+}
+
+
+def compile_url_rules(url_rules, cache_size=100000):
+    """
+    URL_RULES text (one rule per line, applied in order):
+        strip_query [PARAM ...]
+        numeric_ids
+        route PATTERN TEMPLATE
+        replace PATTERN [REPLACEMENT]
+    -> function raw url -> normalized url, or None if there are no rules.
+
+    Results are cached for cache_size urls in two generations: when the
+    young dict is full it becomes old one and the previous old one is
+    dropped, so recently used urls survive (LRU-like) and hit costs one
+    dict lookup. normalize.stats['misses'] counts urls that went through
+    rules.
+    """
+    rules = []
+    for rule_line in url_rules.splitlines():
+        parts = rule_line.split()
+        if not parts or parts[0].startswith('#'):
             continue
+        rule_type = URL_RULE_TYPES.get(parts[0])
+        if rule_type is None:
+            raise ValueError('Unknown url rule: %s' % parts[0])
+        if rule_type is url_rule_strip_query:
+            rules.append(rule_type(parts[1:]))
+        else:
+            try:
+                rules.append(rule_type(*parts[1:]))
+            except (TypeError, re.error) as e:
+                raise ValueError('Wrong url rule "%s": %s' %
+                                 (rule_line.strip(), e))
+    if not rules:
+        return None
 
-        response_time = float(line.response_time)
-        current_stat = stat.get(
-            line.url, {'count': 0, 'time_sum': 0.0,
-                       'time_max': 0.0, 'time_list': []})
+    cache = {'young': {}, 'old': {}}
+    stats = {'misses': 0}
 
-        current_stat['count'] = current_stat['count'] + 1
-        current_stat['time_sum'] = current_stat['time_sum'] + response_time
-        current_stat['time_max'] = (
-            current_stat['time_max']
-            if response_time <= current_stat['time_sum']
-            else response_time)
+    def normalize(url):
+        young = cache['young']
+        result = young.get(url)
+        if result is None:
+            result = cache['old'].get(url)
+            if result is None:
+                stats['misses'] += 1
+                result = url
+                for rule in rules:
+                    result = rule(result)
+            if len(young) >= cache_size:
+                cache['old'] = young
+                young = cache['young'] = {}
+            young[url] = result
+        return result
 
-        current_stat['time_list'].append(response_time)
+    normalize.stats = stats
+    return normalize
 
-        stat[line.url] = current_stat
-        parsed_count += 1
-        total_time += response_time
 
-    # проверяем чтобы процент ощибочных строк был не больше максимума
-    #
-    if float(parsed_count) / line_count < (1.0 - parse_error_perc_max):
-        logging.error('Wrong format. %d of %d lines parsed. '
-                      'More than %d%% of errors - failed parsing',
-                      parsed_count, line_count,
-                      int(parse_error_perc_max * 100))
-        raise Exception('Wrong format')
+def count_url_cache(normalize, misses_before, lookups):
+    """
+    Log and count url cache hits of one aggregation
+    (normalize.stats['misses'] was misses_before at its start)
+    """
+    misses = normalize.stats['misses'] - misses_before
+    count_metric('url_cache_lookups', lookups)
+    count_metric('url_cache_misses', misses)
+    if lookups:
+        logging.info('URL rules: cache hit rate %.1f%%, '
+                     '%d cache misses of %d lookups',
+                     100.0 * (lookups - misses) / lookups, misses, lookups)
 
-    # pass 2 - calculate aggregates & convert
-    logging.info("Calculating aggregates on total %d lines", parsed_count)
 
-    stat_list = []
-    for url, data in stat.iteritems():
-        stat_list.append({
-            'url': url,
-            'count': data['count'],
-            'time_max': data['time_max'],
-            'time_sum': data['time_sum'],
-            'time_avg': data['time_sum'] / data['count'],
-            'time_med': median(data['time_list']),
-            'time_perc': data['time_sum'] / total_time,
-            'count_perc': float(data['count']) / parsed_count,
-        })
+# compiled url rules of the process: (url_rules, cache_size) -> normalize
+_url_normalizers = {}
 
-    # sort it
-    stat_list.sort(key=operator.itemgetter('time_avg'), reverse=True)
 
-    return stat_list[:report_size]
+def get_url_normalizer(url_rules, cache_size=100000):
+    if not url_rules:
+        return None
+    key = (url_rules, cache_size)
+    if key not in _url_normalizers:
+        _url_normalizers[key] = compile_url_rules(url_rules, cache_size)
+    return _url_normalizers[key]
 
 
-def render_report(stat_list, template_filename):
-    """
-    Render stat into html file.
-    Uses REPORT_TEMPLATE from config as page-template
+# run metrics: stage -> [wall, cpu] seconds spent in the stage itself
+# (nested stages excluded), counter -> value
+_metrics = {'stages': {}, 'counters': defaultdict(int)}
+_stage_stack = []
+_stage_clock = [0.0, 0.0]
 
-    :param stat - stat dict, where keys - uri`s
-    :param processed_date - inital date - used in resulting filename
 
-    result row: {"count": 2767,
-                 "time_avg": 62.994999999999997,
-                 "time_max": 9843.5689999999995,
-                 "time_sum": 174306.35200000001,
-                 "url": "/api/v2/internal/html5/phantomjs/queue/?wait=1m",
-                 "time_med": 60.073,
-                 "time_perc": 9.0429999999999993,
-                 "count_perc": 0.106}
-    """
+def cpu_time():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
 
-    # re-format stat to list
-    stat_rows = []
-    for data in stat_list:
-        stat_rows.append({
-            'url': data['url'],
-            'count': data['count'],
-            'time_avg': '{0:.10f}'.format(data['time_avg']),
-            'time_max': '{0:.10f}'.format(data['time_max']),
-            'time_sum': '{0:.10f}'.format(data['time_sum']),
-            'time_med': '{0:.10f}'.format(data['time_med']),
-            'time_perc': '{0:.10f}'.format(data['time_perc']),
-            'count_perc': '{0:.10f}'.format(data['count_perc']),
-        })
 
-    stat_json = json.dumps(stat_rows)
+def reset_metrics():
+    _metrics['stages'].clear()
+    _metrics['counters'].clear()
+    del _stage_stack[:]
 
-    try:
-        with open(template_filename, "r") as ftemp:
-            template = "".join(ftemp.readlines())
-    except Exception as e:
-        logging.error('Failed to read report template file "%s": %s',
-                      template_filename, e.message)
-        return None
 
-    report_str = template.replace('$table_json', stat_json)
-    return report_str
+def count_metric(name, value=1):
+    _metrics['counters'][name] += value
 
 
-def get_report_filename(report_dir, report_datetime):
-    return os.path.join(report_dir, "report_%s.html" %
-                        datetime.strftime(report_datetime, "%Y.%m.%d"))
+def add_counters(counters):
+    for name, value in counters.iteritems():
+        count_metric(name, value)
 
 
-def save_report(report_str, report_filename):
-    report_tmp_filename = "./report.tmp"
-    try:
-        with open(report_tmp_filename, 'w') as freport:
-            freport.write(report_str)
-    except Exception as e:
-        logging.error('Failed to write report to tmp-file: %s', e.message)
-        return None
+def _charge_stage():
+    """
+    Add time since last stage switch to the current stage
+    """
+    wall, cpu = time.time(), cpu_time()
+    if _stage_stack:
+        spent = _metrics['stages'].setdefault(_stage_stack[-1], [0.0, 0.0])
+        spent[0] += wall - _stage_clock[0]
+        spent[1] += cpu - _stage_clock[1]
+    _stage_clock[:] = [wall, cpu]
 
+
+@contextlib.contextmanager
+def metrics_stage(name):
+    """
+    Account wall and cpu time of the block to stage name
+    """
+    _charge_stage()
+    _stage_stack.append(name)
     try:
-        shutil.copyfile(report_tmp_filename, report_filename)
-    except Exception as e:
-        logging.error('Failed to write report to destination: %s', e.message)
-        return None
+        yield
+    finally:
+        _charge_stage()
+        _stage_stack.pop()
 
-    os.remove(report_tmp_filename)
-    return True
 
+def xmetered(iterable, stage, batch_size=1000):
+    """
+    Iterate accounting time spent inside iterable to stage.
+    Items are pulled in batches, so clock is checked once per batch
+    """
+    iterator = iter(iterable)
+    while True:
+        with metrics_stage(stage):
+            batch = list(itertools.islice(iterator, batch_size))
+        if not batch:
+            return
+        for item in batch:
+            yield item
 
-def update_ts_file(ts_filename):
-    timestamp = int(time.mktime(datetime.now().timetuple()))
 
+def open_logfile(filename):
+    # open plain or gzip
     try:
-        with open(ts_filename, 'w') as ts_file:
-            ts_file.write(str(timestamp))
+        if filename.endswith('.gz'):
+            return gzip.open(filename)
+        return open(filename)
     except Exception as e:
-        logging.error('Unable to update ts file "%s": %s',
-                      ts_filename, e.message)
-        return False
+        logging.error('Unable to open file %s', filename)
+        raise
 
-    return True
 
+def xparse_loglines(raw_lines, log_parser=None, ascii_only=False):
+    """
+    raw (undecoded) lines -> (parsed, error)
 
-def process(config):
-    # get last logfile
-    try:
-        log_files_list = os.listdir(config['LOG_DIR'])
-    except Exception as e:
-        logging.error('Could not open log-dir %s. message: %s',
-                      config['LOG_DIR'], e.message)
-        update_ts_file(config['TS_FILE'])
-        return False
+    Lines are parsed as bytes, only url is decoded from utf-8 and only if
+    it has non-ASCII bytes. ascii_only - lines are known to be ASCII
+    """
+    for line in raw_lines:
+        try:
+            parsed = parse_log_line(line.rstrip(), log_parser)
+            if not ascii_only and parsed.url.translate(None, ASCII_BYTES):
+                parsed = parsed._replace(url=parsed.url.decode('utf-8'))
+            yield parsed, None
+        except UnicodeDecodeError as e:
+            count_metric('parse_errors_decode')
+            yield None, e
+        except Exception as e:
+            count_metric('parse_errors_format')
+            yield None, e
 
-    target_logfile_data = get_last_log(
-        log_files_list, config['LOG_FILE_PATTERN'])
-    
-    if not target_logfile_data:
-        logging.info('No logfile found. Exiting')
-        return True
 
-    # create report filename
-    report_filename = get_report_filename(config['REPORT_DIR'],
-                                          target_logfile_data.date)
-    
-    # check if report exists
-    if os.path.isfile(report_filename):
-        logging.info("Report for %s already exists. Exiting",
-                     target_logfile_data.date.isoformat())
-        return True
+def xread_blocks(filename, block_size=READ_BLOCK_SIZE, time_index=None):
+    """
+    Content of logfile by blocks: plain file through mmap, gzip inflated
+    with zlib (concatenated gzip members are supported).
+    time_index - sidecar index (see new_time_index) filled along the way
+    """
+    offset = 0
+    for block in xread_raw_blocks(filename, block_size, time_index):
+        if time_index is not None:
+            index_block_times(time_index, block, offset)
+        offset += len(block)
+        yield block
 
-    logging.info("Processing logfile: %s" % target_logfile_data.filename)
-    log_path = os.path.join(config['LOG_DIR'], target_logfile_data.filename)
-    try:
-        stat = process_logfile(
-            log_lines=xread_loglines(log_path),
-            report_size=int(config['REPORT_SIZE']),
-            parse_error_perc_max=config.get('PARSE_ERROR_PERC_MAX', 0.2)
-        )
-    except Exception as e:
-        logging.error('Processing failed: %s', e.message)
-        return False
 
-    report_str = render_report(stat, config['REPORT_TEMPLATE'])
-    saved = save_report(report_str, report_filename)
-    logging.info("Report generated: %s", report_filename)
+def xread_raw_blocks(filename, block_size=READ_BLOCK_SIZE, time_index=None):
+    # blocks of xread_blocks, gzip access points go to time_index
+    with open(filename, 'rb') as logfile:
+        if not filename.endswith('.gz'):
+            size = os.fstat(logfile.fileno()).st_size
+            if not size:
+                return
+            mapped = mmap.mmap(logfile.fileno(), size,
+                               access=mmap.ACCESS_READ)
+            try:
+                for start in xrange(0, size, block_size):
+                    yield mapped[start:start + block_size]
+            finally:
+                mapped.close()
+            return
 
-    return True
+        if time_index is not None and get_libz():
+            # access points are found by zlib of ctypes only
+            for block in xinflate_gzip(logfile, block_size,
+                                       time_index['access']):
+                yield block
+            return
 
+        data = logfile.read(block_size)
+        if not data:
+            return
+        decompressor = zlib.decompressobj(GZIP_WBITS)
+        # end of stream of the current gzip member is reached
+        ended = False
+        while True:
+            if not data:
+                data = logfile.read(block_size)
+                if not data:
+                    break
+            if ended:
+                # next gzip member; zero padding after members is skipped
+                data = data.lstrip('\0')
+                if not data:
+                    continue
+                decompressor = zlib.decompressobj(GZIP_WBITS)
+                ended = False
+            block = decompressor.decompress(data, block_size)
+            if block:
+                yield block
+            if decompressor.unused_data:
+                # input after the end of stream goes to unused_data
+                ended = True
+                data = decompressor.unused_data
+            else:
+                data = decompressor.unconsumed_tail
+        if not ended:
+            # member ends right at the end of file or file is truncated:
+            # zlib of python 2 has no Decompress.eof, so a byte past the
+            # end of stream tells it (and takes the rest of output)
+            try:
+                block = decompressor.decompress('\0')
+            except zlib.error:
+                block = ''
+            ended = bool(decompressor.unused_data)
+            if not ended:
+                raise EOFError('Compressed file ended before the '
+                               'end-of-stream marker was reached')
+            if block:
+                yield block
 
-def main():
 
-    # options
-    arg_parser = argparse.ArgumentParser()
-    arg_parser.add_argument('--config',
-                            dest='config_file',
-                            default='/usr/local/etc/log_analyzer.conf',
-                            help='path to config-file')
-    args = arg_parser.parse_args()
+# zlib of ctypes: [library or None], loaded on first use
+_libz = []
 
-    config = init_config(args.config_file)
-    if not config:
-        sys.exit(1)
 
-    print("Started %s" % datetime.now().isoformat())
+def get_libz():
+    if not _libz:
+        try:
+            libz = ctypes.CDLL(ctypes.util.find_library('z'))
+            libz.zlibVersion.restype = ctypes.c_char_p
+            libz.inflatePrime
+            libz.inflateReset2
+        except (OSError, AttributeError, TypeError):
+            libz = None
+        _libz.append(libz)
+    return _libz[0]
 
-    # logging
-    logging.basicConfig(
-        format='[%(asctime)s] %(levelname).1s %(message)s',
-        datefmt='%Y.%m.%d %H:%M:%S',
-        level=logging.INFO,
-        filename=config.get("PROCESS_LOG", None)
-    )
 
-    logging.info('Processing started')
-    # process
+def xinflate_gzip(logfile, block_size=READ_BLOCK_SIZE, access_points=None,
+                  start=None, span=TIME_INDEX_SPAN):
+    """
+    Inflated content of gzip logfile by blocks, zlib through ctypes.
+
+    access_points - list to collect access points into, one per span
+    bytes of output: (output offset, input offset, bits, zlib-compressed
+    window), input offset is of the deflate block boundary, bits - its
+    bits in the previous byte.
+    start - access point to restart inflating from (output starts at its
+    output offset)
+    """
+    libz = get_libz()
+    stream = ZStream()
+    stream_ref = ctypes.byref(stream)
+    raw = start is not None
+    if libz.inflateInit2_(stream_ref, -zlib.MAX_WBITS if raw else GZIP_WBITS,
+                          libz.zlibVersion(), ctypes.sizeof(stream)) != Z_OK:
+        raise zlib.error('Unable to initialize zlib')
     try:
-        processed = process(config)
+        in_offset = out_offset = last_point = 0
+        if raw:
+            out_offset, in_offset, bits, window = start
+            logfile.seek(in_offset - (1 if bits else 0))
+            if bits:
+                libz.inflatePrime(stream_ref, bits,
+                                  ord(logfile.read(1)) >> (8 - bits))
+            window = zlib.decompress(window)
+            libz.inflateSetDictionary(stream_ref, window, len(window))
+        flush = Z_NO_FLUSH if access_points is None else Z_BLOCK
+        out = ctypes.create_string_buffer(block_size)
+        out_address = ctypes.addressof(out)
+        filled = 0
+        tail = ''
+        data = ''
+        ended = False
+        while True:
+            if not stream.avail_in:
+                data = logfile.read(block_size)
+                if not data:
+                    break
+                stream.next_in = ctypes.cast(ctypes.c_char_p(data),
+                                             ctypes.c_void_p).value
+                stream.avail_in = len(data)
+            if ended:
+                # zero padding after gzip member is skipped
+                rest = data[len(data) - stream.avail_in:]
+                padding = len(rest) - len(rest.lstrip('\0'))
+                stream.next_in += padding
+                stream.avail_in -= padding
+                in_offset += padding
+                if not stream.avail_in:
+                    continue
+            stream.next_out = out_address + filled
+            stream.avail_out = block_size - filled
+            avail_in = stream.avail_in
+            ret = libz.inflate(stream_ref, flush)
+            if ret < 0 and ret != Z_BUF_ERROR:
+                raise zlib.error('Error %d while decompressing data' % ret)
+            in_offset += avail_in - stream.avail_in
+            out_offset += block_size - filled - stream.avail_out
+            filled = block_size - stream.avail_out
+            ended = ret == Z_STREAM_END
+
+            if (access_points is not None and
+                    stream.data_type & Z_END_OF_BLOCK and
+                    not stream.data_type & Z_LAST_BLOCK and
+                    out_offset - last_point >= span):
+                window = ctypes.string_at(
+                    out_address + max(0, filled - GZIP_WINDOW),
+                    min(filled, GZIP_WINDOW))
+                if len(window) < GZIP_WINDOW:
+                    window = tail[len(window) - GZIP_WINDOW:] + window
+                access_points.append((out_offset, in_offset,
+                                      stream.data_type & 7,
+                                      zlib.compress(window)))
+                last_point = out_offset
+
+            if filled == block_size:
+                block = ctypes.string_at(out_address, filled)
+                if access_points is not None:
+                    tail = (tail + block)[-GZIP_WINDOW:]
+                filled = 0
+                yield block
+            if ended:
+                if raw:
+                    # gzip trailer of the member, next member from header
+                    in_offset += 8
+                    logfile.seek(in_offset)
+                    stream.avail_in = 0
+                    libz.inflateReset2(stream_ref, GZIP_WBITS)
+                    raw = False
+                else:
+                    # next gzip member
+                    libz.inflateReset(stream_ref)
+        if filled:
+            yield ctypes.string_at(out_address, filled)
+        if not ended:
+            raise EOFError('Compressed file ended before the end-of-stream '
+                           'marker was reached')
+    finally:
+        libz.inflateEnd(stream_ref)
+
+
+def index_block_times(time_index, block, offset):
+    """
+    Sample $time_local of a line every TIME_INDEX_STEP bytes of block
+    at offset of inflated log into time_index['times']: [(minute, offset
+    of the line), ...] - one item where sampled minute changes.
+    time_index['last'] - latest minute of the last lines of blocks
+    """
+    times = time_index['times']
+    log_parser = time_index['parser']
+    for start in xrange(0, len(block), TIME_INDEX_STEP):
+        # line starting in the block, whole line must be in it
+        if start or offset:
+            start = block.find('\n', start) + 1
+            if not start:
+                break
+        end = block.find('\n', start)
+        if end < 0:
+            break
+        try:
+            minute = time_local_minute(log_parser(block[start:end]).time_local)
+        except Exception:
+            continue
+        if not times or times[-1][0] != minute:
+            times.append((minute, offset + start))
+
+    # samples are sparse on a quiet log: the end of log is known by time
+    # of the last line of block
+    end = block.rfind('\n')
+    start = block.rfind('\n', 0, max(end, 0)) + 1
+    if end > 0 and (start or not offset):
+        try:
+            minute = time_local_minute(log_parser(block[start:end]).time_local)
+        except Exception:
+            return
+        time_index['last'] = max(time_index['last'], minute)
+
+
+def xline_batches(blocks):
+    """
+    Lines of blocks (without newline) in batches - one per block:
+    (lines, ascii_only)
+    """
+    rest = ''
+    rest_ascii = True
+    for block in blocks:
+        block_ascii = not block.translate(None, ASCII_BYTES)
+        lines = block.split('\n')
+        lines[0] = rest + lines[0]
+        rest = lines.pop()
+        if lines:
+            yield lines, block_ascii and rest_ascii
+            rest_ascii = block_ascii
+        else:
+            rest_ascii = rest_ascii and block_ascii
+    if rest:
+        yield [rest], rest_ascii
+
+
+def xread_line_batches(filename, block_size=READ_BLOCK_SIZE, time_index=None):
+    """
+    Lines of logfile (without newline) in batches - one per block:
+    (lines, ascii_only)
+    """
+    return xline_batches(xread_blocks(filename, block_size, time_index))
+
+
+def xread_line_batches_threaded(filename, block_size=READ_BLOCK_SIZE,
+                                queue_size=4, time_index=None):
+    """
+    xread_line_batches running in a separate thread, so inflating (zlib
+    releases the GIL) overlaps with parsing in the caller. At most
+    queue_size batches wait in the queue
+    """
+    batches = Queue.Queue(queue_size)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                batches.put(item, timeout=0.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for batch in xread_line_batches(filename, block_size,
+                                            time_index):
+                if not put((batch, None)):
+                    return
+        except Exception as e:
+            put((None, e))
+            return
+        put((None, None))
+
+    producer = threading.Thread(target=produce, name='log-reader')
+    producer.daemon = True
+    producer.start()
+    try:
+        while True:
+            batch, error = batches.get()
+            if error is not None:
+                raise error
+            if batch is None:
+                return
+            yield batch
+    finally:
+        stop.set()
+        producer.join()
+
+
+def estimate_line_count(filename, probe_size=1 << 16):
+    """
+    Number of lines in logfile by average length of its first lines.
+    Uncompressed size of .gz is taken from gzip trailer (size of the last
+    member modulo 4GB)
+    """
+    with open(filename, 'rb') as logfile:
+        size = os.fstat(logfile.fileno()).st_size
+        if filename.endswith('.gz') and size >= 4:
+            logfile.seek(-4, os.SEEK_END)
+            size = struct.unpack('<I', logfile.read(4))[0]
+    blocks = xread_blocks(filename, probe_size)
+    head = next(blocks, '')
+    blocks.close()
+    return max(1, size * (head.count('\n') or 1) // max(len(head), 1))
+
+
+def xsample_line_batches(filename, sample, block_size=READ_BLOCK_SIZE,
+                         read_thread=False):
+    """
+    Deterministic sample of logfile lines in batches (lines, ascii_only).
+
+    sample - {'rate': share of lines} or {'lines': approximate number of
+    lines}. Plain file: SAMPLE_WINDOWS evenly spaced byte ranges are read,
+    the rest is skipped. Gzip is inflated completely, lines with crc32
+    below the rate are taken. Real share of lines taken (of bytes for
+    plain file) is saved into sample['rate']
+    """
+    rate = sample.get('rate')
+    if rate is None:
+        rate = float(sample['lines']) / estimate_line_count(filename)
+    if rate >= 1.0:
+        sample['rate'] = 1.0
+        for batch in xread_line_batches(filename, block_size):
+            yield batch
+        return
+
+    if filename.endswith('.gz'):
+        threshold = int(rate * 0x100000000)
+        total = taken = 0
+        if read_thread:
+            batches = xread_line_batches_threaded(filename, block_size)
+        else:
+            batches = xread_line_batches(filename, block_size)
+        for lines, ascii_only in batches:
+            total += len(lines)
+            lines = [line for line in lines
+                     if zlib.crc32(line) & 0xffffffff < threshold]
+            taken += len(lines)
+            if lines:
+                yield lines, ascii_only
+        sample['rate'] = float(taken) / total if total else 1.0
+        return
+
+    with open(filename, 'rb') as logfile:
+        size = os.fstat(logfile.fileno()).st_size
+        if not size:
+            sample['rate'] = 1.0
+            return
+        mapped = mmap.mmap(logfile.fileno(), size, access=mmap.ACCESS_READ)
+        try:
+            window_size = max(1, int(size * rate / SAMPLE_WINDOWS))
+            taken = end = 0
+            for i in xrange(SAMPLE_WINDOWS):
+                # window: whole lines from the first line starting at offset
+                start = max(end, size * i // SAMPLE_WINDOWS)
+                if start:
+                    start = mapped.find('\n', start - 1) + 1
+                    if not start:
+                        break
+                end = mapped.find('\n', start + window_size - 1)
+                end = size if end < 0 else end + 1
+                block = mapped[start:end]
+                taken += len(block)
+                lines = block.split('\n')
+                if not lines[-1]:
+                    lines.pop()
+                yield lines, not block.translate(None, ASCII_BYTES)
+        finally:
+            mapped.close()
+        sample['rate'] = float(taken) / size
+
+
+def xcheck_parse_errors(log_lines, parse_error_perc_max,
+                        check_lines=SAMPLE_CHECK_LINES):
+    """
+    Fail after the first check_lines lines if share of parse errors among
+    them is already above parse_error_perc_max
+    """
+    log_lines = iter(log_lines)
+    seen = errors = 0
+    for parsed, parse_error in itertools.islice(log_lines, check_lines):
+        seen += 1
+        if parse_error:
+            errors += 1
+        yield parsed, parse_error
+    # shorter input is checked by build_stat_list as usual
+    if seen == check_lines and errors > check_lines * parse_error_perc_max:
+        logging.error('Wrong format. %d of first %d lines are not parsed. '
+                      'More than %d%% of errors - failed parsing',
+                      errors, check_lines, int(parse_error_perc_max * 100))
+        raise Exception('Wrong format')
+    for log_line in log_lines:
+        yield log_line
+
+
+def xread_loglines(filename, log_parser=None, block_size=READ_BLOCK_SIZE,
+                   read_thread=False, sample=None, time_index=None):
+    """
+    (parsed, error) for lines of logfile.
+    read_thread - inflate .gz in a separate thread
+    sample - read only a sample of lines (see xsample_line_batches)
+    time_index - sidecar index to fill by the full pass (see new_time_index)
+    """
+    if sample:
+        batches = xsample_line_batches(filename, sample, block_size,
+                                       read_thread)
+    elif read_thread and filename.endswith('.gz'):
+        batches = xread_line_batches_threaded(filename, block_size,
+                                              time_index=time_index)
+    else:
+        batches = xread_line_batches(filename, block_size, time_index)
+    return xparse_line_batches(batches, log_parser)
+
+
+def xparse_line_batches(batches, log_parser=None):
+    """
+    (parsed, error) for lines of (lines, ascii_only) batches
+    """
+    while True:
+        with metrics_stage('decompression'):
+            batch = next(batches, None)
+        if batch is None:
+            break
+        raw_lines, ascii_only = batch
+        with metrics_stage('parsing'):
+            parsed_lines = list(xparse_loglines(raw_lines, log_parser,
+                                                ascii_only))
+        for parsed in parsed_lines:
+            yield parsed
+
+
+def time_local_minute(time_local):
+    """
+    $time_local '30/Jun/2017:03:28:23 +0300' -> minute 201706300328
+    (local time of the log, offset is ignored)
+    """
+    return (int(time_local[7:11]) * 100000000 +
+            TIME_LOCAL_MONTHS[time_local[3:6]] * 1000000 +
+            int(time_local[0:2]) * 10000 +
+            int(time_local[12:14]) * 100 +
+            int(time_local[15:17]))
+
+
+def datetime_minute(value):
+    return int(value.strftime('%Y%m%d%H%M'))
+
+
+def new_time_index(log_format):
+    """
+    Empty sidecar index of logfile to be filled by a full pass over it
+    (see xread_blocks), None if log_format has no $time_local:
+    {'times': [(minute, offset), ...], 'last': minute of the last line,
+    'access': [gzip access point, ...], 'parser': extended parser of
+    log_format}. Offsets are of inflated log
+    """
+    if 'time_local' not in LOG_FORMAT_VAR_RE.findall(
+            read_log_format(log_format)):
+        return None
+    return {'times': [], 'last': 0, 'access': [],
+            'parser': get_log_parser(log_format, extended=True)}
+
+
+def get_time_index_filename(config, log_path):
+    """
+    Hidden sidecar .<logfile>.tidx next to logfile or in TIME_INDEX_DIR
+    """
+    index_dir = config.get('TIME_INDEX_DIR') or os.path.dirname(log_path)
+    return os.path.join(index_dir, '.%s.tidx' % os.path.basename(log_path))
+
+
+def save_time_index(index_filename, time_index, log_path):
+    """
+    Save index along with size and mtime of logfile, it's valid while
+    they are the same
+    """
+    try:
+        index_file, index_tmp_filename = open_tmp_file(index_filename)
+        cPickle.dump({'version': TIME_INDEX_VERSION,
+                      'signature': file_signature(log_path),
+                      'times': time_index['times'],
+                      'last': time_index['last'],
+                      'access': time_index['access']},
+                     index_file, cPickle.HIGHEST_PROTOCOL)
+        commit_tmp_files([(index_file, index_tmp_filename, index_filename)])
+    except Exception as e:
+        logging.warning('Unable to save time index "%s": %s',
+                        index_filename, e)
+        return False
+    return True
+
+
+def load_time_index(index_filename, log_path):
+    """
+    Index of logfile, None if there is no (valid) index
+    """
+    if not os.path.isfile(index_filename):
+        return None
+    try:
+        with open(index_filename, 'rb') as index_file:
+            time_index = cPickle.load(index_file)
+    except Exception as e:
+        logging.warning('Unable to read time index "%s": %s',
+                        index_filename, e)
+        return None
+    if (time_index.get('version') != TIME_INDEX_VERSION or
+            time_index.get('signature') != file_signature(log_path)):
+        logging.info('Time index "%s" is outdated', index_filename)
+        return None
+    return time_index
+
+
+def time_index_range(time_index, start, end, slack=TIME_INDEX_SLACK):
+    """
+    Offsets [offset_from, offset_to) of inflated log having all lines of
+    datetimes [start, end) (minute precision), offset_to is None - up to
+    the end of log
+    """
+    low = datetime_minute(start - timedelta(minutes=slack))
+    high = datetime_minute(end + timedelta(minutes=slack))
+    times = time_index['times']
+    if not times:
+        return 0, None
+    # first sampled minute not before the window: lines before the
+    # previous change of minute are earlier than the window
+    offset_from = 0
+    for i, (minute, _) in enumerate(times):
+        if minute >= low:
+            if i:
+                offset_from = times[i - 1][1]
+            break
+    else:
+        # the window is after the last sample, but maybe not after the
+        # last line
+        if time_index['last'] < low:
+            return 0, 0
+        return times[-1][1], None
+    # lines after the last sampled minute before the window end are later
+    # than the window
+    offset_to = 0
+    for i in xrange(len(times) - 1, -1, -1):
+        if times[i][0] < high:
+            offset_to = times[i + 1][1] if i + 1 < len(times) else None
+            break
+    return offset_from, offset_to
+
+
+def xread_range_blocks(filename, time_index, offset_from, offset_to=None,
+                       block_size=READ_BLOCK_SIZE):
+    """
+    Content of logfile between offsets of inflated log by blocks: plain
+    file through mmap, gzip is inflated from the last access point of
+    time_index before offset_from (from the start if there is none)
+    """
+    if offset_to is not None and offset_to <= offset_from:
+        return
+    with open(filename, 'rb') as logfile:
+        if not filename.endswith('.gz'):
+            size = os.fstat(logfile.fileno()).st_size
+            if offset_to is None or offset_to > size:
+                offset_to = size
+            if offset_from >= offset_to:
+                return
+            mapped = mmap.mmap(logfile.fileno(), size,
+                               access=mmap.ACCESS_READ)
+            try:
+                for start in xrange(offset_from, offset_to, block_size):
+                    yield mapped[start:min(start + block_size, offset_to)]
+            finally:
+                mapped.close()
+            return
+
+        points = time_index['access']
+        i = bisect.bisect_right([point[0] for point in points], offset_from)
+        if i and get_libz():
+            offset = points[i - 1][0]
+            blocks = xinflate_gzip(logfile, block_size, start=points[i - 1])
+        else:
+            offset = 0
+            blocks = xread_raw_blocks(filename, block_size)
+        try:
+            for block in blocks:
+                start = offset
+                offset += len(block)
+                if offset <= offset_from:
+                    continue
+                if offset_to is not None and offset >= offset_to:
+                    block = block[:offset_to - start]
+                yield block[max(0, offset_from - start):]
+                if offset_to is not None and offset >= offset_to:
+                    return
+        finally:
+            blocks.close()
+
+
+def xfilter_window(log_lines, start, end):
+    """
+    (parsed, error) of lines with $time_local in datetimes [start, end)
+    (minute precision). Parse errors have no time: they are passed through
+    if the previous parsed line is in the window (lines go by time), so
+    errors of the rest of the range read don't count for the window
+    """
+    start = datetime_minute(start)
+    end = datetime_minute(end)
+    # $time_local up to minutes -> minute
+    minutes = {}
+    inside = False
+    for parsed, parse_error in log_lines:
+        if parsed is not None:
+            time_local = parsed.time_local or ''
+            minute = minutes.get(time_local[:17])
+            if minute is None:
+                try:
+                    minute = time_local_minute(time_local)
+                except (ValueError, KeyError):
+                    minute = 0
+                minutes[time_local[:17]] = minute
+            inside = start <= minute < end
+        if inside:
+            yield parsed, parse_error
+
+
+def quantile(sorted_lst, q):
+    """
+    q-quantile of sorted list with linear interpolation
+    (q=0.5 gives usual median)
+    """
+    n = len(sorted_lst)
+    if n < 1:
+        return None
+    rank = q * (n - 1)
+    lo = int(math.floor(rank))
+    hi = min(lo + 1, n - 1)
+    return sorted_lst[lo] + (sorted_lst[hi] - sorted_lst[lo]) * (rank - lo)
+
+
+def median(lst):
+    return quantile(sorted(lst), 0.5)
+
+
+def hist_log_gamma(rel_error):
+    """
+    Bucket width for histogram with relative error rel_error
+    """
+    return math.log((1.0 + rel_error) / (1.0 - rel_error))
+
+
+def hist_key(value, log_gamma):
+    if value < HIST_MIN_TIME:
+        return HIST_ZERO_KEY
+    return int(math.ceil(math.log(value) / log_gamma))
+
+
+def hist_collapse(hist, max_buckets):
+    """
+    Keep histogram size bounded: lowest buckets are merged together,
+    so only the smallest (least interesting) times lose precision
+    """
+    if len(hist) <= max_buckets:
+        return
+    keys = sorted(hist)
+    extra = len(hist) - max_buckets
+    target = keys[extra]
+    for key in keys[:extra]:
+        hist[target] += hist.pop(key)
+
+
+def hist_merge(hist, other, max_buckets):
+    for key, count in other.iteritems():
+        hist[key] = hist.get(key, 0) + count
+    hist_collapse(hist, max_buckets)
+    return hist
+
+
+def hist_add_times(hist, times, log_gamma, max_buckets=None):
+    """
+    Count response times into histogram one by one, as aggregate_loglines
+    does (not collapsed without max_buckets)
+    """
+    for value in times:
+        key = hist_key(value, log_gamma)
+        if key in hist:
+            hist[key] += 1
+        else:
+            hist[key] = 1
+            if max_buckets:
+                hist_collapse(hist, max_buckets)
+    return hist
+
+
+def hist_quantiles(hist, quantiles, log_gamma):
+    """
+    Estimate quantiles from histogram. Every estimate is within
+    rel_error of some value whose rank is close to the requested one
+    """
+    gamma = math.exp(log_gamma)
+    count = sum(hist.itervalues())
+    keys = sorted(hist)
+    result = []
+    idx = 0
+    seen = hist[keys[0]]
+    for q in quantiles:
+        rank = int(math.floor(q * (count - 1)))
+        while seen <= rank:
+            idx += 1
+            seen += hist[keys[idx]]
+        key = keys[idx]
+        if key == HIST_ZERO_KEY:
+            result.append(0.0)
+        else:
+            result.append(2.0 * gamma ** key / (gamma + 1.0))
+    return result
+
+
+def prune_stat(stat, max_urls, missing_bound):
+    """
+    Heavy hitters (space-saving with batch eviction): keep top max_urls
+    urls by count and top max_urls by time_sum, drop the rest.
+    Returns new missing_bound - max possible count/time_sum of a url
+    that is not in stat
+    """
+    if len(stat) <= max_urls:
+        return missing_bound
+
+    keep = set(heapq.nlargest(max_urls, stat,
+                              key=lambda url: stat[url].count))
+    keep.update(heapq.nlargest(max_urls, stat,
+                               key=lambda url: stat[url].time_sum))
+
+    count_bound, time_bound = missing_bound
+    for url in stat.keys():
+        if url not in keep:
+            data = stat.pop(url)
+            count_bound = max(count_bound, data.count + data.count_err)
+            time_bound = max(time_bound, data.time_sum + data.time_err)
+    return count_bound, time_bound
+
+
+def parse_group_by(group_by):
+    """
+    'url,status_class; url,hour; method' ->
+    (('url', 'status_class'), ('url', 'hour'), ('method',))
+    """
+    groups = []
+    for part in group_by.split(';'):
+        dims = tuple(dim.strip() for dim in part.split(',') if dim.strip())
+        for dim in dims:
+            if dim not in GROUP_DIMENSIONS:
+                raise ValueError('Unknown GROUP_BY dimension: %s' % dim)
+        if dims and dims not in groups:
+            groups.append(dims)
+    return tuple(groups)
+
+
+def rollup_groups(cube, group_by, stat):
+    """
+    Lines counted by raw (url record of stat, method, status, hour of
+    $time_local) -> groups of group_by. Derived values are cached, so
+    equal values of different keys are the same (interned) objects
+    """
+    groups = {}
+    group_keys = []
+    for dims in group_by:
+        key_of = operator.itemgetter(
+            *[GROUP_DIMENSIONS.index(dim) for dim in dims])
+        group_keys.append((key_of, groups.setdefault(dims, {})))
+
+    urls = {}
+    if any('url' in dims for dims in group_by):
+        urls = dict((data, url) for url, data in stat.iteritems())
+    statuses = {}
+    hours = {}
+    for (url_stat, method, status, hour_str), record in cube.iteritems():
+        url = urls.get(url_stat)
+        derived = statuses.get(status)
+        if derived is None:
+            derived = statuses[status] = (
+                (status, status[:1] + 'xx') if status else (None, None))
+        hour = hours.get(hour_str)
+        if hour is None and hour_str.isdigit():
+            hour = hours[hour_str] = int(hour_str)
+        dimensions = (url, method) + derived + (hour,)
+        for key_of, group in group_keys:
+            key = key_of(dimensions)
+            target = group.get(key)
+            if target is None:
+                group[key] = list(record)
+            else:
+                target[0] += record[0]
+                target[1] += record[1]
+                if record[2] > target[2]:
+                    target[2] = record[2]
+    return groups
+
+
+def prune_groups(groups, stat):
+    """
+    Drop url groups of urls evicted from stat (heavy hitters mode)
+    """
+    for dims, group in groups.iteritems():
+        if 'url' not in dims:
+            continue
+        if len(dims) == 1:
+            url_of = lambda key: key
+        else:
+            url_of = operator.itemgetter(dims.index('url'))
+        for key in group.keys():
+            if url_of(key) not in stat:
+                del group[key]
+
+
+def merge_groups(groups, other):
+    """
+    Add groups of other aggregate into groups (records are reused)
+    """
+    for dims, other_group in other.iteritems():
+        group = groups.setdefault(dims, {})
+        for key, record in other_group.iteritems():
+            target = group.get(key)
+            if target is None:
+                group[key] = record
+            else:
+                target[0] += record[0]
+                target[1] += record[1]
+                if record[2] > target[2]:
+                    target[2] = record[2]
+    return groups
+
+
+def aggregate_loglines(log_lines, exact_quantiles=False, quantile_error=0.01,
+                       quantile_max_buckets=2048, max_urls=0, url_rules='',
+                       url_cache_size=100000, engine='python', group_by='',
+                       memory_limit=0, spill=None):
+    """
+    Aggregate parsed lines by url into LogAggregate of UrlStat records.
+
+    Response time distribution of each url is kept in a log-bucket
+    histogram of bounded size (relative error quantile_error), so memory
+    doesn't grow with number of hits; urls with up to SMALL_TIMES_MAX hits
+    keep their times as is. exact_quantiles=True keeps every response time
+    instead.
+
+    max_urls > 0 turns on heavy hitters mode: at most 3 * max_urls urls
+    are kept, each with count_err/time_err - how much of its count and
+    time_sum could be missed while it was not tracked.
+
+    url_rules (see compile_url_rules) are applied to urls before
+    aggregation.
+
+    group_by (see parse_group_by) - in the same pass lines are counted
+    into aggregate.groups by each set of dimensions; key is a value for
+    single dimension, tuple of values otherwise. Lines must be parsed by
+    extended parser. Every line updates a single record keyed by raw
+    fields used in any group, groups are rolled up from these records
+    after the pass, so the number of groups doesn't cost per line
+
+    memory_limit > 0 (bytes) - when estimated size of stat gets over it,
+    stat is passed to spill(stat) and emptied (see
+    aggregate_loglines_external)
+
+    engine='numpy' - aggregate with aggregate_loglines_numpy
+    """
+    group_by = parse_group_by(group_by)
+    if engine == 'numpy':
+        if numpy is None:
+            logging.warning('numpy is not installed, using python engine')
+        elif max_urls:
+            logging.warning('numpy engine has no heavy hitters mode, '
+                            'using python engine')
+        elif group_by:
+            logging.warning('numpy engine has no GROUP_BY, '
+                            'using python engine')
+        elif memory_limit:
+            logging.warning('numpy engine has no MEMORY_LIMIT, '
+                            'using python engine')
+        else:
+            return aggregate_loglines_numpy(
+                log_lines, exact_quantiles, quantile_error,
+                quantile_max_buckets, url_rules, url_cache_size)
+
+    line_count = 0
+    parsed_count = 0
+    total_time = 0.0
+    missing_bound = EMPTY_BOUND
+    normalize = get_url_normalizer(url_rules, url_cache_size)
+    if normalize:
+        misses_before = normalize.stats['misses']
+    log_gamma = hist_log_gamma(quantile_error)
+
+    # response_time string -> (float value, histogram key)
+    time_cache = {}
+
+    # (url record, method, status, hour of $time_local) -> [count,
+    # time_sum, time_max], fields not used by group_by are None. The record
+    # stands for url - no extra copy of url string per key
+    cube = {}
+    used = set(itertools.chain.from_iterable(group_by))
+    cube_url = 'url' in used
+    cube_method = 'method' in used
+    cube_status = 'status' in used or 'status_class' in used
+    cube_hour = 'hour' in used
+
+    stat = {}
+    stat_size = 0
+    for line, parse_error in log_lines:
+        line_count += 1
+        if parse_error:
+            continue
+
+        cached = time_cache.get(line.response_time)
+        if cached is None:
+            value = float(line.response_time)
+            cached = time_cache[line.response_time] = (
+                value, hist_key(value, log_gamma))
+        response_time, bucket = cached
+
+        url = normalize(line.url) if normalize else line.url
+        current_stat = stat.get(url)
+        if current_stat is None:
+            current_stat = UrlStat(time_list=array('d'))
+            if max_urls:
+                if len(stat) >= 3 * max_urls:
+                    missing_bound = prune_stat(stat, max_urls, missing_bound)
+                    if cube_url:
+                        kept = set(stat.itervalues())
+                        for key in cube.keys():
+                            if key[0] not in kept:
+                                del cube[key]
+                current_stat.count_err, current_stat.time_err = missing_bound
+            if memory_limit:
+                stat_size += SPILL_URL_BYTES + len(url)
+            stat[url] = current_stat
+
+        current_stat.count += 1
+        current_stat.time_sum += response_time
+        if response_time > current_stat.time_max:
+            current_stat.time_max = response_time
+
+        times = current_stat.time_list
+        if times is None:
+            hist = current_stat.time_hist
+            if bucket in hist:
+                hist[bucket] += 1
+            else:
+                hist[bucket] = 1
+                hist_collapse(hist, quantile_max_buckets)
+        else:
+            times.append(response_time)
+            if not exact_quantiles and len(times) > SMALL_TIMES_MAX:
+                current_stat.time_hist = hist_add_times(
+                    {}, times, log_gamma, quantile_max_buckets)
+                current_stat.time_list = None
+
+        if group_by:
+            key = (current_stat if cube_url else None,
+                   line.method if cube_method else None,
+                   line.status if cube_status else None,
+                   # $time_local: 30/Jun/2017:03:28:23 +0300
+                   (line.time_local or '')[12:14] if cube_hour else '')
+            record = cube.get(key)
+            if record is None:
+                # strings of a new key are shared by all equal keys
+                key = key[:1] + tuple(intern(value) if value else value
+                                      for value in key[1:])
+                cube[key] = [1, response_time, response_time]
+            else:
+                record[0] += 1
+                record[1] += response_time
+                if response_time > record[2]:
+                    record[2] = response_time
+
+        parsed_count += 1
+        total_time += response_time
+
+        if memory_limit:
+            stat_size += 8
+            if stat_size > memory_limit:
+                spill(stat)
+                stat.clear()
+                stat_size = 0
+
+    if normalize:
+        count_url_cache(normalize, misses_before, parsed_count)
+
+    return LogAggregate(stat=stat, line_count=line_count,
+                        parsed_count=parsed_count, total_time=total_time,
+                        missing_bound=missing_bound,
+                        groups=rollup_groups(cube, group_by, stat))
+
+
+def aggregate_loglines_numpy(log_lines, exact_quantiles=False,
+                             quantile_error=0.01, quantile_max_buckets=2048,
+                             url_rules='', url_cache_size=100000,
+                             batch_size=100000):
+    """
+    Columnar version of aggregate_loglines, same result.
+
+    Lines are taken in batches, urls and response time strings are
+    interned into int ids. Per batch count comes from bincount,
+    time_sum/time_max from unbuffered add.at/maximum.at (element order is
+    kept, so sums are bit-for-bit equal to the sequential ones),
+    histograms from one unique() over (url id, bucket) codes; (url id,
+    time id) codes of urls with up to SMALL_TIMES_MAX hits so far are kept
+    for their time lists. In exact mode all times are sorted by (url,
+    time) with a single integer sort at the end.
+    """
+    line_count = 0
+    log_gamma = hist_log_gamma(quantile_error)
+    normalize = get_url_normalizer(url_rules, url_cache_size)
+    if normalize:
+        misses_before = normalize.stats['misses']
+
+    # unknown key gets next id
+    url_ids = defaultdict(itertools.count().next)
+    time_ids = defaultdict(itertools.count().next)
+    time_values = numpy.zeros(0)
+    time_keys = numpy.zeros(0, dtype=numpy.int64)
+
+    counts = numpy.zeros(0, dtype=numpy.int64)
+    time_sum = numpy.zeros(0)
+    time_max = numpy.zeros(0)
+    total_time = numpy.zeros(1)
+    hists = []
+    exact_codes = []
+    small_codes = numpy.zeros(0, dtype=numpy.int64)
+
+    first = operator.itemgetter(0)
+    second = operator.itemgetter(1)
+    log_lines = iter(log_lines)
+    while True:
+        batch = list(itertools.islice(log_lines, batch_size))
+        if not batch:
+            break
+        line_count += len(batch)
+
+        parsed = map(first, batch)
+        if map(second, batch).count(None) != len(batch):
+            parsed = [line for line, parse_error in batch if not parse_error]
+            if not parsed:
+                continue
+        urls = map(first, parsed)
+        response_times = map(second, parsed)
+        if normalize:
+            urls = map(normalize, urls)
+        ids = numpy.array(map(url_ids.__getitem__, urls), dtype=numpy.int64)
+        tids = numpy.array(map(time_ids.__getitem__, response_times),
+                           dtype=numpy.int64)
+
+        if len(time_ids) > len(time_values):
+            new_times = sorted((time_id, time_str)
+                               for time_str, time_id in time_ids.iteritems()
+                               if time_id >= len(time_values))
+            values = [float(time_str) for _, time_str in new_times]
+            time_values = numpy.concatenate((time_values, values))
+            time_keys = numpy.concatenate(
+                (time_keys, [hist_key(value, log_gamma) for value in values]))
+
+        size = len(url_ids)
+        if size > len(counts):
+            hists.extend({} for _ in xrange(size - len(counts)))
+            for column in (counts, time_sum, time_max):
+                column.resize(size, refcheck=False)
+
+        values = time_values[tids]
+        counts += numpy.bincount(ids, minlength=size)
+        numpy.add.at(time_sum, ids, values)
+        numpy.maximum.at(time_max, ids, values)
+        # cumsum adds one by one, as the python loop does
+        total_time[0] = numpy.cumsum(
+            numpy.concatenate((total_time, values)))[-1]
+
+        if exact_quantiles:
+            exact_codes.append((ids << 32) | tids)
+            continue
+
+        small_codes = numpy.concatenate((small_codes, (ids << 32) | tids))
+        small_codes = small_codes[
+            counts[small_codes >> 32] <= SMALL_TIMES_MAX]
+
+        codes = (ids << 32) | (time_keys[tids] - HIST_ZERO_KEY)
+        codes, code_counts = numpy.unique(codes, return_counts=True)
+        for code, code_count in zip(codes.tolist(), code_counts.tolist()):
+            hist = hists[code >> 32]
+            key = (code & 0xffffffff) + HIST_ZERO_KEY
+            hist[key] = hist.get(key, 0) + code_count
+            if len(hist) > quantile_max_buckets:
+                hist_collapse(hist, quantile_max_buckets)
+
+    time_lists = [None] * len(url_ids)
+    if len(small_codes):
+        # stable sort keeps order of lines
+        ids = small_codes >> 32
+        order = numpy.argsort(ids, kind='mergesort')
+        ids = ids[order]
+        values = time_values[small_codes[order] & 0xffffffff]
+        borders = numpy.flatnonzero(numpy.diff(ids)) + 1
+        for url_id, url_times in zip(ids[numpy.r_[0, borders]].tolist(),
+                                     numpy.split(values, borders)):
+            time_lists[url_id] = array('d', url_times.tostring())
+            hists[url_id] = None
+    if exact_codes:
+        # (url id, time rank) codes - one integer sort gives times of
+        # every url in order
+        time_order = numpy.argsort(time_values, kind='mergesort')
+        time_rank = numpy.empty_like(time_order)
+        time_rank[time_order] = numpy.arange(len(time_order))
+        codes = numpy.concatenate(exact_codes)
+        codes = (codes & ~0xffffffff) | time_rank[codes & 0xffffffff]
+        codes.sort()
+        ids = codes >> 32
+        values = time_values[time_order][codes & 0xffffffff]
+        borders = numpy.flatnonzero(numpy.diff(ids)) + 1
+        for url_id, url_times in zip(ids[numpy.r_[0, borders]].tolist(),
+                                     numpy.split(values, borders)):
+            time_lists[url_id] = array('d', url_times.tostring())
+            hists[url_id] = None
+
+    if normalize:
+        count_url_cache(normalize, misses_before, int(counts.sum()))
+
+    counts_list = counts.tolist()
+    time_sum_list = time_sum.tolist()
+    time_max_list = time_max.tolist()
+    stat = {}
+    for url, url_id in url_ids.iteritems():
+        stat[url] = UrlStat(counts_list[url_id], time_sum_list[url_id],
+                            time_max_list[url_id], time_lists[url_id],
+                            hists[url_id])
+
+    return LogAggregate(stat=stat, line_count=line_count,
+                        parsed_count=int(counts.sum()),
+                        total_time=float(total_time[0]),
+                        missing_bound=EMPTY_BOUND, groups={})
+
+
+def merge_url_stat(target, data, quantile_max_buckets=2048, log_gamma=None):
+    """
+    Add partial per-url stat data into target (both are modified/reused).
+    log_gamma - histogram mode: time lists grown over SMALL_TIMES_MAX, or
+    merged with a histogram, become histograms. Without it only time lists
+    can be merged (exact mode)
+    """
+    if target is None:
+        return data
+    if log_gamma is None and (target.time_hist is not None or
+                              data.time_hist is not None):
+        raise ValueError('log_gamma is required to merge time histograms')
+    target.count += data.count
+    target.time_sum += data.time_sum
+    if data.time_max > target.time_max:
+        target.time_max = data.time_max
+    if target.time_list is not None and data.time_list is not None:
+        target.time_list.extend(data.time_list)
+        if (log_gamma is not None and
+                len(target.time_list) > SMALL_TIMES_MAX):
+            target.time_hist = hist_add_times(
+                {}, target.time_list, log_gamma, quantile_max_buckets)
+            target.time_list = None
+    else:
+        if target.time_hist is None:
+            target.time_hist = hist_add_times({}, target.time_list, log_gamma)
+            target.time_list = None
+        if data.time_hist is None:
+            hist_add_times(target.time_hist, data.time_list, log_gamma,
+                           quantile_max_buckets)
+        else:
+            hist_merge(target.time_hist, data.time_hist, quantile_max_buckets)
+    if target.count_err is not None:
+        target.count_err += data.count_err or 0
+        target.time_err += data.time_err or 0.0
+    return target
+
+
+def add_missing_bound(stat, other_stat, bound):
+    """
+    urls of stat absent in other_stat could have up to bound there
+    """
+    if bound == EMPTY_BOUND:
+        return
+    for url, data in stat.iteritems():
+        if url not in other_stat:
+            data.count_err = (data.count_err or 0) + bound[0]
+            data.time_err = (data.time_err or 0.0) + bound[1]
+
+
+def merge_aggregates(aggregates, quantile_max_buckets=2048, max_urls=0,
+                     exact_quantiles=False, quantile_error=0.01):
+    """
+    Merge partial LogAggregate-s (from chunks of one file) into one.
+    Stat of the first aggregate is reused as result
+    """
+    log_gamma = None if exact_quantiles else hist_log_gamma(quantile_error)
+    stat = None
+    groups = {}
+    line_count = 0
+    parsed_count = 0
+    total_time = 0.0
+    missing_bound = EMPTY_BOUND
+    for aggregate in aggregates:
+        merge_groups(groups, aggregate.groups)
+        if stat is None:
+            stat = aggregate.stat
+            missing_bound = aggregate.missing_bound
+        else:
+            add_missing_bound(stat, aggregate.stat, aggregate.missing_bound)
+            add_missing_bound(aggregate.stat, stat, missing_bound)
+            for url, data in aggregate.stat.iteritems():
+                stat[url] = merge_url_stat(stat.get(url), data,
+                                           quantile_max_buckets, log_gamma)
+            missing_bound = (missing_bound[0] + aggregate.missing_bound[0],
+                             missing_bound[1] + aggregate.missing_bound[1])
+            if max_urls:
+                missing_bound = prune_stat(stat, max_urls, missing_bound)
+                prune_groups(groups, stat)
+        line_count += aggregate.line_count
+        parsed_count += aggregate.parsed_count
+        total_time += aggregate.total_time
+
+    return LogAggregate(stat=stat or {}, line_count=line_count,
+                        parsed_count=parsed_count, total_time=total_time,
+                        missing_bound=missing_bound, groups=groups)
+
+
+def replay_url_stat(target, data, log_gamma=None,
+                    quantile_max_buckets=2048):
+    """
+    Add spilled record of url (with time list) into target as if its
+    lines came right after target's: time_sum is continued value by
+    value, so it's bit-for-bit the sum of a single pass.
+    log_gamma - histogram mode: target turns into histogram record once
+    it has more than SMALL_TIMES_MAX times, as in aggregate_loglines
+    """
+    if target is None:
+        target = data
+    else:
+        target.count += data.count
+        time_sum = target.time_sum
+        for value in data.time_list:
+            time_sum += value
+        target.time_sum = time_sum
+        if data.time_max > target.time_max:
+            target.time_max = data.time_max
+        if target.time_hist is not None:
+            hist_add_times(target.time_hist, data.time_list, log_gamma,
+                           quantile_max_buckets)
+        else:
+            target.time_list.extend(data.time_list)
+    if log_gamma is not None and target.time_list is not None:
+        hist_url_stat(target, log_gamma, quantile_max_buckets)
+    return target
+
+
+def hist_url_stat(data, log_gamma, quantile_max_buckets=2048):
+    """
+    Record with all its times -> record of histogram mode, the same
+    aggregate_loglines would make
+    """
+    if len(data.time_list) > SMALL_TIMES_MAX:
+        data.time_hist = hist_add_times({}, data.time_list, log_gamma,
+                                        quantile_max_buckets)
+        data.time_list = None
+    return data
+
+
+def aggregate_loglines_external(log_lines, memory_limit, report_size=1000,
+                                spill_dir=None, partitions=SPILL_PARTITIONS,
+                                **options):
+    """
+    Exact aggregation of a log whose stat doesn't fit in memory_limit bytes.
+
+    Lines are aggregated keeping time lists; when estimated size of stat
+    gets over memory_limit, its records are split by hash of url into
+    partitions and appended to partition files in a scratch dir inside
+    spill_dir. Then every partition is reduced on its own - records of a
+    url are replayed in order of spills, so they are identical to the ones
+    of aggregate_loglines - and top report_size urls in build_stat_list
+    order are selected with a heap. Memory is bounded by memory_limit in
+    the pass and by the urls of the largest partition in the reduce: with
+    histograms in histogram mode, with all times (8 bytes per hit) in
+    exact quantiles mode.
+
+    Without spills stat has every url, otherwise top urls only.
+    Heavy hitters mode is bounded anyway and GROUP_BY sets with url need
+    all urls in memory - these are aggregated in memory as usual.
+    options - aggregate_loglines kwargs
+    """
+    exact_quantiles = options.pop('exact_quantiles', False)
+    if options.get('max_urls'):
+        logging.info('Heavy hitters mode is bounded, MEMORY_LIMIT is not used')
+        memory_limit = 0
+    elif any('url' in dims
+             for dims in parse_group_by(options.get('group_by', ''))):
+        logging.warning('MEMORY_LIMIT does not work with GROUP_BY sets '
+                        'by url, aggregating in memory')
+        memory_limit = 0
+    if not memory_limit:
+        aggregate = aggregate_loglines(
+            log_lines, exact_quantiles=exact_quantiles, **options)
+        count_metric('distinct_urls', len(aggregate.stat))
+        return aggregate
+
+    log_gamma = hist_log_gamma(options.get('quantile_error', 0.01))
+    quantile_max_buckets = options.get('quantile_max_buckets', 2048)
+    spill_files = []
+    scratch_dir = tempfile.mkdtemp(prefix='log_analyzer_spill_',
+                                   dir=spill_dir)
+
+    def spill(stat):
+        if not spill_files:
+            spill_files.extend(
+                open(os.path.join(scratch_dir, '%03d.spill' % i), 'w+b')
+                for i in xrange(partitions))
+        parts = [{} for _ in xrange(partitions)]
+        for url, data in stat.iteritems():
+            parts[hash(url) % partitions][url] = data
+        for part, spill_file in zip(parts, spill_files):
+            cPickle.dump(part, spill_file, cPickle.HIGHEST_PROTOCOL)
+
+    try:
+        aggregate = aggregate_loglines(
+            log_lines, exact_quantiles=True, memory_limit=memory_limit,
+            spill=spill, **options)
+        if not spill_files:
+            if not exact_quantiles:
+                for data in aggregate.stat.itervalues():
+                    hist_url_stat(data, log_gamma, quantile_max_buckets)
+            count_metric('distinct_urls', len(aggregate.stat))
+            return aggregate
+
+        spill(aggregate.stat)
+        aggregate = aggregate._replace(stat={})
+        spill_bytes = sum(spill_file.tell() for spill_file in spill_files)
+        logging.info('Stat is over MEMORY_LIMIT, spilled %d bytes to %s',
+                     spill_bytes, scratch_dir)
+        count_metric('spill_bytes', spill_bytes)
+
+        order = lambda item: (-item[1].time_sum / item[1].count, item[0])
+        top = []
+        for spill_file in spill_files:
+            spill_file.seek(0)
+            stat = {}
+            while True:
+                try:
+                    part = cPickle.load(spill_file)
+                except EOFError:
+                    break
+                for url, data in part.iteritems():
+                    stat[url] = replay_url_stat(
+                        stat.get(url), data,
+                        None if exact_quantiles else log_gamma,
+                        quantile_max_buckets)
+            count_metric('distinct_urls', len(stat))
+            top = heapq.nsmallest(report_size,
+                                  itertools.chain(top, stat.iteritems()),
+                                  key=order)
+            del stat
+    finally:
+        for spill_file in spill_files:
+            spill_file.close()
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+
+    return aggregate._replace(stat=dict(top))
+
+
+def add_sample_estimates(row, data, rate, log_gamma):
+    """
+    Scale report row of sampled lines up to the whole log and add 95%
+    confidence intervals of count, time_avg and time_med
+    """
+    count = data.count
+    row['count'] = int(round(count / rate))
+    count_dev = Z95 * math.sqrt(count * (1.0 - rate)) / rate
+    row['count_ci_low'] = max(count, int(math.floor(count / rate - count_dev)))
+    row['count_ci_high'] = int(math.ceil(count / rate + count_dev))
+    row['time_sum'] = data.time_sum / rate
+    if 'count_err' in row:
+        row['count_err'] = int(round(row['count_err'] / rate))
+        row['time_sum_err'] /= rate
+
+    if data.time_list is not None:
+        times = sorted(data.time_list)
+        sq_sum = sum(value * value for value in times)
+    else:
+        gamma = math.exp(log_gamma)
+        sq_sum = sum(bucket_count * (2.0 * gamma ** key / (gamma + 1.0)) ** 2
+                     for key, bucket_count in data.time_hist.iteritems()
+                     if key != HIST_ZERO_KEY)
+    # time_avg of sample is an estimate of time_avg itself
+    avg = row['time_avg']
+    if count > 1:
+        variance = max(0.0, sq_sum / count - avg * avg) * count / (count - 1)
+        avg_dev = Z95 * math.sqrt(variance / count)
+    else:
+        avg_dev = avg
+    row['time_avg_ci_low'] = max(0.0, avg - avg_dev)
+    row['time_avg_ci_high'] = avg + avg_dev
+
+    # median: ranks n/2 +- z * sqrt(n) / 2
+    rank_dev = Z95 * 0.5 / math.sqrt(count)
+    bounds = [max(0.0, 0.5 - rank_dev), min(1.0, 0.5 + rank_dev)]
+    if data.time_list is not None:
+        bounds = [quantile(times, q) for q in bounds]
+    else:
+        bounds = hist_quantiles(data.time_hist, bounds, log_gamma)
+    row['time_med_ci_low'], row['time_med_ci_high'] = bounds
+
+
+def sparkline(values):
+    """
+    [value or None, ...] -> unicode sparkline scaled to the max value
+    """
+    top = max(values) or 1.0
+    levels = len(SPARKLINE_CHARS)
+    return u''.join(
+        u' ' if value is None else
+        SPARKLINE_CHARS[min(levels - 1, int(value / top * levels))]
+        for value in values)
+
+
+def url_groups(groups):
+    """
+    Groups by url and one more dimension:
+    [(dimension, {url: {value: record}}), ...]
+    """
+    result = []
+    for dims, group in sorted(groups.iteritems()):
+        if len(dims) != 2 or 'url' not in dims:
+            continue
+        url_idx = dims.index('url')
+        by_url = defaultdict(dict)
+        for key, record in group.iteritems():
+            by_url[key[url_idx]][key[1 - url_idx]] = record
+        result.append((dims[1 - url_idx], by_url))
+    return result
+
+
+def add_group_columns(stat_list, groups, sample_rate=None):
+    """
+    url x hour group -> time_avg_hourly: sparkline of average response time
+    by hour; url x other dimension -> count_<dimension>_<value> columns
+    (0 if url has no such lines, lines without the value aren't counted).
+    Other groups are only in build_group_lists
+    """
+    scale = 1.0 / sample_rate if sample_rate else 1.0
+    for dim, by_url in url_groups(groups):
+        if dim == 'hour':
+            for row in stat_list:
+                hourly = [None] * 24
+                for hour, record in by_url.get(row['url'], {}).iteritems():
+                    if hour is not None:
+                        hourly[hour] = record[1] / record[0]
+                row['time_avg_hourly'] = sparkline(hourly)
+            continue
+
+        values = set()
+        for row in stat_list:
+            values.update(by_url.get(row['url'], ()))
+        # variable absent in LOG_FORMAT
+        values.discard(None)
+        for row in stat_list:
+            url_records = by_url.get(row['url'], {})
+            for value in values:
+                record = url_records.get(value)
+                row['count_%s_%s' % (dim, value)] = (
+                    int(round(record[0] * scale)) if record else 0)
+
+
+def build_group_lists(aggregate, urls, sample_rate=None):
+    """
+    aggregate.groups -> {'dim1,dim2': [row, ...]} sorted by time_sum,
+    groups with url dimension are limited to given urls (report rows)
+    """
+    scale = 1.0 / sample_rate if sample_rate else 1.0
+    urls = set(urls)
+    group_lists = {}
+    for dims, group in aggregate.groups.iteritems():
+        rows = []
+        for key, (count, time_sum, time_max) in group.iteritems():
+            if len(dims) == 1:
+                key = (key,)
+            row = dict(zip(dims, key))
+            if 'url' in row and row['url'] not in urls:
+                continue
+            row.update({
+                'count': int(round(count * scale)),
+                'time_sum': time_sum * scale,
+                'time_avg': time_sum / count,
+                'time_max': time_max,
+            })
+            rows.append(row)
+        rows.sort(key=lambda row: (-row['time_sum'], sorted(row.items())))
+        group_lists[','.join(dims)] = rows
+    return group_lists
+
+
+def build_stat_list(aggregate, report_size=1000, parse_error_perc_max=0.0,
+                    quantile_error=0.01, sample_rate=None):
+    """
+    LogAggregate -> list of report rows sorted by time_avg
+
+    sample_rate - aggregate is made of this share of log lines: counts and
+    sums are scaled up, confidence intervals are added.
+    Quantiles are exact for urls with time_list, estimated from time_hist
+    otherwise: records of either mode tell it themselves
+    """
+    stat, line_count, parsed_count, total_time = aggregate[:4]
+    if not line_count:
+        logging.info('No lines to aggregate')
+        return []
+
+    # проверяем чтобы процент ощибочных строк был не больше максимума
+    #
+    if float(parsed_count) / line_count < (1.0 - parse_error_perc_max):
+        logging.error('Wrong format. %d of %d lines parsed. '
+                      'More than %d%% of errors - failed parsing',
+                      parsed_count, line_count,
+                      int(parse_error_perc_max * 100))
+        raise Exception('Wrong format')
+
+    # pass 2 - calculate aggregates & convert
+    logging.info("Calculating aggregates on total %d lines", parsed_count)
+
+    log_gamma = hist_log_gamma(quantile_error)
+    quantile_values = [q for _, q in QUANTILES]
+    stat_list = []
+    for url, data in stat.iteritems():
+        if data.time_list is not None:
+            times = sorted(data.time_list)
+            url_quantiles = [quantile(times, q) for q in quantile_values]
+        else:
+            url_quantiles = hist_quantiles(
+                data.time_hist, quantile_values, log_gamma)
+
+        row = {
+            'url': url,
+            'count': data.count,
+            'time_max': data.time_max,
+            'time_sum': data.time_sum,
+            'time_avg': data.time_sum / data.count,
+            'time_perc': data.time_sum / total_time,
+            'count_perc': float(data.count) / parsed_count,
+        }
+        for (name, _), value in zip(QUANTILES, url_quantiles):
+            row[name] = value
+        if data.count_err is not None:
+            # heavy hitters mode: real values are in
+            # [count, count + count_err], [time_sum, time_sum + time_sum_err]
+            row['count_err'] = data.count_err
+            row['time_sum_err'] = data.time_err
+        stat_list.append(row)
+
+    # sort it (by url on equal time_avg - result doesn't depend on dict order)
+    stat_list.sort(key=lambda row: (-row['time_avg'], row['url']))
+    stat_list = stat_list[:report_size]
+
+    if sample_rate is not None:
+        for row in stat_list:
+            add_sample_estimates(row, stat[row['url']], sample_rate,
+                                 log_gamma)
+    add_group_columns(stat_list, aggregate.groups, sample_rate)
+
+    return stat_list
+
+
+def process_logfile(log_lines, report_size=1000, parse_error_perc_max=0.0,
+                    sample_rate=None, **options):
+    """
+    Aggregate lines and build report rows.
+    options - aggregate_loglines kwargs
+    sample_rate - log_lines are a sample of this share of the log
+    """
+    aggregate = aggregate_loglines(log_lines, **options)
+    return build_stat_list(aggregate, report_size, parse_error_perc_max,
+                           options.get('quantile_error', 0.01),
+                           sample_rate)
+
+
+def split_logfile(filename, parts):
+    """
+    Split plain logfile into byte ranges [(start, end), ...]
+    with borders aligned to line starts
+    """
+    size = os.path.getsize(filename)
+    borders = [0]
+    with open(filename, 'rb') as logfile:
+        for i in range(1, parts):
+            offset = max(size * i // parts, borders[-1])
+            if offset >= size:
+                break
+            if not offset:
+                # файл меньше числа частей
+                continue
+            # дочитываем до конца строки, на которую попали
+            logfile.seek(offset - 1)
+            logfile.readline()
+            borders.append(min(logfile.tell(), size))
+    borders.append(size)
+    return [(start, end) for start, end in zip(borders, borders[1:])
+            if end > start]
+
+
+def xread_chunk(filename, start, end):
+    """
+    raw lines of plain logfile in byte range [start, end)
+    """
+    with open(filename, 'rb') as logfile:
+        logfile.seek(start)
+        remaining = end - start
+        for line in logfile:
+            if remaining <= 0:
+                break
+            remaining -= len(line)
+            yield line
+
+
+def aggregate_chunk(args):
+    """
+    Worker: aggregate byte range of plain logfile
+    """
+    filename, start, end, log_format, options = args
+    reset_metrics()
+    log_lines = xparse_loglines(
+        xread_chunk(filename, start, end),
+        get_log_parser(log_format, bool(options.get('group_by'))))
+    return aggregate_loglines(log_lines, **options), dict(_metrics['counters'])
+
+
+def aggregate_batch(args):
+    """
+    Worker: aggregate batch of raw lines
+    """
+    raw_lines, log_format, options = args
+    reset_metrics()
+    log_lines = xparse_loglines(
+        raw_lines, get_log_parser(log_format, bool(options.get('group_by'))))
+    return aggregate_loglines(log_lines, **options), dict(_metrics['counters'])
+
+
+def aggregate_host_log(host, log_path, log_format, options, host_column=False):
+    """
+    Aggregate logfile of one host (multi-host mode). host_column - add
+    'url,host' and 'host' groups, so report gets count_host_<host> columns
+    """
+    aggregate = aggregate_loglines(
+        xread_loglines(log_path, get_log_parser(
+            log_format, bool(options.get('group_by')))),
+        **options)
+    if host_column:
+        aggregate.groups[('url', 'host')] = dict(
+            ((url, host), [data.count, data.time_sum, data.time_max])
+            for url, data in aggregate.stat.iteritems())
+        aggregate.groups[('host',)] = {host: [
+            aggregate.parsed_count, aggregate.total_time,
+            max(itertools.chain((0.0,), (
+                data.time_max for data in aggregate.stat.itervalues())))]}
+    return aggregate
+
+
+def aggregate_host_logfile(args):
+    """
+    Worker: aggregate_host_log
+    """
+    reset_metrics()
+    return aggregate_host_log(*args), dict(_metrics['counters'])
+
+
+def collect_counters(result):
+    """
+    Worker result (aggregate, counters) -> aggregate, counters are added
+    to run metrics
+    """
+    aggregate, counters = result
+    add_counters(counters)
+    return aggregate
+
+
+def xread_batches(filename, batch_size):
+    """
+    Lines of logfile in batches of at least batch_size lines
+    (the last one may be shorter)
+    """
+    batch = []
+    for lines, _ in xread_line_batches(filename):
+        batch.extend(lines)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def get_merge_options(options):
+    """
+    aggregate_loglines kwargs -> merge_aggregates kwargs
+    """
+    return {
+        'quantile_max_buckets': options.get('quantile_max_buckets', 2048),
+        'max_urls': options.get('max_urls', 0),
+        'exact_quantiles': options.get('exact_quantiles', False),
+        'quantile_error': options.get('quantile_error', 0.01),
+    }
+
+
+def aggregate_logfile_parallel(filename, workers, log_format=DEFAULT_LOG_FORMAT,
+                               batch_size=20000, **options):
+    """
+    Aggregate single logfile on several processes.
+
+    Plain file is split into line-aligned byte ranges, each range is read
+    and aggregated by its own worker. Gzip file is inflated once here,
+    lines are sent to workers in batches; at most 2 * workers batches are
+    in flight so memory stays bounded.
+    """
+    merge_options = get_merge_options(options)
+    pool = multiprocessing.Pool(workers)
+    try:
+        if not filename.endswith('.gz'):
+            tasks = [(filename, start, end, log_format, options)
+                     for start, end in split_logfile(filename, workers)]
+            # imap keeps order of chunks - float sums and heavy hitters
+            # pruning don't depend on which worker is done first
+            return merge_aggregates(
+                itertools.imap(collect_counters,
+                               pool.imap(aggregate_chunk, tasks)),
+                **merge_options)
+
+        aggregate = LogAggregate({}, 0, 0, 0.0, EMPTY_BOUND, {})
+        in_flight = deque()
+        batches = xmetered(xread_batches(filename, batch_size),
+                           'decompression', 1)
+        for batch in batches:
+            in_flight.append(pool.apply_async(
+                aggregate_batch, ((batch, log_format, options),)))
+            if len(in_flight) >= 2 * workers:
+                aggregate = merge_aggregates(
+                    [aggregate, collect_counters(in_flight.popleft().get())],
+                    **merge_options)
+
+        while in_flight:
+            aggregate = merge_aggregates(
+                [aggregate, collect_counters(in_flight.popleft().get())],
+                **merge_options)
+        return aggregate
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def format_report_row(data):
+    row = {}
+    for key, value in data.iteritems():
+        if isinstance(value, float):
+            value = '{0:.10f}'.format(value)
+        row[key] = value
+    return row
+
+
+def read_report_template(template_filename, placeholder='$table_json'):
+    """
+    template -> (prefix, suffix) around placeholder
+    """
+    try:
+        with open(template_filename, "r") as ftemp:
+            template = ftemp.read()
+    except Exception as e:
+        logging.error('Failed to read report template file "%s": %s',
+                      template_filename, e)
+        return None
+    prefix, _, suffix = template.partition(placeholder)
+    return prefix, suffix
+
+
+def render_report(stat_list, template_filename, banner=''):
+    """
+    Render stat into html file.
+    Uses REPORT_TEMPLATE from config as page-template
+    banner - text for $report_banner in template
+
+    :param stat - stat dict, where keys - uri`s
+    :param processed_date - inital date - used in resulting filename
+
+    result row: {"count": 2767,
+                 "time_avg": 62.994999999999997,
+                 "time_max": 9843.5689999999995,
+                 "time_sum": 174306.35200000001,
+                 "url": "/api/v2/internal/html5/phantomjs/queue/?wait=1m",
+                 "time_med": 60.073,
+                 "time_perc": 9.0429999999999993,
+                 "count_perc": 0.106}
+    """
+    template = read_report_template(template_filename)
+    if template is None:
+        return None
+
+    stat_json = json.dumps([format_report_row(data) for data in stat_list])
+    prefix = template[0].replace('$report_banner', cgi.escape(banner))
+    return prefix + stat_json + template[1]
+
+
+def open_tmp_file(target_filename):
+    """
+    tmp-file in the same dir as target_filename (for atomic rename)
+    """
+    target_dir = os.path.dirname(target_filename) or '.'
+    if not os.path.isdir(target_dir):
+        os.makedirs(target_dir)
+    fd, tmp_filename = tempfile.mkstemp(
+        dir=target_dir,
+        prefix='.%s.' % os.path.basename(target_filename), suffix='.tmp')
+    return os.fdopen(fd, 'wb'), tmp_filename
+
+
+def commit_tmp_files(tmp_files):
+    """
+    fsync + rename [(tmp-file, tmp_filename, target_filename), ...]
+    in given order, then fsync their dirs
+    """
+    for tmp_file, tmp_filename, _ in tmp_files:
+        tmp_file.flush()
+        os.fsync(tmp_file.fileno())
+        tmp_file.close()
+        os.chmod(tmp_filename, 0644)
+
+    for _, tmp_filename, target_filename in tmp_files:
+        os.rename(tmp_filename, target_filename)
+
+    target_dirs = set(os.path.dirname(target_filename) or '.'
+                      for _, _, target_filename in tmp_files)
+    for target_dir in target_dirs:
+        dir_fd = os.open(target_dir, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+
+def discard_tmp_files(tmp_files):
+    """
+    Close and remove [(tmp-file, tmp_filename, target_filename), ...]
+    of a failed write, targets are left as they are
+    """
+    for tmp_file, tmp_filename, _ in tmp_files:
+        tmp_file.close()
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+
+
+def write_report(stat_list, template_filename, report_filename,
+                 gzip_copy=False, banner=''):
+    """
+    Stream report straight into tmp-file next to report_filename:
+    template prefix, rows one by one, suffix - then fsync and rename.
+    Memory used doesn't depend on report size.
+    gzip_copy - also write report_filename.gz (for nginx gzip_static)
+    banner - text for $report_banner in template
+    """
+    template = read_report_template(template_filename)
+    if template is None:
+        return None
+    prefix, suffix = template
+    prefix = prefix.replace('$report_banner', cgi.escape(banner))
+
+    tmp_files = []
+    try:
+        freport, tmp_filename = open_tmp_file(report_filename)
+        tmp_files.append((freport, tmp_filename, report_filename))
+        outputs = [freport]
+        if gzip_copy:
+            fgz, gz_tmp_filename = open_tmp_file(report_filename + '.gz')
+            # .gz is renamed first: report presence means both are ready
+            tmp_files.insert(0, (fgz, gz_tmp_filename,
+                                 report_filename + '.gz'))
+            gz = gzip.GzipFile(filename=os.path.basename(report_filename),
+                               mode='wb', fileobj=fgz)
+            outputs.append(gz)
+
+        def write(chunk):
+            with metrics_stage('writing'):
+                for output in outputs:
+                    output.write(chunk)
+
+        write(prefix)
+        write('[')
+        for i, data in enumerate(stat_list):
+            if i:
+                write(', ')
+            write(json.dumps(format_report_row(data)))
+        write(']')
+        write(suffix)
+
+        with metrics_stage('writing'):
+            if gzip_copy:
+                gz.close()
+            commit_tmp_files(tmp_files)
+    except Exception as e:
+        logging.error('Failed to write report "%s": %s', report_filename, e)
+        discard_tmp_files(tmp_files)
+        return None
+
+    return True
+
+
+def get_report_data_dirname(report_filename):
+    """
+    report_2017.06.30.html -> report_2017.06.30.data (shards of sharded report)
+    """
+    return os.path.splitext(report_filename)[0] + '.data'
+
+
+def report_sort_orders(stat_list):
+    """
+    column -> 'asc' for text columns (url), 'desc' for numbers
+    """
+    orders = {}
+    for data in stat_list[:1]:
+        for key, value in data.iteritems():
+            orders[key] = 'asc' if isinstance(value, basestring) else 'desc'
+    return orders
+
+
+def write_report_shards(shard_dir, rows, page_size):
+    """
+    rows (json strings) -> shard_dir/00000.json.gz, ... page_size rows each
+    """
+    os.mkdir(shard_dir)
+    for page, start in enumerate(xrange(0, len(rows), page_size)):
+        shard_filename = os.path.join(shard_dir, '%05d.json.gz' % page)
+        with open(shard_filename, 'wb') as fshard:
+            # level 9 is 4x slower than 6 for 2% smaller shards
+            gz = gzip.GzipFile(filename='', mode='wb', compresslevel=6,
+                               fileobj=fshard, mtime=0)
+            gz.write('[' + ', '.join(rows[start:start + page_size]) + ']')
+            gz.close()
+            fshard.flush()
+            os.fsync(fshard.fileno())
+    dir_fd = os.open(shard_dir, os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+
+def replace_dir(src_dir, target_dir):
+    """
+    rename src_dir to target_dir, previous target_dir is removed
+    """
+    old_dir = None
+    if os.path.isdir(target_dir):
+        old_dir = tempfile.mkdtemp(dir=os.path.dirname(target_dir) or '.',
+                                   prefix='.%s.' % os.path.basename(target_dir),
+                                   suffix='.old')
+        os.rename(target_dir, os.path.join(old_dir, 'data'))
+    os.rename(src_dir, target_dir)
+    if old_dir:
+        shutil.rmtree(old_dir, ignore_errors=True)
+
+
+def write_sharded_report(stat_list, template_filename, report_filename,
+                         page_size=500, banner=''):
+    """
+    Report layout for big REPORT_SIZE: rows are stored next to the report
+    in <report>.data/<column>/NNNNN.json.gz - gzip JSON pages of page_size
+    rows, presorted by every column (<report>.data/_default - in stat_list
+    order). Page has only meta ($report_meta in template) and fetches
+    the visible page, so its initial load doesn't depend on report size.
+    Shards dir is renamed into place before the html.
+    """
+    template = read_report_template(template_filename, '$report_meta')
+    if template is None:
+        return None
+    prefix, suffix = template
+    prefix = prefix.replace('$report_banner', cgi.escape(banner))
+
+    data_dir = get_report_data_dirname(report_filename)
+    report_dir = os.path.dirname(report_filename) or '.'
+    rows = [json.dumps(format_report_row(data)) for data in stat_list]
+    orders = report_sort_orders(stat_list)
+    meta = {'rows': len(rows), 'page_size': page_size,
+            'data': os.path.basename(data_dir),
+            'columns': sorted(orders), 'orders': orders}
+
+    tmp_dir = None
+    tmp_files = []
+    try:
+        with metrics_stage('writing'):
+            if not os.path.isdir(report_dir):
+                os.makedirs(report_dir)
+            tmp_dir = tempfile.mkdtemp(
+                dir=report_dir, prefix='.%s.' % os.path.basename(data_dir),
+                suffix='.tmp')
+            os.chmod(tmp_dir, 0755)
+            write_report_shards(os.path.join(tmp_dir, '_default'), rows,
+                                page_size)
+        for column, order in sorted(orders.iteritems()):
+            indexes = sorted(xrange(len(rows)),
+                             key=lambda i: stat_list[i].get(column),
+                             reverse=order == 'desc')
+            with metrics_stage('writing'):
+                write_report_shards(os.path.join(tmp_dir, column),
+                                    [rows[i] for i in indexes], page_size)
+
+        with metrics_stage('writing'):
+            freport, tmp_filename = open_tmp_file(report_filename)
+            tmp_files.append((freport, tmp_filename, report_filename))
+            freport.write(prefix)
+            freport.write(json.dumps(meta, sort_keys=True))
+            freport.write(suffix)
+            replace_dir(tmp_dir, data_dir)
+            commit_tmp_files(tmp_files)
+    except Exception as e:
+        logging.error('Failed to write report "%s": %s', report_filename, e)
+        if tmp_dir and os.path.isdir(tmp_dir):
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        discard_tmp_files(tmp_files)
+        return None
+
+    return True
+
+
+def write_config_report(config, stat_list, report_filename, banner=''):
+    """
+    Write report in REPORT_LAYOUT: inline (single html, REPORT_TEMPLATE)
+    or sharded (see write_sharded_report, REPORT_SHARDED_TEMPLATE)
+    """
+    layout = config.get('REPORT_LAYOUT', 'inline')
+    if layout == 'sharded':
+        return write_sharded_report(
+            stat_list,
+            config.get('REPORT_SHARDED_TEMPLATE', './report_sharded.html'),
+            report_filename, int(config.get('REPORT_PAGE_SIZE', 500)),
+            banner)
+    if layout != 'inline':
+        logging.error('Unknown REPORT_LAYOUT: %s', layout)
+        return None
+    return write_report(stat_list, config['REPORT_TEMPLATE'],
+                        report_filename,
+                        config_bool(config.get('REPORT_GZIP', False)),
+                        banner)
+
+
+def get_groups_filename(report_filename):
+    """
+    report_2017.06.30.html -> report_2017.06.30.groups.json
+    """
+    return os.path.splitext(report_filename)[0] + '.groups.json'
+
+
+def write_group_lists(group_lists, groups_filename):
+    """
+    GROUP_BY tables (see build_group_lists) into json file next to report
+    """
+    tmp_files = []
+    try:
+        fgroups, tmp_filename = open_tmp_file(groups_filename)
+        tmp_files.append((fgroups, tmp_filename, groups_filename))
+        with metrics_stage('writing'):
+            json.dump(group_lists, fgroups, sort_keys=True)
+            commit_tmp_files(tmp_files)
+    except Exception as e:
+        logging.error('Failed to write groups "%s": %s', groups_filename, e)
+        discard_tmp_files(tmp_files)
+        return None
+    return True
+
+
+def get_report_filename(report_dir, report_datetime, prefix='report'):
+    return os.path.join(report_dir, "%s_%s.html" % (
+        prefix, datetime.strftime(report_datetime, "%Y.%m.%d")))
+
+
+def get_window_report_filename(report_dir, start, end, prefix='report'):
+    return os.path.join(report_dir, "%s_%s-%s.html" % (
+        prefix, datetime.strftime(start, "%Y.%m.%d_%H%M"),
+        datetime.strftime(end, "%H%M")))
+
+
+def get_period_report_filename(report_dir, date_from, date_to,
+                               prefix='report'):
+    return os.path.join(report_dir, "%s_%s-%s.html" % (
+        prefix, datetime.strftime(date_from, "%Y.%m.%d"),
+        datetime.strftime(date_to, "%Y.%m.%d")))
+
+
+def save_report(report_str, report_filename):
+    """
+    Write report to tmp-file in the report dir, fsync and rename it,
+    so concurrent runs never see (or clobber) half-written reports
+    """
+    try:
+        freport, report_tmp_filename = open_tmp_file(report_filename)
+    except Exception as e:
+        logging.error('Failed to create tmp-file: %s', e)
+        return None
+
+    try:
+        freport.write(report_str)
+        commit_tmp_files([(freport, report_tmp_filename, report_filename)])
+    except Exception as e:
+        logging.error('Failed to write report to destination: %s', e)
+        discard_tmp_files([(freport, report_tmp_filename, report_filename)])
+        return None
+
+    return True
+
+
+def hist_to_blob(hist):
+    """
+    histogram -> packed (key, count) pairs
+    """
+    packed = array('i')
+    for key, count in hist.iteritems():
+        packed.append(key)
+        packed.append(count)
+    return buffer(packed.tostring())
+
+
+def hist_from_blob(blob):
+    packed = array('i')
+    packed.fromstring(str(blob))
+    return dict(zip(packed[0::2], packed[1::2]))
+
+
+def open_aggregate_db(db_filename):
+    db = sqlite3.connect(db_filename, timeout=60)
+    db.executescript("""
+        CREATE TABLE IF NOT EXISTS days (
+            date TEXT PRIMARY KEY,
+            line_count INTEGER,
+            parsed_count INTEGER,
+            total_time REAL,
+            quantile_error REAL
+        );
+        CREATE TABLE IF NOT EXISTS url_stat (
+            date TEXT,
+            url TEXT,
+            count INTEGER,
+            time_sum REAL,
+            time_max REAL,
+            time_hist BLOB,
+            PRIMARY KEY (date, url)
+        );
+    """)
+    return db
+
+
+def store_aggregate(db_filename, date, aggregate, quantile_error=0.01):
+    """
+    Save full per-url aggregate of one day (replaces stored one)
+    """
+    day = date.strftime('%Y-%m-%d')
+    log_gamma = hist_log_gamma(quantile_error)
+
+    def rows():
+        for url, data in aggregate.stat.iteritems():
+            hist = data.time_hist
+            if data.time_list is not None:
+                # time list - store histogram anyway
+                hist = hist_add_times({}, data.time_list, log_gamma)
+            yield (day, url, data.count, data.time_sum, data.time_max,
+                   hist_to_blob(hist))
+
+    db = open_aggregate_db(db_filename)
+    try:
+        with db:
+            db.execute('DELETE FROM url_stat WHERE date = ?', (day,))
+            db.execute('INSERT OR REPLACE INTO days VALUES (?, ?, ?, ?, ?)',
+                       (day, aggregate.line_count, aggregate.parsed_count,
+                        aggregate.total_time, quantile_error))
+            db.executemany('INSERT INTO url_stat VALUES (?, ?, ?, ?, ?, ?)',
+                           rows())
+    finally:
+        db.close()
+
+
+def load_aggregate(db_filename, date_from, date_to, quantile_error=0.01,
+                   quantile_max_buckets=2048):
+    """
+    Merge stored per-day aggregates for dates in [date_from, date_to]
+    into one LogAggregate. Histograms stored with another
+    quantile_error are re-bucketed. None if no days are stored
+    """
+    log_gamma = hist_log_gamma(quantile_error)
+    period = (date_from.strftime('%Y-%m-%d'), date_to.strftime('%Y-%m-%d'))
+
+    db = open_aggregate_db(db_filename)
+    try:
+        days = dict(
+            (row[0], row[1:]) for row in db.execute(
+                'SELECT * FROM days WHERE date BETWEEN ? AND ?', period))
+        if not days:
+            return None
+        logging.info('Loading stored aggregates for %s', ', '.join(sorted(days)))
+
+        stat = {}
+        for day, url, count, time_sum, time_max, blob in db.execute(
+                'SELECT * FROM url_stat WHERE date BETWEEN ? AND ?', period):
+            hist = hist_from_blob(blob)
+            day_error = days[day][3]
+            if day_error != quantile_error:
+                day_gamma = math.exp(hist_log_gamma(day_error))
+                rebucketed = {}
+                for key, key_count in hist.iteritems():
+                    value = (0.0 if key == HIST_ZERO_KEY else
+                             2.0 * day_gamma ** key / (day_gamma + 1.0))
+                    key = hist_key(value, log_gamma)
+                    rebucketed[key] = rebucketed.get(key, 0) + key_count
+                hist = rebucketed
+            data = UrlStat(count, time_sum, time_max, time_hist=hist)
+            stat[url] = merge_url_stat(stat.get(url), data,
+                                       quantile_max_buckets, log_gamma)
+    finally:
+        db.close()
+
+    return LogAggregate(
+        stat=stat,
+        line_count=sum(day[0] for day in days.itervalues()),
+        parsed_count=sum(day[1] for day in days.itervalues()),
+        total_time=sum(day[2] for day in days.itervalues()),
+        missing_bound=EMPTY_BOUND, groups={})
+
+
+def build_diff_list(stat_before, stat_after, report_size=1000):
+    """
+    Rows for urls present in both reports, ranked by growth of time_avg
+    """
+    before = dict((row['url'], row) for row in stat_before)
+    diff_list = []
+    for row in stat_after:
+        old_row = before.get(row['url'])
+        if old_row is None:
+            continue
+        diff_row = {'url': row['url'], 'count': row['count'],
+                    'count_before': old_row['count']}
+        for name in ('time_avg', 'time_med', 'time_p99'):
+            diff_row[name] = row[name]
+            diff_row[name + '_before'] = old_row[name]
+            diff_row[name + '_delta'] = row[name] - old_row[name]
+        diff_list.append(diff_row)
+
+    diff_list.sort(key=operator.itemgetter('time_avg_delta'), reverse=True)
+    return diff_list[:report_size]
+
+
+def aggregate_options(config):
+    """
+    Aggregation options (aggregate_loglines kwargs) from config
+    """
+    return {
+        'exact_quantiles': config_bool(config.get('EXACT_QUANTILES', False)),
+        'quantile_error': float(config.get('QUANTILE_ERROR', 0.01)),
+        'quantile_max_buckets': int(config.get('QUANTILE_MAX_BUCKETS', 2048)),
+        'max_urls': (int(config.get('REPORT_SIZE', 1000)) *
+                     int(config.get('HEAVY_HITTERS_FACTOR', 10))
+                     if config_bool(config.get('HEAVY_HITTERS', False))
+                     else 0),
+        'url_rules': config.get('URL_RULES', ''),
+        'url_cache_size': int(config.get('URL_CACHE_SIZE', 100000)),
+        'engine': config.get('ENGINE', 'python'),
+        'group_by': config.get('GROUP_BY', ''),
+    }
+
+
+def update_ts_file(ts_filename):
+    timestamp = int(time.mktime(datetime.now().timetuple()))
+
+    try:
+        with open(ts_filename, 'w') as ts_file:
+            ts_file.write(str(timestamp))
+    except Exception as e:
+        logging.error('Unable to update ts file "%s": %s',
+                      ts_filename, e.message)
+        return False
+
+    return True
+
+
+def get_metrics_filename(config):
+    """
+    METRICS_FILE or log_analyzer.prom next to TS_FILE
+    """
+    if config.get('METRICS_FILE'):
+        return config['METRICS_FILE']
+    return os.path.join(os.path.dirname(config['TS_FILE']),
+                        'log_analyzer.prom')
+
+
+def peak_rss_bytes():
+    # ru_maxrss is in KB on linux; pool workers count as children
+    return 1024 * max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+
+def collect_metrics(success, run_seconds):
+    """
+    Run metrics as dict (metrics file JSON)
+    """
+    counters = _metrics['counters']
+    lines_read = counters.get('lines_read', 0)
+    return {
+        'success': bool(success),
+        'timestamp': int(time.time()),
+        'run_seconds': run_seconds,
+        'stages': dict((stage, {'wall_seconds': wall, 'cpu_seconds': cpu})
+                       for stage, (wall, cpu) in _metrics['stages'].iteritems()),
+        'lines_read': lines_read,
+        'parse_errors': {
+            'decode': counters.get('parse_errors_decode', 0),
+            'format': counters.get('parse_errors_format', 0),
+        },
+        'distinct_urls': counters.get('distinct_urls', 0),
+        'spill_bytes': counters.get('spill_bytes', 0),
+        'url_cache': {
+            'lookups': counters.get('url_cache_lookups', 0),
+            'misses': counters.get('url_cache_misses', 0),
+        },
+        'lines_per_second': lines_read / run_seconds if run_seconds else 0.0,
+        'peak_rss_bytes': peak_rss_bytes(),
+    }
+
+
+def format_prometheus_metrics(metrics):
+    """
+    Metrics dict -> prometheus text exposition format
+    (for node_exporter textfile collector)
+    """
+    lines = []
+
+    def add(name, help_text, samples):
+        lines.append('# HELP log_analyzer_%s %s' % (name, help_text))
+        lines.append('# TYPE log_analyzer_%s gauge' % name)
+        for labels, value in samples:
+            labels = ','.join('%s="%s"' % label for label in labels)
+            lines.append('log_analyzer_%s%s %s' % (
+                name, '{%s}' % labels if labels else '', repr(value)))
+
+    add('last_run_success', 'Whether the last run succeeded',
+        [((), int(metrics['success']))])
+    add('last_run_timestamp_seconds', 'Time the last run finished',
+        [((), metrics['timestamp'])])
+    add('run_seconds', 'Wall time of the last run',
+        [((), metrics['run_seconds'])])
+    add('stage_seconds', 'Time spent in processing stage',
+        [((('stage', stage), ('clock', clock)), spent[clock + '_seconds'])
+         for stage, spent in sorted(metrics['stages'].iteritems())
+         for clock in ('wall', 'cpu')])
+    add('lines_read', 'Log lines read', [((), metrics['lines_read'])])
+    add('parse_errors', 'Log lines failed to parse',
+        [((('kind', kind),), value)
+         for kind, value in sorted(metrics['parse_errors'].iteritems())])
+    add('distinct_urls', 'Distinct urls aggregated',
+        [((), metrics['distinct_urls'])])
+    add('spill_bytes', 'Bytes of stat spilled to disk (MEMORY_LIMIT)',
+        [((), metrics['spill_bytes'])])
+    add('url_cache_lookups', 'Urls looked up in URL_RULES cache',
+        [((), metrics['url_cache']['lookups'])])
+    add('url_cache_misses', 'Urls normalized by URL_RULES (cache misses)',
+        [((), metrics['url_cache']['misses'])])
+    add('lines_per_second', 'Lines read per second of run',
+        [((), metrics['lines_per_second'])])
+    add('peak_rss_bytes', 'Peak resident set size',
+        [((), metrics['peak_rss_bytes'])])
+    return '\n'.join(lines) + '\n'
+
+
+def write_metrics(config, success, run_seconds):
+    """
+    Save run metrics as prometheus textfile METRICS_FILE and JSON next to
+    it (same name, .json)
+    """
+    metrics = collect_metrics(success, run_seconds)
+    metrics_filename = get_metrics_filename(config)
+    json_filename = os.path.splitext(metrics_filename)[0] + '.json'
+    try:
+        tmp_files = []
+        for filename, content in (
+                (metrics_filename, format_prometheus_metrics(metrics)),
+                (json_filename, json.dumps(metrics, indent=2,
+                                           sort_keys=True))):
+            tmp_file, tmp_filename = open_tmp_file(filename)
+            tmp_files.append((tmp_file, tmp_filename, filename))
+            tmp_file.write(content)
+        commit_tmp_files(tmp_files)
+    except Exception as e:
+        logging.error('Unable to write metrics file "%s": %s',
+                      metrics_filename, e)
+        return False
+    return True
+
+
+def list_log_dir(config):
+    try:
+        return os.listdir(config['LOG_DIR'])
+    except Exception as e:
+        logging.error('Could not open log-dir %s. message: %s',
+                      config['LOG_DIR'], e.message)
+        return None
+
+
+def get_log_sources(config):
+    """
+    [(host, log_dir), ...]: LOG_DIRS (comma or line separated, host is
+    named by the dir) or LOG_DIR
+    """
+    log_dirs = [log_dir.strip()
+                for log_dir in re.split('[,\n]', config.get('LOG_DIRS', ''))
+                if log_dir.strip()]
+    if not log_dirs:
+        return [(None, config['LOG_DIR'])]
+    return [(os.path.basename(os.path.normpath(log_dir)), log_dir)
+            for log_dir in log_dirs]
+
+
+def list_host_logs(config, since=None):
+    """
+    Multi-host mode: logfiles of all sources by date (see
+    get_host_log_files), None if some log dir can't be read
+    """
+    sources = []
+    for host, log_dir in get_log_sources(config):
+        try:
+            sources.append((host, log_dir, os.listdir(log_dir)))
+        except Exception as e:
+            logging.error('Could not open log-dir %s. message: %s',
+                          log_dir, e)
+            return None
+    return get_host_log_files(sources, config['LOG_FILE_PATTERN'], since)
+
+
+def make_report(config, logfile_data, sample=None):
+    """
+    Process single logfile and save its report.
+    sample - build approximate report sample_YYYY.MM.DD.html from a sample
+    of lines (see xsample_line_batches)
+    """
+    report_filename = get_report_filename(
+        config['REPORT_DIR'], logfile_data.date,
+        prefix='sample' if sample else 'report')
+
+    log_format = config.get('LOG_FORMAT', DEFAULT_LOG_FORMAT)
+    options = aggregate_options(config)
+    try:
+        log_parser = get_log_parser(log_format, bool(options['group_by']))
+    except ValueError as e:
+        logging.error('Wrong LOG_FORMAT: %s', e)
+        return False
+
+    workers = int(config.get('WORKERS', 1))
+    # MB
+    memory_limit = int(config.get('MEMORY_LIMIT', 0)) << 20
+    # on a single cpu the thread can't overlap anything
+    read_thread = (config_bool(config.get('READ_THREAD', True)) and
+                   multiprocessing.cpu_count() > 1)
+
+    logging.info("Processing logfile: %s" % logfile_data.filename)
+    log_path = os.path.join(config['LOG_DIR'], logfile_data.filename)
+    # sidecar index for --window by single process full pass (with zlib of
+    # ctypes for .gz), otherwise by the first --window pass
+    time_index = None
+    if (config_bool(config.get('TIME_INDEX', False)) and not sample and
+            (memory_limit or workers <= 1)):
+        time_index = new_time_index(log_format)
+    try:
+        with metrics_stage('aggregation'):
+            if sample:
+                sample = dict(sample)
+                log_lines = xcheck_parse_errors(
+                    xread_loglines(log_path, log_parser,
+                                   read_thread=read_thread, sample=sample),
+                    float(config.get('PARSE_ERROR_PERC_MAX', 0.2)))
+                aggregate = aggregate_loglines(log_lines, **options)
+            elif memory_limit:
+                if workers > 1:
+                    logging.info('MEMORY_LIMIT: aggregating in one process')
+                aggregate = aggregate_loglines_external(
+                    xread_loglines(log_path, log_parser,
+                                   read_thread=read_thread,
+                                   time_index=time_index),
+                    memory_limit, int(config['REPORT_SIZE']),
+                    config.get('SPILL_DIR') or None,
+                    int(config.get('SPILL_PARTITIONS', SPILL_PARTITIONS)),
+                    **options)
+            elif workers > 1:
+                aggregate = aggregate_logfile_parallel(log_path, workers,
+                                                       log_format, **options)
+            else:
+                aggregate = aggregate_loglines(
+                    xread_loglines(log_path, log_parser,
+                                   read_thread=read_thread,
+                                   time_index=time_index),
+                    **options)
+    except Exception as e:
+        logging.error('Processing failed: %s', e.message)
+        return False
+    if time_index is not None:
+        save_time_index(get_time_index_filename(config, log_path),
+                        time_index, log_path)
+    count_metric('lines_read', aggregate.line_count)
+    if not memory_limit or sample:
+        count_metric('distinct_urls', len(aggregate.stat))
+
+    if sample:
+        logging.info('Sampled %.2f%% of %s', 100 * sample['rate'],
+                     logfile_data.filename)
+        return save_aggregate_report(config, aggregate, report_filename,
+                                     sample['rate'])
+    if memory_limit and config.get('AGGREGATE_DB'):
+        logging.warning('AGGREGATE_DB is not updated with MEMORY_LIMIT: '
+                        'full aggregate of the day is not kept in memory')
+    else:
+        save_day_aggregate(config, logfile_data.date, aggregate)
+    return save_aggregate_report(config, aggregate, report_filename)
+
+
+def make_window_report(config, logfile_data, start, end):
+    """
+    Report report_YYYY.MM.DD_HHMM-HHMM.html of logfile lines with
+    $time_local in [start, end). Only the byte range of the window is read
+    if logfile has the sidecar index, otherwise the index is built by this
+    (full) pass
+    """
+    report_filename = get_window_report_filename(config['REPORT_DIR'],
+                                                 start, end)
+    log_format = config.get('LOG_FORMAT', DEFAULT_LOG_FORMAT)
+    options = aggregate_options(config)
+    try:
+        log_parser = get_log_parser(log_format, extended=True)
+    except ValueError as e:
+        logging.error('Wrong LOG_FORMAT: %s', e)
+        return False
+    build_index = new_time_index(log_format)
+    if build_index is None:
+        logging.error('LOG_FORMAT has no $time_local')
+        return False
+
+    log_path = os.path.join(config['LOG_DIR'], logfile_data.filename)
+    index_filename = get_time_index_filename(config, log_path)
+    time_index = load_time_index(index_filename, log_path)
+    if time_index is None:
+        logging.info('No time index of %s, reading whole logfile',
+                     logfile_data.filename)
+        batches = xread_line_batches(log_path, time_index=build_index)
+    else:
+        offset_from, offset_to = time_index_range(time_index, start, end)
+        logging.info('Reading %s from offset %d to %s',
+                     logfile_data.filename, offset_from,
+                     'the end' if offset_to is None else offset_to)
+        batches = xline_batches(xread_range_blocks(
+            log_path, time_index, offset_from, offset_to))
+    try:
+        with metrics_stage('aggregation'):
+            aggregate = aggregate_loglines(
+                xfilter_window(xparse_line_batches(batches, log_parser),
+                               start, end),
+                **options)
+    except Exception as e:
+        logging.error('Processing failed: %s', e.message)
+        return False
+    if time_index is None:
+        save_time_index(index_filename, build_index, log_path)
+    count_metric('lines_read', aggregate.line_count)
+    count_metric('distinct_urls', len(aggregate.stat))
+    return save_aggregate_report(config, aggregate, report_filename)
+
+
+def process_window(config, start, end):
+    """
+    Report of the time window [start, end) of logfile: of the START date
+    or of the latest logfile if START is a time only (see
+    make_window_report)
+    """
+    if single_host_only(config, '--window'):
+        return False
+    with metrics_stage('listing'):
+        log_files_list = list_log_dir(config)
+        if log_files_list is None:
+            return False
+        log_files = get_log_files(log_files_list, config['LOG_FILE_PATTERN'])
+    if isinstance(start, datetime):
+        log_files = [logfile_data for logfile_data in log_files
+                     if logfile_data.date.date() == start.date()]
+    if not log_files:
+        logging.info('No logfile found. Exiting')
+        return True
+    logfile_data = log_files[-1]
+    if not isinstance(start, datetime):
+        start = datetime.combine(logfile_data.date.date(), start)
+    if not isinstance(end, datetime):
+        end = datetime.combine(start.date(), end)
+    if end <= start:
+        logging.error('Empty time window %s - %s', start, end)
+        return False
+    return make_window_report(config, logfile_data, start, end)
+
+
+def parse_window_time(value):
+    """
+    --window bound: HH:MM -> time, YYYYMMDDHHMM -> datetime
+    """
+    if ':' in value:
+        return datetime.strptime(value, '%H:%M').time()
+    return datetime.strptime(value, '%Y%m%d%H%M')
+
+
+def save_day_aggregate(config, date, aggregate):
+    """
+    Keep full aggregate in AGGREGATE_DB (if configured) for rollups
+    """
+    db_filename = config.get('AGGREGATE_DB')
+    if not db_filename:
+        return True
+    try:
+        store_aggregate(db_filename, date, aggregate,
+                        aggregate_options(config)['quantile_error'])
+    except Exception as e:
+        logging.error('Unable to store aggregate to "%s": %s',
+                      db_filename, e)
+        return False
+    return True
+
+
+def save_aggregate_report(config, aggregate, report_filename,
+                          sample_rate=None):
+    options = aggregate_options(config)
+    try:
+        with metrics_stage('rendering'):
+            stat = build_stat_list(
+                aggregate,
+                report_size=int(config['REPORT_SIZE']),
+                parse_error_perc_max=float(
+                    config.get('PARSE_ERROR_PERC_MAX', 0.2)),
+                quantile_error=options['quantile_error'],
+                sample_rate=sample_rate)
+    except Exception as e:
+        logging.error('Processing failed: %s', e.message)
+        return False
+
+    banner = ''
+    if sample_rate is not None:
+        banner = ('Approximate report: built from %.2f%% sample of log '
+                  'lines (%d lines). Counts and sums are scaled up, '
+                  '*_ci_low/*_ci_high - 95%% confidence intervals' %
+                  (100 * sample_rate, aggregate.line_count))
+    with metrics_stage('rendering'):
+        # groups go first: report presence means both are ready
+        if aggregate.groups and not write_group_lists(
+                build_group_lists(aggregate, [row['url'] for row in stat],
+                                  sample_rate),
+                get_groups_filename(report_filename)):
+            return False
+        written = write_config_report(config, stat, report_filename, banner)
+    if not written:
+        return False
+    logging.info("Report generated: %s", report_filename)
+
+    return True
+
+
+def process(config, sample=None):
+    """
+    Build report for the latest logfile (approximate one if sample is
+    given, see make_report)
+    """
+    if is_multi_host(config):
+        if sample:
+            logging.warning('Sampling is not supported for several hosts, '
+                            'building full report')
+        return process_hosts(config)
+
+    # get last logfile
+    with metrics_stage('listing'):
+        log_files_list = list_log_dir(config)
+        if log_files_list is None:
+            update_ts_file(config['TS_FILE'])
+            return False
+
+        target_logfile_data = get_last_log(
+            log_files_list, config['LOG_FILE_PATTERN'])
+
+    if not target_logfile_data:
+        logging.info('No logfile found. Exiting')
+        return True
+
+    # check if report exists (sampled report is always rebuilt)
+    report_filename = get_report_filename(config['REPORT_DIR'],
+                                          target_logfile_data.date)
+    if not sample and os.path.isfile(report_filename):
+        logging.info("Report for %s already exists. Exiting",
+                     target_logfile_data.date.isoformat())
+        return True
+
+    return make_report(config, target_logfile_data, sample)
+
+
+def make_hosts_report(config, date, host_logs):
+    """
+    Merge logfiles of several hosts for one date into one report.
+    Every host's file is aggregated by its own process (at most
+    HOST_WORKERS, 0 - one per host), per-url partials are merged in order
+    of hosts. HOST_COLUMN adds count_host_<host> columns to the report
+    """
+    report_filename = get_report_filename(config['REPORT_DIR'], date)
+    log_format = config.get('LOG_FORMAT', DEFAULT_LOG_FORMAT)
+    options = aggregate_options(config)
+    try:
+        get_log_parser(log_format, bool(options['group_by']))
+    except ValueError as e:
+        logging.error('Wrong LOG_FORMAT: %s', e)
+        return False
+
+    if int(config.get('MEMORY_LIMIT', 0)):
+        logging.warning('MEMORY_LIMIT is not used for several hosts, '
+                        'aggregating in memory')
+    host_column = config_bool(config.get('HOST_COLUMN', False))
+    workers = min(int(config.get('HOST_WORKERS', 0)) or len(host_logs),
+                  len(host_logs))
+    tasks = [(host_log.host, host_log.path, log_format, options, host_column)
+             for host_log in host_logs]
+    logging.info('Processing %d logfiles for %s: %s', len(host_logs),
+                 date.strftime('%Y-%m-%d'),
+                 ', '.join(host_log.path for host_log in host_logs))
+    try:
+        with metrics_stage('aggregation'):
+            if workers > 1:
+                pool = multiprocessing.Pool(workers)
+                try:
+                    # imap keeps order of hosts - merge doesn't depend on
+                    # which host is done first
+                    aggregate = merge_aggregates(
+                        itertools.imap(collect_counters, pool.imap(
+                            aggregate_host_logfile, tasks)),
+                        **get_merge_options(options))
+                finally:
+                    pool.terminate()
+                    pool.join()
+            else:
+                aggregate = merge_aggregates(
+                    (aggregate_host_log(*task) for task in tasks),
+                    **get_merge_options(options))
+    except Exception as e:
+        logging.error('Processing failed: %s', e)
+        return False
+    count_metric('lines_read', aggregate.line_count)
+    count_metric('distinct_urls', len(aggregate.stat))
+
+    save_day_aggregate(config, date, aggregate)
+    return save_aggregate_report(config, aggregate, report_filename)
+
+
+def get_missing_hosts(config, host_logs):
+    """
+    Hosts without logfile for the latest date of host_logs (see
+    list_host_logs): LOG_DIRS sources and hosts of the previous date
+    """
+    date_hosts = set(host_log.host for host_log in host_logs[-1][1])
+    expected = set(host for host, _ in get_log_sources(config)
+                   if host is not None)
+    if len(host_logs) > 1:
+        expected.update(host_log.host for host_log in host_logs[-2][1])
+    return sorted(host for host in expected
+                  if not any(date_host == host or
+                             date_host.startswith(host + '/')
+                             for date_host in date_hosts))
+
+
+def process_hosts(config):
+    """
+    Multi-host mode of process: one report for the latest date from
+    logfiles of all hosts. It's not built until every host has the
+    logfile for the date (see get_missing_hosts)
+    """
+    with metrics_stage('listing'):
+        host_logs = list_host_logs(config)
+        if host_logs is None:
+            update_ts_file(config['TS_FILE'])
+            return False
+
+    if not host_logs:
+        logging.info('No logfile found. Exiting')
+        return True
+
+    date, logs = host_logs[-1]
+    report_filename = get_report_filename(config['REPORT_DIR'], date)
+    if os.path.isfile(report_filename):
+        logging.info("Report for %s already exists. Exiting",
+                     date.isoformat())
+        return True
+
+    missing_hosts = get_missing_hosts(config, host_logs)
+    if missing_hosts:
+        logging.warning('No logfiles for %s of hosts: %s. Report is built '
+                        'when all hosts have them', date.strftime('%Y-%m-%d'),
+                        ', '.join(missing_hosts))
+        return True
+
+    return make_hosts_report(config, date, logs)
+
+
+def load_state(state_filename):
+    """
+    Incremental state: {'filename', 'inode', 'offset', 'options',
+    'aggregate'} or None if there is no (readable) state
+    """
+    if not os.path.isfile(state_filename):
+        return None
+    try:
+        with open(state_filename, 'rb') as state_file:
+            state = cPickle.load(state_file)
+        state['aggregate'] = LogAggregate(*state['aggregate'])
+        for data in state['aggregate'].stat.itervalues():
+            if not isinstance(data, UrlStat):
+                raise ValueError('stat of an older version')
+            break
+    except Exception as e:
+        logging.error('Unable to read state file "%s": %s. '
+                      'Starting from scratch', state_filename, e)
+        return None
+    return state
+
+
+def save_state(state_filename, state):
+    """
+    Write state to tmp-file, fsync and rename it: after a crash the
+    state file is the previous or the new one, never a truncated one
+    """
+    state = dict(state, aggregate=tuple(state['aggregate']))
+    try:
+        state_file, state_tmp_filename = open_tmp_file(state_filename)
+    except Exception as e:
+        logging.error('Unable to save state file "%s": %s',
+                      state_filename, e)
+        return False
+
+    try:
+        cPickle.dump(state, state_file, cPickle.HIGHEST_PROTOCOL)
+        commit_tmp_files([(state_file, state_tmp_filename, state_filename)])
+    except Exception as e:
+        logging.error('Unable to save state file "%s": %s',
+                      state_filename, e)
+        discard_tmp_files([(state_file, state_tmp_filename, state_filename)])
+        return False
+    return True
+
+
+def xread_appended(filename, state):
+    """
+    Complete lines of plain logfile after state['offset'].
+    state['offset'] is moved along; unfinished last line is left
+    for the next run
+    """
+    with open(filename, 'rb') as logfile:
+        logfile.seek(state['offset'])
+        for line in logfile:
+            if not line.endswith('\n'):
+                break
+            state['offset'] += len(line)
+            yield line
+
+
+def update_state(state, log_path, log_parser, options):
+    """
+    Aggregate lines appended to log_path since state was saved.
+    Rotated (other inode), truncated or gzipped files, and changed
+    options lead to a full rescan
+    """
+    filename = os.path.basename(log_path)
+    log_stat = os.stat(log_path)
+    if (state is None or
+            state['filename'] != filename or
+            state['inode'] != log_stat.st_ino or
+            state['offset'] > log_stat.st_size or
+            state['options'] != options):
+        if state is not None:
+            logging.info('Log %s was rotated, truncated or options changed. '
+                         'Full rescan', filename)
+        state = {'filename': filename, 'inode': log_stat.st_ino,
+                 'offset': 0, 'options': options,
+                 'aggregate': LogAggregate({}, 0, 0, 0.0, EMPTY_BOUND, {})}
+
+    start_offset = state['offset']
+    if filename.endswith('.gz'):
+        # gzip can't be read from the middle
+        if state['offset'] == log_stat.st_size:
+            return state
+        start_offset = 0
+        new_lines = xread_loglines(log_path, log_parser)
+        state['aggregate'] = LogAggregate({}, 0, 0, 0.0, EMPTY_BOUND, {})
+        state['offset'] = log_stat.st_size
+    else:
+        new_lines = xparse_loglines(xread_appended(log_path, state),
+                                    log_parser)
+
+    with metrics_stage('aggregation'):
+        new_aggregate = aggregate_loglines(new_lines, **options)
+    count_metric('lines_read', new_aggregate.line_count)
+    logging.info('Aggregated %d new lines (%d bytes) of %s',
+                 new_aggregate.line_count, state['offset'] - start_offset,
+                 filename)
+    state['aggregate'] = merge_aggregates(
+        [state['aggregate'], new_aggregate],
+        options['quantile_max_buckets'], options['max_urls'],
+        options['exact_quantiles'], options['quantile_error'])
+    return state
+
+
+def process_incremental(config):
+    """
+    Refresh report of the latest (still growing) logfile, parsing only
+    lines appended since the previous run. Offset, inode and partial
+    aggregates are kept in STATE_FILE
+    """
+    if single_host_only(config, '--incremental'):
+        return False
+    log_files_list = list_log_dir(config)
+    if log_files_list is None:
+        return False
+
+    logfiles = get_log_files(log_files_list, config['LOG_FILE_PATTERN'])
+    if not logfiles:
+        logging.info('No logfile found. Exiting')
+        return True
+
+    options = aggregate_options(config)
+    try:
+        log_parser = get_log_parser(
+            config.get('LOG_FORMAT', DEFAULT_LOG_FORMAT),
+            bool(options['group_by']))
+    except ValueError as e:
+        logging.error('Wrong LOG_FORMAT: %s', e)
+        return False
+    if int(config.get('MEMORY_LIMIT', 0)):
+        logging.warning('MEMORY_LIMIT is not used with --incremental: '
+                        'aggregate is kept in memory and in STATE_FILE')
+
+    state_filename = config.get('STATE_FILE', './log_analyzer.state')
+    state = load_state(state_filename)
+
+    # previous day: pick up its last lines before switching to the new log
+    dates = dict((logfile_data.filename, logfile_data.date)
+                 for logfile_data in logfiles)
+    targets = [logfiles[-1]]
+    if (state is not None and state['filename'] != logfiles[-1].filename and
+            state['filename'] in dates):
+        targets.insert(0, LogfileData(filename=state['filename'],
+                                      date=dates[state['filename']]))
+
+    for logfile_data in targets:
+        log_path = os.path.join(config['LOG_DIR'], logfile_data.filename)
+        try:
+            state = update_state(state, log_path, log_parser, options)
+        except Exception as e:
+            logging.error('Processing failed: %s', e)
+            return False
+
+        report_filename = get_report_filename(config['REPORT_DIR'],
+                                              logfile_data.date)
+        save_day_aggregate(config, logfile_data.date, state['aggregate'])
+        if not save_aggregate_report(config, state['aggregate'],
+                                     report_filename):
+            return False
+
+    return save_state(state_filename, state)
+
+
+def load_stored_period(config, date_from, date_to):
+    db_filename = config.get('AGGREGATE_DB')
+    if not db_filename:
+        logging.error('AGGREGATE_DB is not configured')
+        return None
+    options = aggregate_options(config)
+    try:
+        aggregate = load_aggregate(db_filename, date_from, date_to,
+                                   options['quantile_error'],
+                                   options['quantile_max_buckets'])
+    except Exception as e:
+        logging.error('Unable to load aggregates from "%s": %s',
+                      db_filename, e)
+        return None
+    if aggregate is None:
+        logging.error('No stored aggregates for %s - %s',
+                      date_from.date().isoformat(),
+                      date_to.date().isoformat())
+    return aggregate
+
+
+def process_rollup(config, date_from, date_to):
+    """
+    Report for period [date_from, date_to] from stored day aggregates
+    """
+    aggregate = load_stored_period(config, date_from, date_to)
+    if aggregate is None:
+        return False
+
+    report_filename = get_period_report_filename(config['REPORT_DIR'],
+                                                 date_from, date_to)
+    return save_aggregate_report(dict(config, EXACT_QUANTILES=False),
+                                 aggregate, report_filename)
+
+
+def process_diff(config, date_before, date_after):
+    """
+    Report of biggest latency regressions between two stored days
+    """
+    stat_lists = []
+    for date in (date_before, date_after):
+        aggregate = load_stored_period(config, date, date)
+        if aggregate is None:
+            return False
+        options = aggregate_options(config)
+        try:
+            stat_lists.append(build_stat_list(
+                aggregate, report_size=len(aggregate.stat),
+                parse_error_perc_max=1.0,
+                quantile_error=options['quantile_error']))
+        except Exception as e:
+            logging.error('Processing failed: %s', e.message)
+            return False
+
+    diff_list = build_diff_list(stat_lists[0], stat_lists[1],
+                                int(config['REPORT_SIZE']))
+    report_filename = get_period_report_filename(
+        config['REPORT_DIR'], date_before, date_after, prefix='diff')
+    if not write_config_report(config, diff_list, report_filename):
+        return False
+    logging.info("Report generated: %s", report_filename)
+    return True
+
+
+def _backfill_worker(args):
+    config, logfile_data = args
+    try:
+        return make_report(config, logfile_data)
+    except Exception:
+        logging.exception('Processing %s failed', logfile_data.filename)
+        return False
+
+
+def process_hosts_backfill(config, since=None):
+    """
+    Multi-host mode of process_backfill: reports for every date (newer
+    than since) without one, from logfiles of all hosts. Dates are built
+    one by one, hosts of a date in parallel (see make_hosts_report);
+    dates with missing hosts are skipped (see get_missing_hosts)
+    """
+    host_logs = list_host_logs(config, since)
+    if host_logs is None:
+        return False
+
+    dates = [i for i, (date, _) in enumerate(host_logs)
+             if not os.path.isfile(get_report_filename(config['REPORT_DIR'],
+                                                       date))]
+    if not dates:
+        logging.info('No unreported logfiles found')
+        return True
+    logging.info('Backfill: %d dates of several hosts', len(dates))
+
+    failed = []
+    for i in dates:
+        date, logs = host_logs[i]
+        missing_hosts = get_missing_hosts(config, host_logs[:i + 1])
+        if missing_hosts:
+            logging.warning('No logfiles for %s of hosts: %s. Skipping',
+                            date.strftime('%Y-%m-%d'),
+                            ', '.join(missing_hosts))
+            continue
+        if not make_hosts_report(config, date, logs):
+            failed.append(date.strftime('%Y-%m-%d'))
+    if failed:
+        logging.error('Backfill failed for: %s', ', '.join(failed))
+    return not failed
+
+
+def process_backfill(config, since=None):
+    """
+    Build reports for every logfile in LOG_DIR (newer than since)
+    that has no report yet. Files are processed on a pool of
+    BACKFILL_WORKERS processes (by default - number of CPUs)
+    """
+    if is_multi_host(config):
+        return process_hosts_backfill(config, since)
+
+    log_files_list = list_log_dir(config)
+    if log_files_list is None:
+        return False
+
+    logfiles = [
+        logfile_data for logfile_data in get_log_files(
+            log_files_list, config['LOG_FILE_PATTERN'], since)
+        if not os.path.isfile(get_report_filename(config['REPORT_DIR'],
+                                                  logfile_data.date))]
+    if not logfiles:
+        logging.info('No unreported logfiles found')
+        return True
+
+    workers = (int(config.get('BACKFILL_WORKERS', 0)) or
+               multiprocessing.cpu_count())
+    workers = min(workers, len(logfiles))
+    logging.info('Backfill: %d logfiles, %d workers', len(logfiles), workers)
+
+    # pool workers can't start their own pools - one file per process
+    worker_config = dict(config, WORKERS=1)
+    tasks = [(worker_config, logfile_data) for logfile_data in logfiles]
+    if workers == 1:
+        results = map(_backfill_worker, tasks)
+    else:
+        pool = multiprocessing.Pool(workers)
+        try:
+            results = pool.map(_backfill_worker, tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+    failed = [logfile_data.filename
+              for logfile_data, result in zip(logfiles, results) if not result]
+    if failed:
+        logging.error('Backfill failed for: %s', ', '.join(failed))
+    return not failed
+
+
+def inotify_watch(path):
+    """
+    inotify fd watching dir path, None if inotify is not available
+    """
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        fd = libc.inotify_init()
+    except (OSError, AttributeError):
+        return None
+    if fd < 0:
+        return None
+    if libc.inotify_add_watch(fd, path, IN_WATCH_MASK) < 0:
+        os.close(fd)
+        return None
+    return fd
+
+
+def read_inotify_events(fd, timeout):
+    """
+    Wait up to timeout seconds -> [(filename, mask), ...], [] on timeout
+    """
+    ready, _, _ = select.select([fd], [], [], timeout)
+    if not ready:
+        return []
+    data = os.read(fd, 65536)
+    events = []
+    pos = 0
+    while pos < len(data):
+        _, mask, _, length = INOTIFY_EVENT.unpack_from(data, pos)
+        pos += INOTIFY_EVENT.size
+        events.append((data[pos:pos + length].rstrip('\0'), mask))
+        pos += length
+    return events
+
+
+def file_signature(path):
+    try:
+        file_stat = os.stat(path)
+    except OSError:
+        return None
+    return file_stat.st_size, file_stat.st_mtime
+
+
+def watch_wakeups(inotify_fd, interval):
+    """
+    Wait for LOG_DIR changes: yields inotify events [(filename, mask), ...],
+    or None after sleeping interval when polling
+    """
+    while True:
+        if inotify_fd is not None:
+            yield read_inotify_events(inotify_fd, interval)
+        else:
+            time.sleep(interval)
+            yield None
+
+
+def process_watch(config, iterations=None, wakeups=None):
+    """
+    Stay resident and build reports for logfiles appearing in LOG_DIR.
+
+    LOG_DIR is watched with inotify (WATCH_INOTIFY), or polled every
+    WATCH_INTERVAL seconds; in the latter case it is listed again only
+    if its mtime changed. New file is processed when it is closed after
+    writing / moved into LOG_DIR, or when its size and mtime didn't
+    change since the previous check. TS_FILE is updated every
+    WATCH_INTERVAL as a heartbeat. Compiled parsers and url normalizers
+    stay cached between files.
+
+    iterations - stop after so many wakeups (default - never)
+    wakeups - iterable used instead of watch_wakeups (tests drive it)
+    """
+    if single_host_only(config, '--watch'):
+        return False
+
+    log_dir = config['LOG_DIR']
+    interval = float(config.get('WATCH_INTERVAL', 10))
+    inotify_fd = None
+    if config_bool(config.get('WATCH_INOTIFY', True)):
+        inotify_fd = inotify_watch(log_dir)
+    logging.info('Watching %s (%s)', log_dir,
+                 'inotify' if inotify_fd is not None else
+                 'polling every %gs' % interval)
+
+    # latest log as in usual run; older unreported logs are for --backfill
+    reset_metrics()
+    started = time.time()
+    write_metrics(config, process(config), time.time() - started)
+
+    file_list = list_log_dir(config) or []
+    dir_signature = file_signature(log_dir)
+    seen = set(filename for filename in file_list
+               if re.match(config['LOG_FILE_PATTERN'], filename))
+    # new file -> its signature at previous check
+    pending = {}
+    try:
+        if wakeups is None:
+            wakeups = watch_wakeups(inotify_fd, interval)
+        for events in itertools.islice(wakeups, iterations):
+            closed = set()
+            if events is not None:
+                closed = set(filename for filename, mask in events
+                             if mask & (IN_CLOSE_WRITE | IN_MOVED_TO))
+                list_changed = bool(events)
+            else:
+                list_changed = file_signature(log_dir) != dir_signature
+
+            update_ts_file(config['TS_FILE'])
+            if list_changed:
+                dir_signature = file_signature(log_dir)
+                file_list = list_log_dir(config) or []
+
+            new_files = [logfile_data for logfile_data in get_log_files(
+                file_list, config['LOG_FILE_PATTERN'])
+                if logfile_data.filename not in seen]
+            for logfile_data in new_files:
+                signature = file_signature(
+                    os.path.join(log_dir, logfile_data.filename))
+                if (logfile_data.filename not in closed and
+                        pending.get(logfile_data.filename) != signature):
+                    pending[logfile_data.filename] = signature
+                    continue
+
+                pending.pop(logfile_data.filename, None)
+                seen.add(logfile_data.filename)
+                if os.path.isfile(get_report_filename(config['REPORT_DIR'],
+                                                      logfile_data.date)):
+                    continue
+                reset_metrics()
+                started = time.time()
+                processed = make_report(config, logfile_data)
+                write_metrics(config, processed, time.time() - started)
+    except KeyboardInterrupt:
+        logging.info('Watch stopped')
+    finally:
+        if inotify_fd is not None:
+            os.close(inotify_fd)
+    return True
+
+
+def main():
+
+    # options
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--config',
+                            dest='config_file',
+                            default='/usr/local/etc/log_analyzer.conf',
+                            help='path to config-file')
+    arg_parser.add_argument('--backfill',
+                            action='store_true',
+                            help='build reports for all unreported logfiles')
+    arg_parser.add_argument('--since',
+                            type=lambda s: datetime.strptime(s, '%Y%m%d'),
+                            help='backfill only logs since date YYYYMMDD')
+    arg_parser.add_argument('--incremental',
+                            action='store_true',
+                            help='refresh report of the latest logfile '
+                                 'parsing only appended lines')
+    arg_parser.add_argument('--rollup',
+                            nargs=2,
+                            metavar=('FROM', 'TO'),
+                            type=lambda s: datetime.strptime(s, '%Y%m%d'),
+                            help='report for period YYYYMMDD YYYYMMDD '
+                                 'from stored aggregates')
+    arg_parser.add_argument('--diff',
+                            nargs=2,
+                            metavar=('BEFORE', 'AFTER'),
+                            type=lambda s: datetime.strptime(s, '%Y%m%d'),
+                            help='latency regressions between two stored '
+                                 'days YYYYMMDD YYYYMMDD')
+    sample_group = arg_parser.add_mutually_exclusive_group()
+    sample_group.add_argument('--sample',
+                              metavar='RATE',
+                              type=float,
+                              help='approximate report of the latest log '
+                                   'from RATE share of lines (0..1)')
+    sample_group.add_argument('--sample-lines',
+                              metavar='N',
+                              type=int,
+                              help='approximate report of the latest log '
+                                   'from about N lines')
+    arg_parser.add_argument('--window',
+                            nargs=2,
+                            metavar=('START', 'END'),
+                            type=parse_window_time,
+                            help='report of lines logged from START to END '
+                                 '(HH:MM of the latest log or YYYYMMDDHHMM)')
+    arg_parser.add_argument('--watch',
+                            action='store_true',
+                            help='stay resident and process new logfiles '
+                                 'as they appear')
+    arg_parser.add_argument('--profile',
+                            metavar='FILE',
+                            help='save cProfile stats of processing to FILE')
+    args = arg_parser.parse_args()
+    if args.sample is not None and not 0 < args.sample <= 1:
+        arg_parser.error('--sample RATE must be in (0, 1]')
+    if args.sample_lines is not None and args.sample_lines <= 0:
+        arg_parser.error('--sample-lines N must be positive')
+    sample = None
+    if args.sample:
+        sample = {'rate': args.sample}
+    elif args.sample_lines:
+        sample = {'lines': args.sample_lines}
+
+    config = init_config(args.config_file)
+    if not config:
+        sys.exit(1)
+
+    print("Started %s" % datetime.now().isoformat())
+
+    # logging
+    logging.basicConfig(
+        format='[%(asctime)s] %(levelname).1s %(message)s',
+        datefmt='%Y.%m.%d %H:%M:%S',
+        level=logging.INFO,
+        filename=config.get("PROCESS_LOG", None)
+    )
+
+    logging.info('Processing started')
+    started = time.time()
+    profiler = cProfile.Profile() if args.profile else None
+    # process
+    try:
+        if profiler:
+            profiler.enable()
+        if args.backfill:
+            processed = process_backfill(config, args.since)
+        elif args.incremental:
+            processed = process_incremental(config)
+        elif args.rollup:
+            processed = process_rollup(config, *args.rollup)
+        elif args.diff:
+            processed = process_diff(config, *args.diff)
+        elif args.window:
+            processed = process_window(config, *args.window)
+        elif args.watch:
+            # SIGTERM stops watching as Ctrl-C does
+            signal.signal(signal.SIGTERM, signal.default_int_handler)
+            processed = process_watch(config)
+        else:
+            processed = process(config, sample)
     except Exception:
         logging.exception('Processing error')
+        write_metrics(config, False, time.time() - started)
         sys.exit(1)
+    finally:
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(args.profile)
+            logging.info('Profile saved to %s', args.profile)
 
-    if processed:
+    # approximate or time window report is not a processing of the log
+    if processed and not sample and not args.window:
         update_ts_file(config['TS_FILE'])
+    if not args.watch:
+        # --watch saves metrics after every file
+        write_metrics(config, processed, time.time() - started)
 
 
     logging.info('Processing finished')
@@ -12,12 +12,24 @@ import sys
 import os
 import time
 import glob
+import gzip
+import shutil
+import tempfile
+import random
+import json
+import threading
+import zlib
+import cPickle
 
-from datetime import datetime, date, time
+from datetime import datetime, date, time, timedelta
+from collections import defaultdict
+from array import array
 
 sys.path.insert(0,(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
 
 from log_analyzer import *
+import log_analyzer
+import benchmark
 
 class LogAnalyzerCase(unittest.TestCase):
     
@@ -30,6 +42,20 @@ class LogAnalyzerCase(unittest.TestCase):
         self.assertEqual(filedate.day, 02)
 
 
+    def test_log_files(self):
+        file_list = ['nginx-access-ui.log-20170103.log', 'nginx-access-ui.log-20170101.gz',
+                     'nginx-access-ui.log-20170102.gz', 'other.log-20170104.gz']
+        logfiles = get_log_files(file_list, 'nginx-access-ui.log-(\d+).(gz|log)')
+        self.assertEqual([l.filename for l in logfiles],
+                         ['nginx-access-ui.log-20170101.gz', 'nginx-access-ui.log-20170102.gz',
+                          'nginx-access-ui.log-20170103.log'])
+
+        logfiles = get_log_files(file_list, 'nginx-access-ui.log-(\d+).(gz|log)', datetime(2017, 1, 2))
+        self.assertEqual(len(logfiles), 2)
+
+        self.assertEqual(get_last_log([], 'nginx-access-ui.log-(\d+).(gz|log)'), None)
+
+
     def test_line_parse(self):
         line = '1.138.198.128 -  - [30/Jun/2017:03:28:23 +0300] "GET /api/v2/banner/25949683 HTTP/1.1" 200 1261 "-" "python-requests/2.8.1" "-" "1498782502-440360380-4707-10488740" "4e9627334" 0.863'
         parsed = parse_log_line(line)
@@ -47,6 +73,31 @@ class LogAnalyzerCase(unittest.TestCase):
         parsed_line = parse_log_line(line)
 
 
+    def test_log_format(self):
+        log_format = """log_format ui_short '$remote_addr $remote_user $http_x_real_ip [$time_local] "$request" '
+                    '$status $body_bytes_sent "$http_referer" '
+                    '"$http_user_agent" "$http_x_forwarded_for" "$http_X_REQUEST_ID" "$http_X_RB_USER" '
+                    '$request_time';"""
+        log_parser = compile_log_format(log_format)
+
+        line = '1.138.198.128 -  - [30/Jun/2017:03:28:23 +0300] "GET /api/v2/banner/25949683 HTTP/1.1" 200 1261 "-" "python-requests/2.8.1" "-" "1498782502-440360380-4707-10488740" "4e9627334" 0.863'
+        self.assertEqual(log_parser(line), ('/api/v2/banner/25949683', '0.863'))
+
+        # quotes and spaces inside fields - regex fallback
+        line = '1.138.198.128 -  - [30/Jun/2017:03:28:23 +0300] "GET /api/v2/banner/1 HTTP/1.1" 200 1261 "-" "agent "quoted" x" "-" "-" "-" 0.1'
+        self.assertEqual(log_parser(line), ('/api/v2/banner/1', '0.1'))
+
+        with self.assertRaises(ValueError):
+            log_parser('1.138.198.128 -  - [30/Jun/2017:03:28:23 +0300] "-" 400 0 "-" "-" "-" "-" "-" 0.000')
+
+        # other format
+        log_parser = compile_log_format('$request_time "$request" $status')
+        self.assertEqual(log_parser('0.5 "POST /x?a=1 HTTP/1.0" 200'), ('/x?a=1', '0.5'))
+
+        with self.assertRaises(ValueError):
+            compile_log_format('$remote_addr $status')
+
+
     def test_line_wrong_format(self):
         stat = [{'count': 1, 'time_avg': 1.631, 'time_max': 0.0, 'time_sum': 1.631, 'url': '/banners/26362895/switch_status/?status=delete&_=1498748952071', 'time_med': 1.631, 'time_perc': 8.461522660694406e-07, 'count_perc': 3.826014295519814e-07}, 
                 {'count': 1, 'time_avg': 0.046, 'time_max': 0.0, 'time_sum': 0.046, 'url': '/accounts/login/?next=/agency/campaigns/%3Fsearch%3D%25D1%2581%25D0%25BE%25D1%2582%25D0%25B0%26activity%3Dactive', 'time_med': 0.046, 'time_perc': 2.386450290569851e-08, 'count_perc': 3.826014295519814e-07}, 
@@ -70,6 +121,179 @@ class LogAnalyzerCase(unittest.TestCase):
         stat.sort(key=operator.itemgetter('time_avg'), reverse=True)
         
 
+    def test_quantiles(self):
+        times = [0.001 * i for i in range(1, 1001)] + [0.0] * 10
+        lines = [(ParsedLine(url='/a', response_time='%.3f' % t), None) for t in times]
+
+        exact = process_logfile(lines, exact_quantiles=True)[0]
+        self.assertEqual(exact['count'], 1010)
+        self.assertAlmostEqual(exact['time_max'], 1.0)
+        self.assertAlmostEqual(exact['time_med'], median(times))
+        self.assertAlmostEqual(exact['time_p99'], quantile(sorted(times), 0.99))
+
+        approx = process_logfile(lines, quantile_error=0.01)[0]
+        for name, _ in QUANTILES:
+            self.assertAlmostEqual(approx[name], exact[name], delta=exact[name] * 0.011)
+
+        # histogram size is bounded
+        approx = process_logfile(lines, quantile_error=0.001, quantile_max_buckets=50)[0]
+        self.assertAlmostEqual(approx['time_p99'], exact['time_p99'], delta=exact['time_p99'] * 0.0011)
+
+        self.assertEqual(median([3.0, 1.0, 2.0, 4.0]), 2.5)
+
+
+    def test_parallel(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            with open('./test/log/nginx-access-ui.log-20170630.log') as sample:
+                sample_lines = sample.readlines()
+            plain_path = os.path.join(tmp_dir, 'nginx-access-ui.log-20170630.log')
+            with open(plain_path, 'w') as plain:
+                for i in range(3000):
+                    plain.write(sample_lines[i % len(sample_lines)].rstrip().replace('/api/', '/api/%d/' % (i % 37), 1) + '\n')
+                plain.write('broken line\n')
+            gz_path = plain_path + '.gz'
+            with open(plain_path) as plain, gzip.open(gz_path, 'w') as gz:
+                shutil.copyfileobj(plain, gz)
+
+            borders = split_logfile(plain_path, 4)
+            self.assertEqual(borders[0][0], 0)
+            self.assertEqual(borders[-1][1], os.path.getsize(plain_path))
+            self.assertEqual(sum(1 for s, e in borders for l in xread_chunk(plain_path, s, e)), 3001)
+
+            tiny_path = os.path.join(tmp_dir, 'tiny.log')
+            with open(tiny_path, 'w') as tiny:
+                tiny.write('a\n')
+            self.assertEqual(split_logfile(tiny_path, 4), [(0, 2)])
+            open(tiny_path, 'w').close()
+            self.assertEqual(split_logfile(tiny_path, 4), [])
+
+            for exact in (False, True):
+                serial = process_logfile(xread_loglines(plain_path), parse_error_perc_max=0.2, exact_quantiles=exact)
+                serial = dict((row['url'], row) for row in serial)
+                for path in (plain_path, gz_path):
+                    aggregate = aggregate_logfile_parallel(path, 3, batch_size=500, exact_quantiles=exact)
+                    self.assertEqual(aggregate.line_count, 3001)
+                    parallel = build_stat_list(aggregate, parse_error_perc_max=0.2)
+                    # chunks are merged in file order: the same floats on every run
+                    self.assertEqual(build_stat_list(aggregate_logfile_parallel(
+                        path, 3, batch_size=500, exact_quantiles=exact), parse_error_perc_max=0.2), parallel)
+                    # and the same report as the serial path (sums of chunks may
+                    # differ from the line by line sum in the last bits only)
+                    self.assertEqual(len(parallel), len(serial))
+                    for row in parallel:
+                        self.assertEqual(format_report_row(row), format_report_row(serial[row['url']]))
+        finally:
+            shutil.rmtree(tmp_dir)
+
+
+    def test_heavy_hitters(self):
+        lines = []
+        for i in range(5000):
+            lines.append((ParsedLine(url='/heavy/%d' % (i % 5), response_time='0.100'), None))
+            lines.append((ParsedLine(url='/slow', response_time='2.000'), None) if i % 50 == 0 else
+                         (ParsedLine(url='/unique/%d' % i, response_time='0.010'), None))
+        exact = aggregate_loglines(lines)
+        approx = aggregate_loglines(lines, max_urls=10)
+
+        self.assertTrue(len(approx.stat) <= 30)
+        self.assertNotEqual(approx.missing_bound, EMPTY_BOUND)
+        for url in ['/heavy/%d' % i for i in range(5)] + ['/slow']:
+            data = approx.stat[url]
+            true_data = exact.stat[url]
+            self.assertTrue(data.count <= true_data.count <= data.count + data.count_err)
+            self.assertTrue(data.time_sum <= true_data.time_sum + 1e-9)
+            self.assertTrue(true_data.time_sum <= data.time_sum + data.time_err + 1e-9)
+
+        report = build_stat_list(approx, report_size=3)
+        self.assertEqual(report[0]['url'], '/slow')
+        self.assertTrue('count_err' in report[0])
+
+        # merged partials keep bounds valid
+        merged = merge_aggregates([aggregate_loglines(lines[:5000], max_urls=10),
+                                   aggregate_loglines(lines[5000:], max_urls=10)], max_urls=10)
+        for url in ['/heavy/%d' % i for i in range(5)] + ['/slow']:
+            data = merged.stat[url]
+            self.assertTrue(data.count <= exact.stat[url].count <= data.count + data.count_err)
+
+
+    def test_url_rules(self):
+        url_rules = """
+            # comment
+            strip_query _ utm_source
+            numeric_ids
+            route ^/api/v2/banner/{id}/statistic/ /api/v2/banner/{id}/statistic/
+        """
+        normalize = compile_url_rules(url_rules, cache_size=2)
+        self.assertEqual(normalize('/api/v2/banner/25949683'), '/api/v2/banner/{id}')
+        self.assertEqual(normalize('/api/v2/banner/17096340/'), '/api/v2/banner/{id}/')
+        self.assertEqual(normalize('/banners/26362895/switch_status/?status=delete&_=1498748952071'),
+                         '/banners/{id}/switch_status/?status=delete')
+        self.assertEqual(normalize('/api/v2/banner/26751035/statistic/?date_from=2017-06-29&date_to=2017-06-29'),
+                         '/api/v2/banner/{id}/statistic/')
+        self.assertEqual(normalize('/x?_=1'), '/x')
+        self.assertEqual(normalize.stats['misses'], 5)
+        self.assertEqual(normalize('/x?_=1'), '/x')
+        self.assertEqual(normalize.stats['misses'], 5)
+
+        self.assertEqual(compile_url_rules('strip_query')('/a?b=1'), '/a')
+        self.assertEqual(compile_url_rules('replace \\.json$')('/a.json'), '/a')
+        self.assertEqual(compile_url_rules(''), None)
+        with self.assertRaises(ValueError):
+            compile_url_rules('unknown_rule')
+
+        lines = [(ParsedLine(url='/api/v2/banner/%d' % i, response_time='0.1'), None) for i in range(100)]
+        reset_metrics()
+        stat = process_logfile(lines + lines[:10], url_rules=url_rules)
+        self.assertEqual(len(stat), 1)
+        self.assertEqual(stat[0]['count'], 110)
+        metrics = collect_metrics(True, 1.0)
+        self.assertEqual(metrics['url_cache'], {'lookups': 110, 'misses': 100})
+        self.assertIn('log_analyzer_url_cache_misses 100\n', format_prometheus_metrics(metrics))
+
+
+    @unittest.skipIf(log_analyzer.numpy is None, 'numpy is not installed')
+    def test_numpy_engine(self):
+        rnd = random.Random(1)
+        lines = []
+        for i in range(30000):
+            if i % 1000 == 0:
+                lines.append((None, Exception()))
+            url = '/api/v2/banner/%d' % int(rnd.paretovariate(1.2))
+            lines.append((ParsedLine(url=url, response_time='%.3f' % rnd.expovariate(5)), None))
+
+        for options in ({}, {'exact_quantiles': True}, {'url_rules': 'numeric_ids'}):
+            expected = aggregate_loglines(lines, **options)
+            result = aggregate_loglines_numpy(lines, batch_size=7000, **options)
+            self.assertEqual(result[1:], expected[1:])
+            self.assertEqual(build_stat_list(result, 10000, 0.1),
+                             build_stat_list(expected, 10000, 0.1))
+
+
+    def test_url_stat(self):
+        times = ['0.%03d' % i for i in range(1, SMALL_TIMES_MAX + 2)]
+        lines = [(ParsedLine(url='/a', response_time=t), None) for t in times[:-1]]
+        lines += [(ParsedLine(url='/b', response_time=t), None) for t in times]
+        aggregate = aggregate_loglines(lines)
+        small, big = aggregate.stat['/a'], aggregate.stat['/b']
+        self.assertEqual(small.time_list, array('d', map(float, times[:-1])))
+        self.assertEqual(small.time_hist, None)
+        self.assertEqual(big.time_list, None)
+        self.assertEqual(sum(big.time_hist.values()), SMALL_TIMES_MAX + 1)
+        self.assertEqual(small.count_err, None)
+        self.assertEqual(build_stat_list(aggregate)[1]['time_med'], median(map(float, times[:-1])))
+
+        # merged small lists become a histogram at the same count
+        merged = merge_aggregates([aggregate_loglines(lines[::2]), aggregate_loglines(lines[1::2])])
+        self.assertEqual(merged.stat['/a'].time_hist, None)
+        self.assertEqual(merged.stat['/b'].time_list, None)
+        quantiles = lambda rows: [(row['url'], row['count'], row['time_med'], row['time_p99']) for row in rows]
+        self.assertEqual(quantiles(build_stat_list(merged)), quantiles(build_stat_list(aggregate)))
+
+        copy = cPickle.loads(cPickle.dumps(big, cPickle.HIGHEST_PROTOCOL))
+        self.assertEqual((copy.count, copy.time_hist), (big.count, big.time_hist))
+
+
     def test_report_render(self):
         stat = [{'count': 1, 'time_avg': 1.631, 'time_max': 0.0, 'time_sum': 1.631, 'url': '/banners/26362895/switch_status/?status=delete&_=1498748952071', 'time_med': 1.631, 'time_perc': 8.461522660694406e-07, 'count_perc': 3.826014295519814e-07}, 
                 {'count': 1, 'time_avg': 0.046, 'time_max': 0.0, 'time_sum': 0.046, 'url': '/accounts/login/?next=/agency/campaigns/%3Fsearch%3D%25D1%2581%25D0%25BE%25D1%2582%25D0%25B0%26activity%3Dactive', 'time_med': 0.046, 'time_perc': 2.386450290569851e-08, 'count_perc': 3.826014295519814e-07}, 
@@ -82,6 +306,189 @@ class LogAnalyzerCase(unittest.TestCase):
         self.assertNotEqual(pos, -1)
 
 
+    def test_write_report(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            stat = [{'count': 1, 'time_avg': 1.631, 'time_max': 1.631, 'time_sum': 1.631, 'url': '/a', 'time_med': 1.631, 'time_perc': 0.5, 'count_perc': 0.5},
+                    {'count': 1, 'time_avg': 0.046, 'time_max': 0.046, 'time_sum': 0.046, 'url': '/b', 'time_med': 0.046, 'time_perc': 0.5, 'count_perc': 0.5}]
+            report_filename = os.path.join(tmp_dir, 'reports', 'report_2017.06.30.html')
+            self.assertTrue(write_report(stat, './report.html', report_filename, gzip_copy=True))
+
+            self.assertEqual(sorted(os.listdir(os.path.dirname(report_filename))),
+                             ['report_2017.06.30.html', 'report_2017.06.30.html.gz'])
+            with open(report_filename) as report:
+                report_str = report.read()
+            self.assertEqual(report_str, render_report(stat, './report.html'))
+            with gzip.open(report_filename + '.gz') as report:
+                self.assertEqual(report.read(), report_str)
+
+            self.assertEqual(write_report(stat, './no_such_template.html', report_filename), None)
+
+            # failed .gz tmp-file doesn't leave .html tmp-file behind
+            def open_tmp_file(target_filename):
+                if target_filename.endswith('.gz'):
+                    raise IOError('No space left on device')
+                return open_tmp_file_orig(target_filename)
+            open_tmp_file_orig = log_analyzer.open_tmp_file
+            log_analyzer.open_tmp_file = open_tmp_file
+            try:
+                self.assertEqual(write_report(stat, './report.html', report_filename + '.new', gzip_copy=True), None)
+            finally:
+                log_analyzer.open_tmp_file = open_tmp_file_orig
+            self.assertEqual(sorted(os.listdir(os.path.dirname(report_filename))),
+                             ['report_2017.06.30.html', 'report_2017.06.30.html.gz'])
+        finally:
+            shutil.rmtree(tmp_dir)
+
+
+    def test_external_aggregation(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            log_path = os.path.join(tmp_dir, 'nginx-access-ui.log-20170630.log')
+            benchmark.generate_log(log_path, lines=30000, urls=20000, zipf=1.1, error_rate=0.01, seed=9)
+            lines = list(xread_loglines(log_path, compile_log_format(DEFAULT_LOG_FORMAT, extended=True)))
+
+            for options in ({'group_by': 'method; status_class'}, {'exact_quantiles': True}):
+                expected = aggregate_loglines(lines, **options)
+                reset_metrics()
+                result = aggregate_loglines_external(iter(lines), 300000, 50, tmp_dir, 8, **options)
+                self.assertTrue(log_analyzer._metrics['counters']['spill_bytes'] > 0)
+                self.assertEqual(log_analyzer._metrics['counters']['distinct_urls'], len(expected.stat))
+                self.assertEqual(len(result.stat), 50)
+                self.assertEqual(result[1:], expected[1:])
+                self.assertEqual(build_stat_list(result, 50, 0.1), build_stat_list(expected, 50, 0.1))
+                # scratch dir is removed
+                self.assertEqual(os.listdir(tmp_dir), ['nginx-access-ui.log-20170630.log'])
+
+                # fits in memory - every url is kept
+                result = aggregate_loglines_external(iter(lines), 1 << 30, 50, tmp_dir, **options)
+                self.assertEqual(len(result.stat), len(expected.stat))
+                self.assertEqual(build_stat_list(result, 10000, 0.1), build_stat_list(expected, 10000, 0.1))
+
+            # histogram mode: records of a hot url are reduced into a histogram
+            record = None
+            for i in range(5):
+                record = replay_url_stat(record, UrlStat(5, 0.5, 0.1, array('d', [0.1] * 5)), hist_log_gamma(0.01))
+            self.assertEqual((record.count, record.time_list), (25, None))
+            self.assertEqual(sum(record.time_hist.values()), 25)
+            # a histogram can't be merged without its log_gamma
+            self.assertRaises(ValueError, merge_url_stat, record, UrlStat(1, 0.1, 0.1, array('d', [0.1])))
+        finally:
+            shutil.rmtree(tmp_dir)
+
+
+    def test_group_by(self):
+        line = '1.138.198.128 -  - [30/Jun/2017:03:28:23 +0300] "POST /api/1 HTTP/1.1" 502 1261 "-" "python-requests/2.8.1" "-" "-" "-" 0.863'
+        self.assertEqual(compile_log_format(DEFAULT_LOG_FORMAT, extended=True)(line),
+                         ('/api/1', '0.863', 'POST', '502', '30/Jun/2017:03:28:23 +0300'))
+        self.assertEqual(compile_log_format('$request_time "$request" $status', extended=True)('0.5 "GET /x HTTP/1.0" 404'),
+                         ('/x', '0.5', 'GET', '404', None))
+        with self.assertRaises(ValueError):
+            parse_group_by('url,country')
+
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            log_path = os.path.join(tmp_dir, 'nginx-access-ui.log-20170630.log')
+            benchmark.generate_log(log_path, lines=20000, urls=50, error_rate=0.01, seed=5)
+            group_by = 'url,status_class; url,hour; method'
+            log_parser = compile_log_format(DEFAULT_LOG_FORMAT, extended=True)
+            lines = list(xread_loglines(log_path, log_parser))
+
+            expected = defaultdict(lambda: [0, 0.0])
+            for line, error in lines:
+                if error:
+                    continue
+                for key in [(('url', 'status_class'), (line.url, line.status[0] + 'xx')),
+                            (('url', 'hour'), (line.url, int(line.time_local[12:14]))),
+                            (('method',), line.method)]:
+                    expected[key][0] += 1
+                    expected[key][1] += float(line.response_time)
+
+            aggregate = aggregate_loglines(lines, group_by=group_by)
+            merged = merge_aggregates([aggregate_loglines(lines[:7000], group_by=group_by),
+                                       aggregate_loglines(lines[7000:], group_by=group_by)])
+            for result in (aggregate, merged):
+                self.assertEqual(sorted(result.groups), [('method',), ('url', 'hour'), ('url', 'status_class')])
+                got = {}
+                for dims, group in result.groups.items():
+                    for key, (count, time_sum, time_max) in group.items():
+                        got[dims, key] = count
+                        self.assertAlmostEqual(time_sum, expected[dims, key][1])
+                self.assertEqual(got, dict((key, value[0]) for key, value in expected.items()))
+
+            rows = build_stat_list(aggregate, parse_error_perc_max=0.1)
+            for row in rows:
+                self.assertEqual(row['count_status_class_2xx'] + row['count_status_class_5xx'], row['count'])
+                self.assertEqual(len(row['time_avg_hourly']), 24)
+
+            # $status is absent from the format: no count_status_class_None column
+            no_status = [(ParsedLineExt('/x', '0.1', 'GET', None, None), None)]
+            rows = build_stat_list(aggregate_loglines(no_status, group_by='url,status_class'))
+            self.assertEqual(sorted(rows[0]), sorted(build_stat_list(aggregate_loglines(no_status))[0]))
+
+            config = {
+                "REPORT_SIZE": 10,
+                "REPORT_DIR": tmp_dir,
+                "REPORT_TEMPLATE": "./report.html",
+                "LOG_DIR": tmp_dir,
+                "LOG_FILE_PATTERN": "nginx-access-ui.log-(\\d+).(gz|log)",
+                "GROUP_BY": group_by,
+            }
+            self.assertTrue(process(config))
+            with open(os.path.join(tmp_dir, 'report_2017.06.30.groups.json')) as fgroups:
+                group_lists = json.load(fgroups)
+            self.assertEqual(sorted(group_lists), ['method', 'url,hour', 'url,status_class'])
+            self.assertEqual(sum(row['count'] for row in group_lists['method']), aggregate.parsed_count)
+            self.assertEqual(len(set(row['url'] for row in group_lists['url,hour'])), 10)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+
+    def test_sharded_report(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            rnd = random.Random(1)
+            stat = [{'count': rnd.randint(1, 100), 'time_avg': rnd.random(), 'url': '/%d' % i}
+                    for i in range(1200)]
+            config = {'REPORT_LAYOUT': 'sharded', 'REPORT_PAGE_SIZE': 500}
+            report_filename = os.path.join(tmp_dir, 'report_2017.06.30.html')
+            self.assertTrue(write_config_report(config, stat, report_filename))
+            # rewrite replaces shards
+            self.assertTrue(write_config_report(config, stat, report_filename))
+            self.assertEqual(sorted(os.listdir(tmp_dir)),
+                             ['report_2017.06.30.data', 'report_2017.06.30.html'])
+
+            data_dir = os.path.join(tmp_dir, 'report_2017.06.30.data')
+            self.assertEqual(sorted(os.listdir(data_dir)), ['_default', 'count', 'time_avg', 'url'])
+            for column in ('_default', 'count', 'time_avg', 'url'):
+                shards = sorted(os.listdir(os.path.join(data_dir, column)))
+                self.assertEqual(shards, ['00000.json.gz', '00001.json.gz', '00002.json.gz'])
+                rows = []
+                for shard in shards:
+                    with gzip.open(os.path.join(data_dir, column, shard)) as fshard:
+                        rows.extend(json.load(fshard))
+                self.assertEqual(len(rows), 1200)
+                if column == '_default':
+                    self.assertEqual([row['url'] for row in rows], [data['url'] for data in stat])
+                elif column == 'url':
+                    self.assertEqual([row['url'] for row in rows], sorted(data['url'] for data in stat))
+                else:
+                    values = [float(row[column]) for row in rows]
+                    self.assertEqual(values, sorted(values, reverse=True))
+
+            # page size doesn't depend on number of rows
+            with open(report_filename) as report:
+                report_str = report.read()
+            self.assertIn('"rows": 1200', report_str)
+            self.assertTrue(write_config_report(config, stat[:10], report_filename))
+            with open(report_filename) as report:
+                self.assertEqual(len(report.read()), len(report_str) - 2)
+
+            self.assertEqual(write_config_report({'REPORT_LAYOUT': 'pdf'}, stat, report_filename), None)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+
     def test_full_process(self):
         config = {
             "REPORT_SIZE": 1000,
@@ -114,6 +521,186 @@ class LogAnalyzerCase(unittest.TestCase):
         self.assertEqual(True, processed)
 
         
+    def test_multi_host(self):
+        pattern = '(?P<host>\w+)\.nginx-access-ui\.log-(\d+).(gz|log)'
+        self.assertEqual(get_host_log_files([(None, '/log', ['b.nginx-access-ui.log-20170630.gz', 'a.nginx-access-ui.log-20170630.log',
+                                                             'a.nginx-access-ui.log-20170629.log', 'other.log'])], pattern),
+                         [(datetime(2017, 6, 29), [HostLogfile('a', '/log/a.nginx-access-ui.log-20170629.log')]),
+                          (datetime(2017, 6, 30), [HostLogfile('a', '/log/a.nginx-access-ui.log-20170630.log'),
+                                                   HostLogfile('b', '/log/b.nginx-access-ui.log-20170630.gz')])])
+        self.assertEqual(get_log_files(['a.nginx-access-ui.log-20170630.log'], pattern)[0].date, datetime(2017, 6, 30))
+
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            config = {
+                "REPORT_SIZE": 100000,
+                "REPORT_DIR": tmp_dir,
+                "REPORT_TEMPLATE": "./report.html",
+                "LOG_DIR": tmp_dir,
+                "LOG_DIRS": '\n'.join(os.path.join(tmp_dir, host) for host in ('front1', 'front2', 'front3')),
+                "LOG_FILE_PATTERN": "nginx-access-ui.log-(\d+).(gz|log)",
+                "HOST_COLUMN": "True",
+                "HOST_WORKERS": 2,
+            }
+            lines = []
+            for seed, host in enumerate(('front1', 'front2', 'front3')):
+                os.mkdir(os.path.join(tmp_dir, host))
+                log_path = os.path.join(tmp_dir, host, 'nginx-access-ui.log-20170630.log')
+                benchmark.generate_log(log_path, lines=3000, urls=100, error_rate=0.0, seed=seed)
+                lines.extend(xread_loglines(log_path))
+            benchmark.generate_log(os.path.join(tmp_dir, 'front1', 'nginx-access-ui.log-20170629.log'), lines=100, seed=7)
+            self.assertTrue(is_multi_host(config))
+
+            # late log of a host: the report waits for it
+            late_path = os.path.join(tmp_dir, 'front3', 'nginx-access-ui.log-20170630.log')
+            os.rename(late_path, os.path.join(tmp_dir, 'late.log'))
+            self.assertEqual(get_missing_hosts(config, list_host_logs(config)), ['front3'])
+            self.assertTrue(process(config))
+            report_filename = os.path.join(tmp_dir, 'report_2017.06.30.html')
+            self.assertFalse(os.path.isfile(report_filename))
+            os.rename(os.path.join(tmp_dir, 'late.log'), late_path)
+            self.assertEqual(get_missing_hosts(config, list_host_logs(config)), [])
+            # hosts of the previous date are expected too
+            self.assertEqual(get_missing_hosts({'LOG_DIR': '/log'}, get_host_log_files(
+                [(None, '/log', ['a.nginx-access-ui.log-20170629.log', 'b.nginx-access-ui.log-20170629.log',
+                                 'a.nginx-access-ui.log-20170630.log'])], pattern)), ['b'])
+
+            self.assertTrue(process(config))
+            with open(report_filename) as report_file:
+                report = report_file.read()
+            rows = json.loads(report[report.index('var table = ') + len('var table = '):].split(';\n')[0])
+            expected = dict((row['url'], row) for row in process_logfile(lines, 100000))
+            self.assertEqual(len(rows), len(expected))
+            for row in rows:
+                self.assertEqual(int(row['count']), expected[row['url']]['count'])
+                self.assertEqual(sum(int(row.get('count_host_front%d' % i, 0)) for i in (1, 2, 3)), int(row['count']))
+            with open(get_groups_filename(report_filename)) as groups_file:
+                hosts = json.load(groups_file)['host']
+            self.assertEqual(sorted(row['host'] for row in hosts), ['front1', 'front2', 'front3'])
+            self.assertEqual(sum(row['count'] for row in hosts), len(lines))
+
+            # backfill builds a date from logs of all hosts
+            log_dir = os.path.join(tmp_dir, 'hosts')
+            os.mkdir(log_dir)
+            config = dict(config, LOG_DIRS='', LOG_DIR=log_dir, REPORT_DIR=os.path.join(tmp_dir, 'reports'),
+                          LOG_FILE_PATTERN=pattern)
+            for seed, host in enumerate(('a', 'b')):
+                for day in ('20170628', '20170629'):
+                    benchmark.generate_log(os.path.join(log_dir, '%s.nginx-access-ui.log-%s.log' % (host, day)),
+                                           lines=8, urls=3, error_rate=0.0, seed=seed)
+            benchmark.generate_log(os.path.join(log_dir, 'a.nginx-access-ui.log-20170630.log'), lines=8, seed=2)
+            self.assertTrue(process_backfill(config))
+            # 20170630 waits for host b
+            self.assertEqual(sorted(os.listdir(config['REPORT_DIR'])),
+                             ['report_2017.06.28.groups.json', 'report_2017.06.28.html',
+                              'report_2017.06.29.groups.json', 'report_2017.06.29.html'])
+            with open(os.path.join(config['REPORT_DIR'], 'report_2017.06.28.html')) as report_file:
+                report = report_file.read()
+            rows = json.loads(report[report.index('var table = ') + len('var table = '):].split(';\n')[0])
+            self.assertEqual(sum(int(row['count']) for row in rows), 16)
+            self.assertEqual(sum(int(row.get('count_host_a', 0)) for row in rows), 8)
+            for mode in (process_watch, process_incremental):
+                self.assertFalse(mode(config))
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_time_window(self):
+        self.assertEqual(time_local_minute('30/Jun/2017:03:28:23 +0300'), 201706300328)
+        start, end = datetime(2017, 6, 29, 3, 53), datetime(2017, 6, 29, 3, 54)
+        self.assertEqual(parse_window_time('03:53'), start.time())
+        self.assertEqual(parse_window_time('201706290353'), start)
+        # parse errors count for the window only after its lines
+        window_lines = [(ParsedLineExt('/%d' % i, '0.1', 'GET', '200', '29/Jun/2017:03:%d:00 +0300' % minute), None)
+                        for i, minute in enumerate((52, 53, 53, 54))]
+        error = (None, ValueError('Line does not match log format'))
+        self.assertEqual(list(xfilter_window([error, window_lines[0], error, window_lines[1], error,
+                                              window_lines[2], window_lines[3], error], start, end)),
+                         [window_lines[1], error, window_lines[2]])
+
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            config = {
+                "REPORT_SIZE": 100000,
+                "REPORT_DIR": tmp_dir,
+                "REPORT_TEMPLATE": "./report.html",
+                "LOG_DIR": tmp_dir,
+                "LOG_FILE_PATTERN": "nginx-access-ui.log-(\d+).(gz|log)",
+                "TIME_INDEX": True,
+            }
+            log_parser = get_log_parser(DEFAULT_LOG_FORMAT, extended=True)
+            for ext in ('log', 'gz'):
+                # 03:50:22 - about 03:55
+                log_path = os.path.join(tmp_dir, 'nginx-access-ui.log-20170629.' + ext)
+                benchmark.generate_log(log_path, lines=30000, urls=100, error_rate=0.0, seed=5)
+                expected = [parsed for parsed, _ in xread_loglines(log_path, log_parser)
+                            if time_local_minute(parsed.time_local) == 201706290353]
+
+                # first full pass leaves the index, reports go from the range only
+                self.assertTrue(process(config))
+                index_filename = os.path.join(tmp_dir, '.nginx-access-ui.log-20170629.%s.tidx' % ext)
+                time_index = load_time_index(index_filename, log_path)
+                self.assertEqual(time_index['times'][0], (201706290350, 0))
+                offset_from, offset_to = time_index_range(time_index, start, end)
+                self.assertTrue(0 < offset_from < offset_to < sum(len(block) for block in xread_blocks(log_path)))
+                self.assertEqual(time_index_range(time_index, datetime(2017, 6, 30), datetime(2017, 6, 30, 1)), (0, 0))
+
+                for rebuild in (False, True):
+                    if rebuild:
+                        os.remove(index_filename)
+                    self.assertTrue(process_window(config, start.time(), end.time()))
+                    report_filename = os.path.join(tmp_dir, 'report_2017.06.29_0353-0354.html')
+                    with open(report_filename) as report_file:
+                        report = report_file.read()
+                    rows = json.loads(report[report.index('var table = ') + len('var table = '):].split(';\n')[0])
+                    self.assertEqual(sum(int(row['count']) for row in rows), len(expected))
+                    self.assertTrue(os.path.isfile(index_filename))
+                    os.remove(report_filename)
+                self.assertFalse(process_window(config, end.time(), start.time()))
+
+                os.remove(os.path.join(tmp_dir, 'report_2017.06.29.html'))
+                if ext == 'log':
+                    os.remove(log_path)
+
+            # inflating restarts from access points
+            with open(log_path, 'rb') as logfile:
+                content = logfile.read()
+            gz_path = os.path.join(tmp_dir, 'members.gz')
+            with open(gz_path, 'wb') as logfile:
+                logfile.write(content + content)
+            plain = ''.join(xread_blocks(gz_path))
+            access_points = []
+            with open(gz_path, 'rb') as logfile:
+                self.assertEqual(''.join(xinflate_gzip(logfile, 1000, access_points, span=1 << 18)), plain)
+            self.assertTrue(len(access_points) > 10)
+            time_index = {'access': access_points}
+            for offset in (0, 1000, 1 << 20, len(plain) / 2 - 10, len(plain) - 10):
+                self.assertEqual(''.join(xread_range_blocks(gz_path, time_index, offset, offset + 300000)),
+                                 plain[offset:offset + 300000])
+
+            # quiet log: a line every 10 s, the last sample is at about 01:50
+            log_path = os.path.join(tmp_dir, 'nginx-access-ui.log-20170701.log')
+            with open(log_path, 'w') as logfile:
+                for i in range(1000):
+                    moment = datetime(2017, 7, 1) + timedelta(seconds=10 * i)
+                    logfile.write('1.1.1.1 -  - [%s +0300] "GET /api/%d HTTP/1.1" 200 1 "-" "-" "-" "-" "-" 0.100\n'
+                                  % (moment.strftime('%d/%b/%Y:%H:%M:%S'), i % 7))
+            for rebuild in (True, False):
+                self.assertTrue(process_window(config, datetime(2017, 7, 1, 2, 40).time(),
+                                               datetime(2017, 7, 1, 2, 45).time()))
+                report_filename = os.path.join(tmp_dir, 'report_2017.07.01_0240-0245.html')
+                with open(report_filename) as report_file:
+                    report = report_file.read()
+                rows = json.loads(report[report.index('var table = ') + len('var table = '):].split(';\n')[0])
+                self.assertEqual(sum(int(row['count']) for row in rows), 30)
+            time_index = load_time_index(os.path.join(tmp_dir, '.nginx-access-ui.log-20170701.log.tidx'), log_path)
+            self.assertTrue(time_index['times'][-1][0] < 201707010200)
+            self.assertEqual(time_index['last'], 201707010246)
+            self.assertEqual(time_index_range(time_index, datetime(2017, 7, 1, 2, 50), datetime(2017, 7, 1, 3)),
+                             (0, 0))
+        finally:
+            shutil.rmtree(tmp_dir)
+
+
     def test_ts_file(self):
         config = {
             "TS_FILE": "./test/test.ts",
@@ -174,6 +761,351 @@ class LogAnalyzerCase(unittest.TestCase):
         self.assertEqual(True, processed)
         self.assertEqual('TESTLINE', report_line.strip())
 
+    def test_backfill(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            config = {
+                "REPORT_SIZE": 1000,
+                "REPORT_DIR": os.path.join(tmp_dir, 'reports'),
+                "REPORT_TEMPLATE": "./report.html",
+                "LOG_DIR": os.path.join(tmp_dir, 'log'),
+                "LOG_FILE_PATTERN": "nginx-access-ui.log-(\d+).(gz|log)",
+                "BACKFILL_WORKERS": 2,
+            }
+            os.mkdir(config['REPORT_DIR'])
+            os.mkdir(config['LOG_DIR'])
+            for day in ('20170627', '20170628', '20170629', '20170630'):
+                shutil.copy('./test/log/nginx-access-ui.log-20170630.log',
+                            os.path.join(config['LOG_DIR'], 'nginx-access-ui.log-%s.log' % day))
+
+            old_report_file = os.path.join(config['REPORT_DIR'], 'report_2017.06.29.html')
+            with open(old_report_file, 'w') as old_report:
+                old_report.write('TESTLINE')
+
+            self.assertTrue(process_backfill(config, datetime(2017, 6, 28)))
+
+            self.assertEqual(sorted(os.listdir(config['REPORT_DIR'])),
+                             ['report_2017.06.28.html', 'report_2017.06.29.html', 'report_2017.06.30.html'])
+            with open(old_report_file) as old_report:
+                self.assertEqual(old_report.read(), 'TESTLINE')
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_incremental(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            config = {
+                "REPORT_SIZE": 1000,
+                "REPORT_DIR": tmp_dir,
+                "REPORT_TEMPLATE": "./report.html",
+                "LOG_DIR": tmp_dir,
+                "LOG_FILE_PATTERN": "nginx-access-ui.log-(\d+).(gz|log)",
+                "STATE_FILE": os.path.join(tmp_dir, 'state'),
+            }
+            with open('./test/log/nginx-access-ui.log-20170630.log') as sample:
+                sample_lines = [line.rstrip() + '\n' for line in sample]
+            log_path = os.path.join(tmp_dir, 'nginx-access-ui.log-20170630.log')
+            report_path = os.path.join(tmp_dir, 'report_2017.06.30.html')
+
+            with open(log_path, 'w') as log:
+                log.writelines(sample_lines)
+            self.assertTrue(process_incremental(config))
+            self.assertEqual(load_state(config['STATE_FILE'])['aggregate'].line_count, 8)
+
+            # appended lines, last one is not finished yet
+            with open(log_path, 'a') as log:
+                log.writelines(sample_lines[:3])
+                log.write(sample_lines[3][:20])
+            self.assertTrue(process_incremental(config))
+            state = load_state(config['STATE_FILE'])
+            self.assertEqual(state['aggregate'].line_count, 11)
+            self.assertEqual(state['offset'], os.path.getsize(log_path) - 20)
+            with open(log_path, 'a') as log:
+                log.write(sample_lines[3][20:])
+            self.assertTrue(process_incremental(config))
+            self.assertEqual(load_state(config['STATE_FILE'])['aggregate'].line_count, 12)
+
+            with open(report_path) as report:
+                self.assertNotEqual(report.read().find('/api/v2/banner/16852664'), -1)
+
+            # truncated - full rescan
+            with open(log_path, 'w') as log:
+                log.writelines(sample_lines[:2])
+            self.assertTrue(process_incremental(config))
+            self.assertEqual(load_state(config['STATE_FILE'])['aggregate'].line_count, 2)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_aggregate_store(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            config = {
+                "REPORT_SIZE": 1000,
+                "REPORT_DIR": tmp_dir,
+                "REPORT_TEMPLATE": "./report.html",
+                "AGGREGATE_DB": os.path.join(tmp_dir, 'aggregates.sqlite'),
+            }
+            day1 = aggregate_loglines([(ParsedLine(url='/a', response_time='0.100'), None),
+                                       (ParsedLine(url='/b', response_time='1.000'), None)])
+            day2 = aggregate_loglines([(ParsedLine(url='/a', response_time='0.500'), None),
+                                       (ParsedLine(url='/a', response_time='0.700'), None),
+                                       (ParsedLine(url='/b', response_time='0.900'), None)],
+                                      exact_quantiles=True)
+            store_aggregate(config['AGGREGATE_DB'], datetime(2017, 6, 29), day1)
+            store_aggregate(config['AGGREGATE_DB'], datetime(2017, 6, 30), day2)
+
+            rollup = load_aggregate(config['AGGREGATE_DB'], datetime(2017, 6, 1), datetime(2017, 6, 30))
+            self.assertEqual(rollup.parsed_count, 5)
+            self.assertEqual(rollup.stat['/a'].count, 3)
+            self.assertAlmostEqual(rollup.stat['/a'].time_sum, 1.3)
+            self.assertAlmostEqual(rollup.stat['/a'].time_max, 0.7)
+            self.assertEqual(sum(rollup.stat['/a'].time_hist.values()), 3)
+            self.assertEqual(load_aggregate(config['AGGREGATE_DB'], datetime(2017, 7, 1), datetime(2017, 7, 2)), None)
+
+            self.assertTrue(process_rollup(config, datetime(2017, 6, 29), datetime(2017, 6, 30)))
+            self.assertTrue(os.path.isfile(os.path.join(tmp_dir, 'report_2017.06.29-2017.06.30.html')))
+
+            self.assertTrue(process_diff(config, datetime(2017, 6, 29), datetime(2017, 6, 30)))
+            self.assertTrue(os.path.isfile(os.path.join(tmp_dir, 'diff_2017.06.29-2017.06.30.html')))
+
+            diff = build_diff_list(build_stat_list(day1), build_stat_list(day2))
+            self.assertEqual([row['url'] for row in diff], ['/a', '/b'])
+            self.assertAlmostEqual(diff[0]['time_avg_delta'], 0.5)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_benchmark(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            log_path = os.path.join(tmp_dir, 'nginx-access-ui.log-20170630.gz')
+            benchmark.generate_log(log_path, lines=2000, urls=50, error_rate=0.05, seed=7)
+            lines = [parsed for parsed, _ in xread_loglines(log_path)]
+            self.assertEqual(len(lines), 2000)
+            errors = lines.count(None)
+            self.assertTrue(50 < errors < 150)
+            urls = set(line.url for line in lines if line)
+            self.assertTrue(len(urls) <= 50)
+
+            log_copy = os.path.join(tmp_dir, 'nginx-access-ui.log-20170701.gz')
+            benchmark.generate_log(log_copy, lines=2000, urls=50, error_rate=0.05, seed=7)
+            self.assertEqual([parsed for parsed, _ in xread_loglines(log_copy)], lines)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+        stage = {'seconds': 1.0, 'items': 1000, 'items_per_sec': 1000.0, 'peak_rss_kb': 1000}
+        baseline = {'stages': {'xread_loglines': stage, 'render_report': stage}}
+        results = {'stages': {'xread_loglines': dict(stage, items_per_sec=950.0),
+                              'render_report': dict(stage, items_per_sec=800.0, peak_rss_kb=1200)}}
+        regressions = benchmark.compare_results(baseline, results, threshold=0.1)
+        self.assertEqual(len(regressions), 2)
+        self.assertTrue(all(r.startswith('render_report') for r in regressions))
+
+    def test_bulk_reader(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            with open('./test/log/nginx-access-ui.log-20170630.log') as sample:
+                sample_lines = sample.read().rstrip().split('\n')
+            lines = sample_lines + [
+                sample_lines[0].replace('/api/', '/\xd0\xb0\xd0\xbf\xd0\xb8/'),
+                sample_lines[1].replace('/api/', '/\xff/'),
+                sample_lines[2] + '\r',
+                'broken line',
+            ]
+            expected = [parse_log_line(line) for line in sample_lines]
+            expected += [
+                ParsedLine(url=u'/\u0430\u043f\u0438/v2/banner/25019354', response_time='0.390'),
+                None,
+                expected[2],
+                None,
+            ]
+
+            plain_path = os.path.join(tmp_dir, 'nginx-access-ui.log-20170630.log')
+            with open(plain_path, 'wb') as log:
+                log.write('\n'.join(lines))
+            # two gzip members, as after `cat a.gz b.gz`
+            gz_path = os.path.join(tmp_dir, 'nginx-access-ui.log-20170630.gz')
+            with open(gz_path, 'wb') as log:
+                for part in (lines[:5], lines[5:]):
+                    member = gzip.GzipFile(filename='', fileobj=log, mode='wb')
+                    member.write(''.join(line + '\n' for line in part))
+                    member.close()
+
+            for path in (plain_path, gz_path):
+                for block_size in (7, 100, READ_BLOCK_SIZE):
+                    for read_thread in (False, True):
+                        parsed = [line for line, _ in xread_loglines(
+                            path, block_size=block_size, read_thread=read_thread)]
+                        self.assertEqual(parsed, expected)
+
+            # reader thread stops when the generator is dropped
+            log_lines = xread_loglines(gz_path, block_size=7, read_thread=True)
+            next(log_lines)
+            log_lines.close()
+            self.assertEqual([thread for thread in threading.enumerate()
+                              if thread.name == 'log-reader'], [])
+
+            # zero padding after the last member is ignored, as by gzip
+            with open(gz_path, 'rb') as log:
+                gz_data = log.read()
+            with open(gz_path, 'wb') as log:
+                log.write(gz_data + '\0' * 1000)
+            for block_size in (7, READ_BLOCK_SIZE):
+                self.assertEqual([line for line, _ in xread_loglines(gz_path, block_size=block_size)], expected)
+                if get_libz():
+                    with open(gz_path, 'rb') as log:
+                        self.assertEqual(''.join(xinflate_gzip(log, block_size)),
+                                         ''.join(line + '\n' for line in lines))
+            if get_libz():
+                with open(gz_path, 'wb') as log:
+                    log.write(gz_data[:-10])
+                with open(gz_path, 'rb') as log:
+                    with self.assertRaises(EOFError):
+                        list(xinflate_gzip(log))
+
+            # and passes errors through
+            with open(gz_path, 'wb') as log:
+                log.write(gz_data[:-10])
+            with self.assertRaises(EOFError):
+                list(xread_loglines(gz_path, read_thread=True))
+            with open(gz_path, 'wb') as log:
+                log.write(gz_data[:20] + 'broken' + gz_data[26:])
+            with self.assertRaises(zlib.error):
+                list(xread_loglines(gz_path, read_thread=True))
+            errors = [error for _, error in xread_loglines(plain_path)]
+            self.assertTrue(isinstance(errors[9], UnicodeDecodeError))
+            self.assertEqual([e is None for e in errors], [True] * 9 + [False, True, False])
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_metrics(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            config = {
+                "REPORT_SIZE": 1000,
+                "REPORT_DIR": tmp_dir,
+                "REPORT_TEMPLATE": "./report.html",
+                "TS_FILE": os.path.join(tmp_dir, "log_analyzer.ts"),
+                "LOG_DIR": tmp_dir,
+                "LOG_FILE_PATTERN": "nginx-access-ui.log-(\d+).(gz|log)",
+                "PARSE_ERROR_PERC_MAX": 0.5,
+            }
+            with open('./test/log/nginx-access-ui.log-20170630.log') as sample:
+                sample_lines = sample.read().rstrip() + '\n'
+            with open(os.path.join(tmp_dir, 'nginx-access-ui.log-20170630.log'), 'w') as log:
+                log.write(sample_lines + 'broken line\n' +
+                          sample_lines.splitlines()[0].replace('/api/', '/\xff\xfe/') + '\n')
+
+            reset_metrics()
+            self.assertTrue(process(config))
+            self.assertTrue(write_metrics(config, True, 2.0))
+
+            with open(os.path.join(tmp_dir, 'log_analyzer.json')) as fmetrics:
+                metrics = json.load(fmetrics)
+            self.assertEqual(metrics['lines_read'], 10)
+            self.assertEqual(metrics['parse_errors'], {'decode': 1, 'format': 1})
+            self.assertEqual(metrics['distinct_urls'], 8)
+            self.assertEqual(metrics['lines_per_second'], 5.0)
+            self.assertEqual(set(metrics['stages']),
+                             set(['listing', 'decompression', 'parsing', 'aggregation',
+                                  'rendering', 'writing']))
+
+            with open(os.path.join(tmp_dir, 'log_analyzer.prom')) as fmetrics:
+                prom = fmetrics.read()
+            self.assertIn('log_analyzer_lines_read 10\n', prom)
+            self.assertIn('log_analyzer_parse_errors{kind="decode"} 1\n', prom)
+            self.assertIn('log_analyzer_stage_seconds{stage="parsing",clock="cpu"}', prom)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_sample(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            config = {
+                "REPORT_SIZE": 1000,
+                "REPORT_DIR": tmp_dir,
+                "REPORT_TEMPLATE": "./report.html",
+                "TS_FILE": os.path.join(tmp_dir, "log_analyzer.ts"),
+                "LOG_DIR": tmp_dir,
+                "LOG_FILE_PATTERN": "nginx-access-ui.log-(\d+).(gz|log)",
+            }
+            for ext in ('log', 'gz'):
+                log_path = os.path.join(tmp_dir, 'nginx-access-ui.log-20170630.' + ext)
+                benchmark.generate_log(log_path, lines=20000, urls=20, error_rate=0.0, seed=3)
+                full = dict((row['url'], row) for row in process_logfile(xread_loglines(log_path)))
+
+                for sample in ({'rate': 0.1}, {'lines': 2000}):
+                    sample = dict(sample)
+                    aggregate = aggregate_loglines(xread_loglines(log_path, sample=sample))
+                    rows = build_stat_list(aggregate, sample_rate=sample['rate'])
+                    self.assertTrue(0.08 < sample['rate'] < 0.12)
+                    self.assertTrue(18000 < sum(row['count'] for row in rows) < 22000)
+                    top = max(rows, key=lambda row: row['count'])
+                    real = full[top['url']]
+                    self.assertTrue(top['count_ci_low'] <= real['count'] <= top['count_ci_high'])
+                    self.assertTrue(top['time_avg_ci_low'] <= real['time_avg'] <= top['time_avg_ci_high'])
+                    self.assertTrue(top['time_med_ci_low'] <= real['time_med'] <= top['time_med_ci_high'])
+                if ext == 'log':
+                    os.remove(log_path)
+
+            # sampled report doesn't block the real one
+            self.assertTrue(process(config, {'rate': 0.5}))
+            self.assertFalse(os.path.isfile(os.path.join(tmp_dir, 'report_2017.06.30.html')))
+            with open(os.path.join(tmp_dir, 'sample_2017.06.30.html')) as report:
+                self.assertIn('Approximate report', report.read())
+
+            # wrong format fails on the first lines
+            with open(os.path.join(tmp_dir, 'nginx-access-ui.log-20170701.log'), 'w') as log:
+                log.write('broken line\n' * 100000)
+            lines_read = []
+            log_lines = xread_loglines(os.path.join(tmp_dir, 'nginx-access-ui.log-20170701.log'),
+                                       sample={'rate': 0.5})
+            with self.assertRaises(Exception):
+                for log_line in xcheck_parse_errors(log_lines, 0.2):
+                    lines_read.append(log_line)
+            self.assertEqual(len(lines_read), SAMPLE_CHECK_LINES)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_watch(self):
+        for use_inotify in (False, True):
+            tmp_dir = tempfile.mkdtemp()
+            try:
+                log_dir = os.path.join(tmp_dir, 'log')
+                report_dir = os.path.join(tmp_dir, 'reports')
+                os.mkdir(log_dir)
+                config = {
+                    "REPORT_SIZE": 1000,
+                    "REPORT_DIR": report_dir,
+                    "REPORT_TEMPLATE": "./report.html",
+                    "TS_FILE": os.path.join(tmp_dir, "log_analyzer.ts"),
+                    "LOG_DIR": log_dir,
+                    "LOG_FILE_PATTERN": "nginx-access-ui.log-(\d+).(gz|log)",
+                    "WATCH_INOTIFY": use_inotify,
+                }
+                for day in ('20170629', '20170630'):
+                    shutil.copy('./test/log/nginx-access-ui.log-20170630.log',
+                                os.path.join(log_dir, 'nginx-access-ui.log-%s.log' % day))
+
+                def wakeups():
+                    yield [] if use_inotify else None
+                    self.assertEqual(os.listdir(report_dir), ['report_2017.06.30.html'])
+                    shutil.copy('./test/log/nginx-access-ui.log-20170630.log',
+                                os.path.join(log_dir, 'nginx-access-ui.log-20170701.log'))
+                    if use_inotify:
+                        yield [('nginx-access-ui.log-20170701.log', IN_CLOSE_WRITE)]
+                    else:
+                        # seen first, processed when unchanged on the next poll
+                        yield None
+                        self.assertEqual(os.listdir(report_dir), ['report_2017.06.30.html'])
+                        yield None
+
+                self.assertTrue(process_watch(config, wakeups=wakeups()))
+                self.assertEqual(sorted(os.listdir(report_dir)),
+                                 ['report_2017.06.30.html', 'report_2017.07.01.html'])
+                self.assertTrue(os.path.isfile(config['TS_FILE']))
+            finally:
+                shutil.rmtree(tmp_dir)
+
     def test_total_parse_errors(self):
         pass
 